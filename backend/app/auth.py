@@ -1,22 +1,105 @@
 from fastapi import HTTPException, Depends
 from jose import jwt
 from datetime import datetime, timedelta
-import os
+from collections import OrderedDict
+import os, time, hashlib
+from .instrumentation import Counter
 
 JWT_SECRET = os.getenv("JWT_SECRET", "devsecret")
 ALGO = "HS256"
+# token thiết bị (scope=device) do /devices/register cấp; thu hồi qua app/device_auth.py
+DEVICE_SCOPE = "device"
+DEVICE_TOKEN_DAYS = int(os.getenv("AUTH__DEVICE_TOKEN_DAYS", "365"))
+# số token đã verify giữ trong RAM (LRU); 0 = tắt cache
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH__TOKEN_CACHE_SIZE", "10000"))
+
+TOKEN_CACHE = Counter("auth_token_cache_lookups", "Verified JWT cache lookups", ("result",))
 
 def create_token(sub: str, minutes: int = 60):
     now = datetime.utcnow()
     payload = {"sub": sub, "iat": now, "exp": now + timedelta(minutes=minutes)}
     return jwt.encode(payload, JWT_SECRET, algorithm=ALGO)
 
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-security = HTTPBearer()
+def create_device_token(device_uid: str, days: int = DEVICE_TOKEN_DAYS) -> str:
+    """JWT cho thiết bị: `sub` = device_uid, `scope` = device.
 
-def require_user(token: HTTPAuthorizationCredentials = Depends(security)):
+    `iat` để số thực (giây) → thu hồi theo mốc thời gian không dính token cấp lại cùng giây.
+    """
+    now = time.time()
+    payload = {"sub": device_uid, "scope": DEVICE_SCOPE, "iat": now, "exp": int(now + days * 86400)}
+    return jwt.encode(payload, JWT_SECRET, algorithm=ALGO)
+
+class TokenCache:
+    """LRU claims của token đã verify chữ ký, khoá = sha256(token) (không giữ token gốc).
+
+    Entry tự hết hiệu lực ở `exp` của token; token không có `exp` không được cache.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items: OrderedDict[bytes, dict] = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._key(token)
+        claims = self._items.get(key)
+        if claims is None:
+            return None
+        if claims["exp"] <= time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return claims
+
+    def put(self, token: str, claims: dict):
+        if self.maxsize <= 0 or not isinstance(claims.get("exp"), (int, float)):
+            return
+        self._items[self._key(token)] = claims
+        self._items.move_to_end(self._key(token))
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+token_cache = TokenCache()
+
+def decode_token(token: str) -> dict:
+    """Verify chữ ký + `exp` (kết quả được cache). Token sai/hết hạn → 401."""
+    claims = token_cache.get(token)
+    if claims is not None:
+        TOKEN_CACHE.labels("hit").inc()
+        return claims
+    TOKEN_CACHE.labels("miss").inc()
     try:
-        data = jwt.decode(token.credentials, JWT_SECRET, algorithms=[ALGO])
-        return data["sub"]
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[ALGO])
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.put(token, claims)
+    return claims
+
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+security = HTTPBearer()
+
+def verify_user_token(token: str) -> str:
+    """Giải mã JWT user, trả về `sub`; token sai/hết hạn (hoặc token thiết bị) → 401."""
+    claims = decode_token(token)
+    if claims.get("scope") == DEVICE_SCOPE or "sub" not in claims:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return claims["sub"]
+
+def verify_device_token(token: str) -> dict:
+    """Giải mã JWT thiết bị (scope=device), trả về claims; chưa kiểm tra thu hồi."""
+    claims = decode_token(token)
+    if claims.get("scope") != DEVICE_SCOPE or "sub" not in claims:
+        raise HTTPException(status_code=401, detail="Invalid device token")
+    return claims
+
+def require_user(token: HTTPAuthorizationCredentials = Depends(security)):
+    return verify_user_token(token.credentials)
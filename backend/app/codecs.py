@@ -0,0 +1,97 @@
+"""Codec cho payload telemetry: JSON (mặc định), CBOR và MessagePack (tuỳ chọn).
+
+CBOR cần `pip install cbor2`, MessagePack cần `pip install msgpack`; thiếu thư viện
+thì codec đó không có trong `CODECS` và message dùng nó bị bỏ qua (có log).
+
+Chọn codec theo thứ tự:
+- MQTT v5 `content-type` / HTTP `Content-Type` (`application/cbor`, `application/msgpack`, ...).
+- Hậu tố topic: `t0/devices/{uid}/telemetry/cbor`, `.../telemetry/msgpack`.
+- Mặc định JSON.
+"""
+import json, base64
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import cbor2
+except ImportError:  # codec tuỳ chọn
+    cbor2 = None
+
+try:
+    import msgpack
+except ImportError:  # codec tuỳ chọn
+    msgpack = None
+
+class Codec:
+    def __init__(self, name: str, content_types: tuple[str, ...], decode, encode):
+        self.name = name
+        self.content_types = content_types
+        self.decode = decode
+        self.encode = encode
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+def _jsonable(obj):
+    """Đưa kiểu riêng của CBOR/msgpack về kiểu JSON được (payload vẫn lưu cột JSON)."""
+    if isinstance(obj, dict):
+        return {k if isinstance(k, str) else str(k): _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+# tên/content-type của mọi codec đã biết (kể cả chưa cài thư viện) → phân biệt "không hỗ trợ" với "không cài"
+KNOWN = {
+    "json": ("application/json", "text/json"),
+    "cbor": ("application/cbor",),
+    "msgpack": ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack"),
+}
+
+JSON = Codec("json", KNOWN["json"], json.loads, lambda obj: json.dumps(obj).encode())
+
+CODECS: dict[str, Codec] = {"json": JSON}
+if cbor2 is not None:
+    CODECS["cbor"] = Codec(
+        "cbor", KNOWN["cbor"],
+        lambda data: _jsonable(cbor2.loads(data)), cbor2.dumps,
+    )
+if msgpack is not None:
+    CODECS["msgpack"] = Codec(
+        "msgpack", KNOWN["msgpack"],
+        lambda data: _jsonable(msgpack.unpackb(data, raw=False, strict_map_key=False, timestamp=3)), msgpack.packb,
+    )
+
+class CodecUnavailable(ValueError):
+    pass
+
+def _mime(content_type: str | None) -> str:
+    return (content_type or "").split(";")[0].strip().lower()
+
+def codec_name_for(content_type: str | None) -> str | None:
+    mime = _mime(content_type)
+    for name, types in KNOWN.items():
+        if mime in types:
+            return name
+    return None
+
+def get_codec(name: str) -> Codec:
+    """Codec theo tên; `CodecUnavailable` nếu biết tên nhưng chưa cài thư viện."""
+    codec = CODECS.get(name)
+    if codec is None:
+        raise CodecUnavailable(f"codec {name!r} not available (install its package)")
+    return codec
+
+def select_codec(content_type: str | None = None, topic_suffix: str | None = None) -> Codec:
+    """Chọn codec từ content-type rồi tới hậu tố topic; không nhận ra → JSON."""
+    name = codec_name_for(content_type)
+    if name is None and topic_suffix in KNOWN:
+        name = topic_suffix
+    return get_codec(name or "json")
@@ -0,0 +1,145 @@
+"""Hàng đợi command cho thiết bị HTTP polling: lease, ack theo lô, thử lại và dead-letter.
+
+Vòng đời 1 dòng `command_queue`:
+
+    pending ──publish MQTT──▶ sent ──poll──▶ leased ──ack──▶ acked
+                                ▲               │ hết lease (sweeper)
+                                └── attempts < MAX_ATTEMPTS ──┘ ... ≥ MAX_ATTEMPTS ──▶ dead
+
+- `claim()`: `FOR UPDATE SKIP LOCKED` → nhiều request poll cùng lúc (nhiều API worker)
+  không nhận trùng command; tối đa `max` dòng, cũ nhất trước; mỗi lần lease tăng `attempts`.
+- `ack()`: 1 câu UPDATE cho cả lô id, ghi `ack_at`. Ack lại / ack sau khi hết lease vẫn hợp lệ
+  (giao ít nhất 1 lần – thiết bị nên bỏ qua command trùng id).
+- `LeaseSweeper`: định kỳ trả command hết lease về `sent` (đánh thức long-poll bằng NOTIFY)
+  hoặc chuyển `dead` khi đã lease `COMMANDS__MAX_ATTEMPTS` lần.
+- Index partial trên dòng `pending`/`sent` và `leased` → poll/sweep tỉ lệ với số command đang
+  mở, không phụ thuộc lịch sử đã ack.
+"""
+import os, asyncio, logging
+from sqlalchemy import text, bindparam, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import SessionLocal
+from .notifier import announce
+from .instrumentation import Counter
+
+LEASE_SECONDS = int(os.getenv("COMMANDS__LEASE_SECONDS", "30"))
+MAX_ATTEMPTS = int(os.getenv("COMMANDS__MAX_ATTEMPTS", "5"))
+POLL_MAX = int(os.getenv("COMMANDS__POLL_MAX", "10"))
+SWEEP_SECONDS = float(os.getenv("COMMANDS__SWEEP_SECONDS", "5"))
+SWEEP_BATCH = 1000
+
+EVENTS = Counter("command_queue_events", "Command queue transitions", ("event",))
+
+log = logging.getLogger(__name__)
+
+_CLAIM_SQL = text("""
+WITH c AS (
+    SELECT id FROM command_queue
+    WHERE device_uid = :uid AND status = 'sent'
+    ORDER BY id
+    LIMIT :max
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE command_queue q
+SET status = 'leased', attempts = q.attempts + 1, lease_until = now() + make_interval(secs => :lease)
+FROM c WHERE q.id = c.id
+RETURNING q.id, q.cmd, q.params, q.status, q.attempts, q.created_at, q.lease_until
+""")
+
+_ACK_SQL = text("""
+UPDATE command_queue SET status = 'acked', ack_at = coalesce(ack_at, now()), lease_until = NULL
+WHERE device_uid = :uid AND id = ANY(:ids)
+RETURNING id
+""").bindparams(bindparam("ids", type_=ARRAY(BigInteger)))
+
+_SWEEP_SQL = text("""
+WITH expired AS (
+    SELECT id FROM command_queue
+    WHERE status = 'leased' AND lease_until < now()
+    ORDER BY lease_until
+    LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE command_queue q
+SET status = CASE WHEN q.attempts >= :max_attempts THEN 'dead' ELSE 'sent' END, lease_until = NULL
+FROM expired WHERE q.id = expired.id
+RETURNING q.device_uid, q.status
+""")
+
+def _row(r) -> dict:
+    return {
+        "id": r.id, "cmd": r.cmd, "params": r.params, "status": r.status, "attempts": r.attempts,
+        "created_at": r.created_at.isoformat() if r.created_at else None,
+        "lease_until": r.lease_until.isoformat() if r.lease_until else None,
+    }
+
+async def claim(db: AsyncSession, device_uid: str, max_items: int = POLL_MAX, lease_seconds: int = LEASE_SECONDS) -> list[dict]:
+    """Lease tối đa `max_items` command `sent` của thiết bị (cũ nhất trước). Có commit."""
+    res = await db.execute(_CLAIM_SQL, {"uid": device_uid, "max": max_items, "lease": lease_seconds})
+    rows = sorted(res.all(), key=lambda r: r.id)
+    await db.commit()
+    if rows:
+        EVENTS.labels("leased").inc(len(rows))
+    return [_row(r) for r in rows]
+
+async def ack(db: AsyncSession, device_uid: str, ids: list[int]) -> list[int]:
+    """Đánh dấu `acked` các command của thiết bị trong `ids`; trả về id đã ack. Có commit."""
+    if not ids:
+        return []
+    res = await db.execute(_ACK_SQL, {"uid": device_uid, "ids": list(ids)})
+    acked = sorted(r.id for r in res.all())
+    await db.commit()
+    EVENTS.labels("acked").inc(len(acked))
+    return acked
+
+async def sweep(db: AsyncSession, max_attempts: int = MAX_ATTEMPTS) -> dict[str, int]:
+    """Xử lý lease đã hết hạn (theo lô, tới khi hết). Trả về số dòng `redelivered` / `dead`."""
+    counts = {"redelivered": 0, "dead": 0}
+    while True:
+        res = await db.execute(_SWEEP_SQL, {"batch": SWEEP_BATCH, "max_attempts": max_attempts})
+        rows = res.all()
+        redelivered = [r.device_uid for r in rows if r.status == "sent"]
+        if redelivered:
+            await announce(db, redelivered)
+        await db.commit()
+        counts["redelivered"] += len(redelivered)
+        counts["dead"] += len(rows) - len(redelivered)
+        if len(rows) < SWEEP_BATCH:
+            break
+    EVENTS.labels("redelivered").inc(counts["redelivered"])
+    EVENTS.labels("dead").inc(counts["dead"])
+    if counts["dead"]:
+        log.warning("%d commands dead-lettered after %d attempts", counts["dead"], max_attempts)
+    return counts
+
+class LeaseSweeper:
+    """Task nền chạy `sweep()` mỗi `interval` giây (an toàn khi nhiều API worker cùng chạy)."""
+
+    def __init__(self, interval: float = SWEEP_SECONDS):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                async with SessionLocal() as db:
+                    await sweep(db)
+            except Exception:
+                log.exception("command lease sweep failed")
+
+sweeper = LeaseSweeper()
@@ -0,0 +1,103 @@
+"""Chống trùng msg_id trong RAM trước khi chạm DB.
+
+Mỗi thiết bị giữ `DEDUP__WINDOW` msg_id gần nhất đã ghi thành công, dạng vòng (ring)
+các hash 64-bit đóng gói trong 1 `bytearray` (8 byte/msg_id). Số thiết bị được giữ
+giới hạn bởi `DEDUP__MAX_DEVICES` (LRU) → bộ nhớ tối đa ≈ MAX_DEVICES × (8 × WINDOW + ~200 byte).
+
+- `seen()` lúc nhận message: trùng trong cửa sổ → bỏ luôn, không INSERT.
+- `record()` chỉ gọi sau khi commit → message ghi lỗi không bao giờ bị coi là trùng.
+- Không thấy trong cửa sổ ≠ chắc chắn mới: ràng buộc `telemetry_msg_ids` là chốt cuối, nhưng khoá
+  có `ts` (bảng partition) → chỉ chặn bản gửi lại cùng `ts`; message không kèm `ts` (server gán
+  giờ nhận) chỉ được chống trùng bởi cửa sổ này.
+
+QoS1 gửi lại sau reconnect nằm trong số message in-flight của broker (EMQX mặc định
+`max_inflight` = 32) nên cửa sổ 32 bắt được gần hết.
+"""
+import os, hashlib
+from collections import OrderedDict
+from .instrumentation import Counter, GaugeFunc
+
+DEDUP_ENABLED = os.getenv("DEDUP__ENABLED", "1") not in ("0", "false", "no")
+WINDOW = int(os.getenv("DEDUP__WINDOW", "32"))
+MAX_DEVICES = int(os.getenv("DEDUP__MAX_DEVICES", "100000"))
+
+LOOKUPS = Counter("dedup_lookups", "In-memory msg_id dedup lookups (hit = duplicate dropped before the DB)", ("result",))
+
+def _hash(msg_id: str) -> bytes:
+    return hashlib.blake2b(msg_id.encode(), digest_size=8).digest()
+
+class _Ring:
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, window: int):
+        self.buf = bytearray(8 * window)
+        self.pos = 0
+
+    def __contains__(self, h: bytes) -> bool:
+        # find() chạy bằng C; chỉ tính kết quả rơi đúng ranh giới 8 byte
+        i = self.buf.find(h)
+        while i >= 0:
+            if i % 8 == 0:
+                return True
+            i = self.buf.find(h, i + 1)
+        return False
+
+    def add(self, h: bytes):
+        start = self.pos * 8
+        self.buf[start:start + 8] = h
+        self.pos = (self.pos + 1) % (len(self.buf) // 8)
+
+class RecentIds:
+    """Cửa sổ msg_id gần nhất theo thiết bị (LRU thiết bị, ring hash theo msg_id)."""
+
+    def __init__(self, window: int = WINDOW, max_devices: int = MAX_DEVICES, enabled: bool = DEDUP_ENABLED):
+        self.window = max(1, window)
+        self.max_devices = max(1, max_devices)
+        self.enabled = enabled
+        self._devices: OrderedDict[str, _Ring] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._devices)
+
+    def seen(self, device_uid: str, msg_id: str) -> bool:
+        if not self.enabled:
+            return False
+        ring = self._devices.get(device_uid)
+        if ring is not None and _hash(msg_id) in ring:
+            self.hits += 1
+            LOOKUPS.labels("hit").inc()
+            return True
+        self.misses += 1
+        LOOKUPS.labels("miss").inc()
+        return False
+
+    def record(self, device_uid: str, msg_id: str):
+        if not self.enabled:
+            return
+        ring = self._devices.get(device_uid)
+        if ring is None:
+            ring = self._devices[device_uid] = _Ring(self.window)
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(device_uid)
+        h = _hash(msg_id)
+        if h not in ring:
+            ring.add(h)
+
+    def record_many(self, keys):
+        for device_uid, msg_id in keys:
+            self.record(device_uid, msg_id)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "dedup_hits": self.hits,
+            "dedup_hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "dedup_devices": len(self._devices),
+        }
+
+recent_ids = RecentIds()
+GaugeFunc("dedup_devices", "Devices tracked by the in-memory msg_id dedup window", lambda: len(recent_ids))
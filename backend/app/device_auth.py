@@ -0,0 +1,143 @@
+"""Xác thực request HTTP của thiết bị.
+
+- Token thiết bị (JWT scope=device, `sub` = device_uid, cấp ở `/devices/register`):
+  verify chữ ký trong RAM (có cache, xem `app/auth.py`), không truy vấn DB.
+- Thu hồi: bảng `device_token_revocations`; token có `iat` < `revoked_before` bị từ chối.
+  Danh sách giữ trong RAM, nạp lại mỗi `AUTH__REVOCATION_REFRESH_SECONDS` (các API worker
+  khác thấy thu hồi chậm tối đa chừng đó) và cập nhật ngay trên worker xử lý lệnh thu hồi.
+- Secret (`X-Device-Secret` không phải JWT): chuỗi ngẫu nhiên trả về 1 lần lúc đăng ký, DB
+  chỉ lưu `sha256$<hex>` trong `devices.device_secret` (tra theo unique index của device_uid).
+  Thu hồi token của thiết bị xoá luôn secret.
+
+Gửi token qua `Authorization: Bearer <token>` hoặc `X-Device-Secret: <token>`.
+"""
+import os, hmac, hashlib, secrets, asyncio, logging
+from datetime import datetime, timezone
+from fastapi import Depends, Header, HTTPException
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .auth import verify_device_token
+from .db import SessionLocal, get_db
+from .models import Device
+from .instrumentation import Counter
+
+REFRESH_SECONDS = int(os.getenv("AUTH__REVOCATION_REFRESH_SECONDS", "30"))
+
+DEVICE_AUTH = Counter("device_auth_requests", "Device HTTP authentications by method and result", ("method", "result"))
+
+log = logging.getLogger(__name__)
+
+class RevocationList:
+    """device_uid → mốc thu hồi (epoch giây), bản sao trong RAM của `device_token_revocations`."""
+
+    def __init__(self):
+        self._before: dict[str, float] = {}
+        self._task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._before)
+
+    def is_revoked(self, device_uid: str, issued_at: float) -> bool:
+        before = self._before.get(device_uid)
+        return before is not None and issued_at < before
+
+    async def refresh(self, db: AsyncSession):
+        res = await db.execute(text("SELECT device_uid, extract(epoch FROM revoked_before) FROM device_token_revocations"))
+        self._before = {uid: float(ts) for uid, ts in res.all()}
+
+    async def revoke(self, db: AsyncSession, device_uid: str, before: datetime | None = None) -> datetime:
+        """Thu hồi mọi token của thiết bị cấp trước `before` (mặc định: bây giờ). Có commit."""
+        before = before or datetime.now(timezone.utc)
+        await db.execute(text("""
+            INSERT INTO device_token_revocations (device_uid, revoked_before) VALUES (:uid, :before)
+            ON CONFLICT (device_uid) DO UPDATE SET revoked_before = EXCLUDED.revoked_before
+        """), {"uid": device_uid, "before": before})
+        await db.commit()
+        self._before[device_uid] = before.timestamp()
+        return before
+
+    async def start(self):
+        async with SessionLocal() as db:
+            await self.refresh(db)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REFRESH_SECONDS)
+            try:
+                async with SessionLocal() as db:
+                    await self.refresh(db)
+            except Exception:
+                log.exception("device token revocation refresh failed")
+
+revocations = RevocationList()
+
+SECRET_PREFIX = "sha256$"
+
+def hash_secret(secret: str) -> str:
+    return SECRET_PREFIX + hashlib.sha256(secret.encode()).hexdigest()
+
+def new_device_secret() -> tuple[str, str]:
+    """(secret trả cho thiết bị, giá trị lưu DB)."""
+    secret = secrets.token_urlsafe(32)
+    return secret, hash_secret(secret)
+
+# secret cũ (bản rõ, nhiều cái là device_uid đảo ngược – đoán được): bỏ secret đoán được,
+# băm phần còn lại. Idempotent, chạy lúc startup API.
+HASH_LEGACY_SECRETS_SQL = f"""
+UPDATE devices SET device_secret = CASE
+    WHEN device_secret = reverse(device_uid) THEN NULL
+    ELSE '{SECRET_PREFIX}' || encode(sha256(convert_to(device_secret, 'UTF8')), 'hex')
+END
+WHERE device_secret IS NOT NULL AND device_secret NOT LIKE '{SECRET_PREFIX}%'
+"""
+
+def _looks_like_jwt(value: str) -> bool:
+    return value.count(".") == 2
+
+async def authenticate_device(db: AsyncSession, device_uid: str, credential: str | None):
+    """401 nếu thiếu/sai credential, 403 nếu credential thuộc thiết bị khác hoặc đã bị thu hồi."""
+    if not credential:
+        raise HTTPException(status_code=401, detail="Missing device credentials")
+    if _looks_like_jwt(credential):
+        try:
+            claims = verify_device_token(credential)
+        except HTTPException:
+            DEVICE_AUTH.labels("token", "invalid").inc()
+            raise
+        if claims["sub"] != device_uid:
+            DEVICE_AUTH.labels("token", "forbidden").inc()
+            raise HTTPException(status_code=403, detail="Token is for another device")
+        if revocations.is_revoked(device_uid, float(claims.get("iat", 0))):
+            DEVICE_AUTH.labels("token", "revoked").inc()
+            raise HTTPException(status_code=403, detail="Device token revoked")
+        DEVICE_AUTH.labels("token", "ok").inc()
+        return
+    res = await db.execute(select(Device.device_secret).where(Device.device_uid == device_uid))
+    stored = res.scalar_one_or_none()
+    if not stored or not hmac.compare_digest(stored.encode(), hash_secret(credential).encode()):
+        DEVICE_AUTH.labels("secret", "forbidden").inc()
+        raise HTTPException(status_code=403, detail="Invalid device secret")
+    DEVICE_AUTH.labels("secret", "ok").inc()
+
+async def require_device(
+    device_uid: str,
+    db: AsyncSession = Depends(get_db),
+    secret: str | None = Header(None, alias="X-Device-Secret"),
+    authorization: str | None = Header(None),
+):
+    """Dependency cho endpoint `/devices/{device_uid}/...` của thiết bị."""
+    credential = secret
+    if authorization and authorization.lower().startswith("bearer "):
+        credential = authorization[7:]
+    await authenticate_device(db, device_uid, credential)
@@ -0,0 +1,177 @@
+"""Xuất telemetry số lượng lớn, stream thẳng từ Postgres – bộ nhớ không phụ thuộc kích thước export.
+
+- CSV / NDJSON: `COPY (SELECT ...) TO STDOUT` qua asyncpg `copy_from_query`. Dữ liệu từ
+  Postgres được gom thành chunk ~`EXPORT__CHUNK_KB` rồi qua hàng đợi giới hạn
+  `EXPORT__QUEUE_CHUNKS` tới response → client đọc chậm thì COPY chậm theo (backpressure),
+  không dồn vào RAM.
+- Parquet (cần `pyarrow`, tuỳ chọn): server-side cursor, mỗi `EXPORT__PARQUET_ROWS` dòng
+  ghi 1 row group rồi gửi đi ngay.
+- Mỗi thiết bị 1 câu lệnh `WHERE device_uid = $1 AND ts ∈ [from, to) ORDER BY ts, id` → đọc
+  theo index `(device_uid, ts, id)`, không phải sort lớn. Cả export chạy trong 1 transaction
+  REPEATABLE READ READ ONLY → 1 snapshot nhất quán.
+- NDJSON: `jsonb_build_object(...)::text` xuất bằng COPY dạng csv với QUOTE/DELIMITER là ký tự
+  điều khiển không bao giờ xuất hiện trong JSON (jsonb escape chúng) → mỗi dòng là JSON nguyên vẹn.
+"""
+import os, zlib, asyncio, logging
+from datetime import datetime
+from typing import AsyncIterator
+from .db import engine
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet là tuỳ chọn
+    pa = pq = None
+
+CHUNK_BYTES = int(os.getenv("EXPORT__CHUNK_KB", "64")) * 1024
+QUEUE_CHUNKS = int(os.getenv("EXPORT__QUEUE_CHUNKS", "16"))
+PARQUET_ROWS = int(os.getenv("EXPORT__PARQUET_ROWS", "50000"))
+
+# format → (media type, phần mở rộng file)
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+log = logging.getLogger(__name__)
+
+_WHERE = "FROM telemetry WHERE device_uid = $1 AND ts >= $2 AND ts < $3 ORDER BY ts, id"
+_CSV_SQL = f"SELECT device_uid, msg_id, ts, payload {_WHERE}"
+_NDJSON_SQL = f"SELECT jsonb_build_object('device_uid', device_uid, 'msg_id', msg_id, 'ts', ts, 'payload', payload)::text {_WHERE}"
+_PARQUET_SQL = f"SELECT device_uid, msg_id, ts, payload::text {_WHERE}"
+
+class ExportUnavailable(ValueError):
+    """Format hợp lệ nhưng thiếu thư viện tuỳ chọn (ví dụ Parquet cần pyarrow)."""
+
+def available(fmt: str) -> bool:
+    return fmt in FORMATS and (fmt != "parquet" or pq is not None)
+
+class _Chunker:
+    """Gom các mẩu nhỏ thành chunk ~CHUNK_BYTES trước khi đưa vào hàng đợi."""
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.buf = bytearray()
+
+    async def write(self, data: bytes):
+        self.buf += data
+        if len(self.buf) >= CHUNK_BYTES:
+            await self.flush()
+
+    async def flush(self):
+        if self.buf:
+            await self.queue.put(bytes(self.buf))
+            self.buf = bytearray()
+
+class _ParquetSink:
+    """File-like tối giản cho `pq.ParquetWriter`: giữ byte đã ghi cho tới khi được lấy đi."""
+
+    def __init__(self):
+        self.parts: list[bytes] = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        out, self.parts = b"".join(self.parts), []
+        return out
+
+def _parquet_schema():
+    return pa.schema([
+        ("device_uid", pa.string()),
+        ("msg_id", pa.string()),
+        ("ts", pa.timestamp("us", tz="UTC")),
+        ("payload", pa.string()),  # JSON text
+    ])
+
+async def _copy_rows(raw, fmt: str, uids: list[str], from_: datetime, to: datetime, out: _Chunker):
+    for i, uid in enumerate(uids):
+        if fmt == "csv":
+            await raw.copy_from_query(_CSV_SQL, uid, from_, to, output=out.write, format="csv", header=(i == 0))
+        else:
+            await raw.copy_from_query(_NDJSON_SQL, uid, from_, to, output=out.write, format="csv", delimiter="\x02", quote="\x01")
+
+async def _parquet_rows(raw, uids: list[str], from_: datetime, to: datetime, out: _Chunker):
+    sink = _ParquetSink()
+    schema = _parquet_schema()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for uid in uids:
+            cur = await raw.cursor(_PARQUET_SQL, uid, from_, to, prefetch=min(PARQUET_ROWS, 10000))
+            while rows := await cur.fetch(PARQUET_ROWS):
+                cols = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+                await out.write(sink.take())
+    finally:
+        writer.close()
+    await out.write(sink.take())
+
+async def stream_telemetry(fmt: str, uids: list[str], from_: datetime, to: datetime) -> AsyncIterator[bytes]:
+    """Sinh các chunk byte của file export; task đọc DB chạy song song, giới hạn bởi hàng đợi."""
+    if not available(fmt):
+        raise ExportUnavailable(f"export format {fmt!r} unavailable" + (" (pip install pyarrow)" if fmt == "parquet" else ""))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_CHUNKS)
+    out = _Chunker(queue)
+
+    async def produce():
+        async with engine.connect() as conn:
+            raw = (await conn.get_raw_connection()).driver_connection
+            try:
+                async with raw.transaction(isolation="repeatable_read", readonly=True):
+                    await raw.execute("SET LOCAL TimeZone = 'UTC'")
+                    if fmt == "parquet":
+                        await _parquet_rows(raw, uids, from_, to, out)
+                    else:
+                        await _copy_rows(raw, fmt, uids, from_, to, out)
+            except asyncio.CancelledError:
+                # client ngắt giữa chừng: COPY dang dở → không trả kết nối này về pool
+                await conn.invalidate()
+                raise
+        await out.flush()
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            # producer xong (hoặc lỗi): lấy nốt phần còn trong hàng đợi
+            while not queue.empty():
+                yield queue.get_nowait()
+            if task.exception() is not None:
+                # header HTTP đã gửi, không đổi được status → log và cắt response
+                log.error("telemetry export failed, response truncated", exc_info=task.exception())
+            break
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = header gzip
+    async for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
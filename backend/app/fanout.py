@@ -0,0 +1,42 @@
+import uuid
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, insert, func, literal, any_, JSON, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from .models import Device, CommandQueue
+
+def target_devices(device_uids: list[str] | None = None, tenant: str | None = None, uid_prefix: str | None = None):
+    """SELECT device_uid theo danh sách uid / tenant / prefix (các điều kiện AND với nhau)."""
+    q = select(Device.device_uid)
+    if device_uids is not None:
+        # 1 tham số mảng thay vì N bind params (danh sách có thể hàng chục nghìn uid)
+        q = q.where(Device.device_uid == any_(literal(device_uids, ARRAY(String))))
+    if tenant is not None:
+        q = q.where(Device.tenant == tenant)
+    if uid_prefix:
+        q = q.where(Device.device_uid.startswith(uid_prefix, autoescape=True))
+    return q
+
+async def create_job(db: AsyncSession, cmd: str, params: dict | None, targets) -> tuple[str, int]:
+    """Tạo toàn bộ `CommandQueue` của job bằng 1 câu `INSERT ... SELECT` (status `pending`).
+
+    Việc publish MQTT do dispatcher outbox (`app/outbox.py`) làm theo lô.
+    """
+    job_id = uuid.uuid4().hex
+    src = targets.add_columns(
+        literal(cmd), literal(params, JSON), literal("pending"), literal(job_id)
+    )
+    stmt = insert(CommandQueue).from_select(
+        ["device_uid", "cmd", "params", "status", "job_id"], src
+    )
+    res = await db.execute(stmt)
+    await db.commit()
+    return job_id, res.rowcount
+
+async def job_progress(db: AsyncSession, job_id: str) -> dict[str, int]:
+    """Đếm command của job theo status (pending/sent/failed/acked)."""
+    res = await db.execute(
+        select(CommandQueue.status, func.count())
+        .where(CommandQueue.job_id == job_id)
+        .group_by(CommandQueue.status)
+    )
+    return {status: n for status, n in res.all()}
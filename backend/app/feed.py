@@ -0,0 +1,97 @@
+import os, uuid, asyncio, logging
+from datetime import datetime, timezone
+from typing import Callable
+from asyncio_mqtt import Client, MqttError
+from paho.mqtt.client import topic_matches_sub
+from .messages import decode_telemetry, telemetry_topics, content_type_of
+from .mqtt_pub import MQTT_HOST, MQTT_PORT, MQTT_PROTOCOL
+from .presence import STATUS_TOPIC, decode_status
+
+TELEMETRY_TOPIC = os.getenv("MQTT__TOPIC", "t0/devices/+/telemetry")
+
+log = logging.getLogger(__name__)
+
+# listener(device_uid, msg_id, payload, ts) – gọi đồng bộ, phải nhanh, không I/O
+Listener = Callable[[str, str, dict, datetime], None]
+# status_listener(device_uid, online, ts, retained) – message status / last-will (app/presence.py)
+StatusListener = Callable[[str, bool, float | None, bool], None]
+
+class TelemetryFeed:
+    """1 subscription MQTT telemetry cho cả API worker, phát tới các listener trong process.
+
+    Dùng cho dữ liệu "nóng" (device shadow, ...) mà không cần đọc lại Postgres.
+    """
+
+    def __init__(self, topic: str = TELEMETRY_TOPIC, status_topic: str = STATUS_TOPIC):
+        self.topic = topic
+        self.status_topic = status_topic
+        self._listeners: list[Listener] = []
+        self._status_listeners: list[StatusListener] = []
+        self._task: asyncio.Task | None = None
+        self.received = 0
+
+    def add_listener(self, fn: Listener):
+        self._listeners.append(fn)
+
+    def add_status_listener(self, fn: StatusListener):
+        """Nhận thêm topic status (chỉ subscribe khi có listener)."""
+        self._status_listeners.append(fn)
+
+    def publish_local(self, device_uid: str, msg_id: str, payload: dict, ts: datetime | None = None):
+        """Đưa telemetry nhận qua HTTP vào cùng luồng với telemetry MQTT."""
+        ts = ts or datetime.now(timezone.utc)
+        for fn in self._listeners:
+            try:
+                fn(device_uid, msg_id, payload, ts)
+            except Exception:
+                log.exception("telemetry listener failed")
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _dispatch_status(self, m):
+        decoded = decode_status(m.topic, m.payload)
+        if decoded is None:
+            return
+        for fn in self._status_listeners:
+            try:
+                fn(*decoded, bool(m.retain))
+            except Exception:
+                log.exception("status listener failed")
+
+    async def _run(self):
+        delay = 1
+        client_id = f"api-feed-{uuid.uuid4().hex[:8]}"
+        while True:
+            try:
+                async with Client(MQTT_HOST, MQTT_PORT, client_id=client_id, protocol=MQTT_PROTOCOL) as client:
+                    for topic in telemetry_topics(self.topic):
+                        await client.subscribe(topic, qos=0)
+                    if self._status_listeners:
+                        await client.subscribe(self.status_topic, qos=1)
+                    delay = 1
+                    async with client.unfiltered_messages() as messages:
+                        async for m in messages:
+                            if self._status_listeners and topic_matches_sub(self.status_topic, m.topic):
+                                self._dispatch_status(m)
+                                continue
+                            decoded = decode_telemetry(m.topic, m.payload, content_type_of(m))
+                            if decoded is not None:
+                                self.received += 1
+                                self.publish_local(*decoded)
+            except MqttError as e:
+                log.warning("telemetry feed disconnected: %s (retry in %ss)", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+feed = TelemetryFeed()
@@ -0,0 +1,42 @@
+import os, math
+from fnmatch import fnmatchcase
+
+# các path (dạng a.b.c, cho phép wildcard) được trích từ payload telemetry
+DEFAULT_FIELDS = [p.strip() for p in os.getenv("ROLLUP__FIELDS", "data.*").split(",") if p.strip()]
+# path được ghi vào bảng typed `telemetry_metrics` (số và bool)
+METRIC_FIELDS = [p.strip() for p in os.getenv("METRICS__FIELDS", "data.*").split(",") if p.strip()]
+
+def flatten(payload: dict, prefix: str = ""):
+    """Duyệt các lá của payload JSON, trả về cặp (path, value) với path nối bằng dấu chấm."""
+    for key, value in payload.items():
+        path = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        else:
+            yield path, value
+
+def finite_float(value) -> float | None:
+    """int/float hữu hạn → float; còn lại (bool, NaN/inf, int quá lớn cho double, kiểu khác) → None."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    try:
+        value = float(value)  # int quá lớn → OverflowError (math.isfinite cũng vậy)
+    except OverflowError:
+        return None
+    return value if math.isfinite(value) else None
+
+def numeric_fields(payload: dict, patterns: list[str] = DEFAULT_FIELDS, include_bool: bool = False) -> dict[str, float]:
+    """Các lá kiểu số khớp `patterns`, ví dụ `{"data.temp_c": 24.5}`.
+
+    Bool bị bỏ qua, trừ khi `include_bool` (ghi thành 1.0/0.0).
+    """
+    out = {}
+    for path, value in flatten(payload):
+        if isinstance(value, bool):
+            if include_bool and any(fnmatchcase(path, p) for p in patterns):
+                out[path] = float(value)
+            continue
+        value = finite_float(value)
+        if value is not None and any(fnmatchcase(path, p) for p in patterns):
+            out[path] = value
+    return out
@@ -0,0 +1,278 @@
+"""Phân phối firmware OTA: registry phiên bản, kênh, rollout theo %, manifest cache và tải có Range.
+
+- `firmware_releases`: mỗi phiên bản 1 dòng (kênh, tenant hoặc NULL = mọi tenant, sha256, size,
+  `rollout_percent`, `published_at`). File lưu trong `FIRMWARE__DIR` theo tên `<sha256>.bin`
+  (nội dung bất biến → `ETag` = sha256).
+- Kênh của thiết bị: `devices.firmware_channel`, không có thì kênh của tenant
+  (`firmware_tenant_channels`), mặc định `stable`.
+- Rollout: thiết bị nằm trong `rollout_percent` nếu `sha256(version:uid) % 100 < percent` → tăng %
+  chỉ thêm thiết bị, không bỏ thiết bị đã nhận. Thiết bị ngoài rollout của bản mới nhất nhận bản
+  cao nhất mà nó thuộc rollout.
+- Manifest (release đã publish + kênh tenant) và kênh/tenant của thiết bị được cache trong RAM;
+  publish/đổi kênh gửi `NOTIFY firmware_changed` → mọi API worker xoá cache. Nạp lại chỉ chạy
+  1 lần dù hàng nghìn thiết bị check cùng lúc; `FIRMWARE__CACHE_SECONDS` là giới hạn an toàn.
+- Binary nhỏ hơn `FIRMWARE__MEMORY_CACHE_MB` được giữ trong RAM và gửi bằng `memoryview` (không
+  copy, không đọc đĩa mỗi request); lớn hơn thì đọc file theo chunk. Hỗ trợ `If-None-Match` (304),
+  `Range: bytes=a-b` (206, 1 khoảng) và `If-Range` để ESP32 tải tiếp khi bị ngắt.
+"""
+import os, re, hashlib, asyncio, logging, time
+from collections import OrderedDict
+from typing import AsyncIterator
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .instrumentation import Counter
+
+STORAGE_DIR = os.getenv("FIRMWARE__DIR", "/app/firmware")
+CACHE_SECONDS = float(os.getenv("FIRMWARE__CACHE_SECONDS", "300"))
+MAX_BYTES = int(os.getenv("FIRMWARE__MAX_MB", "16")) * 1024 * 1024
+MEMORY_CACHE_BYTES = int(os.getenv("FIRMWARE__MEMORY_CACHE_MB", "64")) * 1024 * 1024
+DEVICE_CACHE_SIZE = int(os.getenv("FIRMWARE__DEVICE_CACHE_SIZE", "100000"))
+CHUNK_BYTES = 256 * 1024
+DEFAULT_CHANNEL = "stable"
+CHANNEL = "firmware_changed"
+
+CHECKS = Counter("firmware_checks", "Firmware update checks by result", ("result",))
+DOWNLOADS = Counter("firmware_downloads", "Firmware download responses by type", ("type",))
+DOWNLOAD_BYTES = Counter("firmware_download_bytes", "Firmware bytes sent")
+
+log = logging.getLogger(__name__)
+
+class FirmwareTooLarge(ValueError):
+    pass
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+def version_key(version: str) -> tuple:
+    """`1.10.0` > `1.9.3`; bản pre-release (`1.2.0-rc1`) thấp hơn `1.2.0`."""
+    core, _, pre = version.partition("-")
+    nums = tuple(int(p) if p.isdigit() else 0 for p in re.split(r"[.+]", core))
+    return nums, 0 if pre else 1, pre
+
+def rollout_bucket(version: str, device_uid: str) -> int:
+    return int.from_bytes(hashlib.sha256(f"{version}:{device_uid}".encode()).digest()[:8], "big") % 100
+
+def storage_path(sha256: str) -> str:
+    return os.path.join(STORAGE_DIR, f"{sha256}.bin")
+
+class Release:
+    __slots__ = ("version", "key", "channel", "tenant", "sha256", "size", "rollout")
+
+    def __init__(self, version, channel, tenant, sha256, size, rollout_percent):
+        self.version = version
+        self.key = version_key(version)
+        self.channel = channel
+        self.tenant = tenant
+        self.sha256 = sha256
+        self.size = size
+        self.rollout = rollout_percent
+
+    def includes(self, device_uid: str) -> bool:
+        return self.rollout >= 100 or rollout_bucket(self.version, device_uid) < self.rollout
+
+class FirmwareRegistry:
+    def __init__(self, ttl: float = CACHE_SECONDS, device_cache_size: int = DEVICE_CACHE_SIZE):
+        self.ttl = ttl
+        self.device_cache_size = device_cache_size
+        self._releases: dict[str, Release] | None = None
+        self._tenant_channels: dict[str, str] = {}
+        self._candidates: dict[tuple[str, str], list[Release]] = {}  # (tenant, kênh) → mới nhất trước
+        self._devices: OrderedDict[str, tuple[str, str | None]] = OrderedDict()  # uid → (tenant, kênh riêng)
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self.loads = 0
+
+    def invalidate(self, scope: str = ""):
+        """Xoá cache theo payload NOTIFY `firmware_changed`: `releases` (release/kênh tenant),
+        `device:<uid>` (kênh 1 thiết bị), rỗng = tất cả. Publish không xoá cache thiết bị →
+        không dồn hàng nghìn truy vấn `devices` ngay sau mỗi lần rollout."""
+        if scope.startswith("device:"):
+            self._devices.pop(scope[7:], None)
+        else:
+            self._releases = None
+            self._candidates = {}
+            if not scope:
+                self._devices.clear()
+        self._generation += 1
+
+    async def _manifest(self, db: AsyncSession) -> dict[str, Release]:
+        releases = self._releases
+        if releases is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return releases
+        async with self._lock:  # 1 lần nạp cho mọi request đang chờ
+            if self._releases is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._releases
+            generation = self._generation
+            res = await db.execute(text("""
+                SELECT version, channel, tenant, sha256, size, rollout_percent
+                FROM firmware_releases WHERE published_at IS NOT NULL
+            """))
+            releases = {row[0]: Release(*row) for row in res.all()}
+            res = await db.execute(text("SELECT tenant, channel FROM firmware_tenant_channels"))
+            tenant_channels = dict(res.all())
+            self.loads += 1
+            if generation == self._generation:  # không bị invalidate trong lúc nạp
+                self._releases, self._tenant_channels, self._candidates = releases, tenant_channels, {}
+                self._loaded_at = time.monotonic()
+            return releases
+
+    async def _device(self, db: AsyncSession, device_uid: str) -> tuple[str, str | None] | None:
+        info = self._devices.get(device_uid)
+        if info is not None:
+            self._devices.move_to_end(device_uid)
+            return info
+        generation = self._generation
+        res = await db.execute(text("SELECT tenant, firmware_channel FROM devices WHERE device_uid = :uid"), {"uid": device_uid})
+        row = res.one_or_none()
+        if row is None:
+            return None
+        info = (row.tenant or "t0", row.firmware_channel)
+        if generation == self._generation:
+            self._devices[device_uid] = info
+            if len(self._devices) > self.device_cache_size:
+                self._devices.popitem(last=False)
+        return info
+
+    def _candidates_for(self, releases: dict[str, Release], tenant: str, channel: str) -> list[Release]:
+        key = (tenant, channel)
+        found = self._candidates.get(key)
+        if found is None:
+            found = sorted(
+                (r for r in releases.values() if r.channel == channel and r.tenant in (None, tenant)),
+                key=lambda r: r.key, reverse=True,
+            )
+            if releases is self._releases:
+                self._candidates[key] = found
+        return found
+
+    async def resolve(self, db: AsyncSession, device_uid: str) -> Release | None:
+        """Bản cao nhất thiết bị được nhận (theo kênh, tenant, rollout); None nếu không có."""
+        releases = await self._manifest(db)
+        info = await self._device(db, device_uid)
+        if info is None:
+            return None
+        tenant, channel = info
+        channel = channel or self._tenant_channels.get(tenant) or DEFAULT_CHANNEL
+        for r in self._candidates_for(releases, tenant, channel):
+            if r.includes(device_uid):
+                return r
+        return None
+
+    async def check(self, db: AsyncSession, device_uid: str, current_version: str) -> tuple[Release | None, bool]:
+        """(bản mục tiêu, có cần cập nhật). Không hạ cấp thiết bị đang chạy bản mới hơn."""
+        target = await self.resolve(db, device_uid)
+        update = target is not None and target.key > version_key(current_version)
+        CHECKS.labels("update" if update else "current").inc()
+        return target, update
+
+    async def downloadable(self, db: AsyncSession, device_uid: str, version: str) -> Release | None:
+        """Release đã publish, cùng tenant với thiết bị (để tải lại/tải tiếp bản bất kỳ đã nhận)."""
+        releases = await self._manifest(db)
+        r = releases.get(version)
+        info = await self._device(db, device_uid)
+        if r is None or info is None or r.tenant not in (None, info[0]):
+            return None
+        return r
+
+registry = FirmwareRegistry()
+
+async def announce_change(db: AsyncSession, scope: str):
+    """NOTIFY trong transaction hiện tại: các worker xoá cache (`scope`, xem `invalidate`) sau khi commit."""
+    await db.execute(text("SELECT pg_notify(:ch, :scope)"), {"ch": CHANNEL, "scope": scope})
+
+async def store_binary(chunks: AsyncIterator[bytes], max_bytes: int = MAX_BYTES) -> tuple[str, int]:
+    """Ghi body upload ra `<sha256>.bin` trong `FIRMWARE__DIR` (ghi file tạm rồi rename)."""
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    tmp = os.path.join(STORAGE_DIR, f".upload-{os.getpid()}-{id(chunks)}")
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise FirmwareTooLarge(f"firmware larger than {max_bytes} bytes")
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        sha = digest.hexdigest()
+        os.replace(tmp, storage_path(sha))
+        return sha, size
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+class _BlobCache:
+    """Binary firmware trong RAM (LRU theo tổng byte)."""
+
+    def __init__(self, max_bytes: int = MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._blobs: OrderedDict[str, bytes] = OrderedDict()
+        self.bytes = 0
+
+    async def get(self, sha256: str, size: int) -> bytes | None:
+        blob = self._blobs.get(sha256)
+        if blob is not None:
+            self._blobs.move_to_end(sha256)
+            return blob
+        if size > self.max_bytes:
+            return None
+        blob = await asyncio.to_thread(_read_file, storage_path(sha256))
+        if sha256 not in self._blobs:
+            self._blobs[sha256] = blob
+            self.bytes += len(blob)
+            while self.bytes > self.max_bytes:
+                _, old = self._blobs.popitem(last=False)
+                self.bytes -= len(old)
+        return blob
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+blobs = _BlobCache()
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """`Range: bytes=a-b` / `a-` / `-n` → (start, end) gồm cả 2 đầu; None = gửi cả file
+    (không có Range, nhiều khoảng, đơn vị lạ). RangeNotSatisfiable nếu nằm ngoài file."""
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            n = int(last)
+            if n <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - n), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable(header)
+    return start, end
+
+async def iter_bytes(release: Release, start: int, end: int) -> AsyncIterator[bytes]:
+    """Đoạn [start, end] của binary: slice `memoryview` của bản trong RAM, hoặc đọc file theo chunk."""
+    blob = await blobs.get(release.sha256, release.size)
+    if blob is not None:
+        view = memoryview(blob)
+        for pos in range(start, end + 1, CHUNK_BYTES):
+            chunk = view[pos:min(pos + CHUNK_BYTES, end + 1)]
+            DOWNLOAD_BYTES.inc(len(chunk))
+            yield chunk
+        return
+    fd = os.open(storage_path(release.sha256), os.O_RDONLY)
+    try:
+        pos = start
+        while pos <= end:
+            chunk = await asyncio.to_thread(os.pread, fd, min(CHUNK_BYTES, end + 1 - pos), pos)
+            if not chunk:
+                break
+            pos += len(chunk)
+            DOWNLOAD_BYTES.inc(len(chunk))
+            yield chunk
+    finally:
+        os.close(fd)
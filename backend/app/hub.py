@@ -0,0 +1,90 @@
+import os, asyncio
+from collections import OrderedDict
+from datetime import datetime
+
+# số thiết bị khác nhau tối đa đang chờ gửi cho 1 subscriber chậm
+MAX_PENDING = int(os.getenv("HUB__MAX_PENDING", "1000"))
+
+class Subscription:
+    """Hàng đợi của 1 client: mỗi thiết bị chỉ giữ giá trị mới nhất (coalesce).
+
+    Client chậm không làm chậm hub: giá trị cũ bị ghi đè, vượt `max_pending`
+    thiết bị thì bỏ thiết bị cũ nhất.
+    """
+
+    def __init__(self, device_uids: set[str] | None, max_pending: int = MAX_PENDING):
+        self.device_uids = device_uids  # None = mọi thiết bị
+        self.max_pending = max(1, max_pending)
+        self._pending: OrderedDict[str, dict] = OrderedDict()
+        self._ready = asyncio.Event()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def offer(self, device_uid: str, event: dict):
+        if device_uid in self._pending:
+            self.coalesced += 1
+            del self._pending[device_uid]
+        elif len(self._pending) >= self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[device_uid] = event
+        self._ready.set()
+
+    async def next_batch(self, timeout: float | None = None) -> list[dict]:
+        """Chờ có dữ liệu rồi lấy hết; trả [] nếu hết `timeout` (để gửi heartbeat)."""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._ready.clear()
+        batch = list(self._pending.values())
+        self._pending.clear()
+        return batch
+
+class TelemetryHub:
+    """Fan-out telemetry trong process tới các subscriber WebSocket/SSE.
+
+    Nguồn dữ liệu là feed MQTT dùng chung (`app/feed.py`), không mở subscription
+    broker riêng cho từng client. Chi phí mỗi message tỉ lệ với số subscriber của
+    đúng thiết bị đó (+ subscriber nhận tất cả).
+    """
+
+    def __init__(self):
+        self._by_device: dict[str, set[Subscription]] = {}
+        self._all: set[Subscription] = set()
+        self.subscribers = 0
+
+    def subscribe(self, device_uids: set[str] | None = None, max_pending: int = MAX_PENDING) -> Subscription:
+        sub = Subscription(device_uids, max_pending)
+        self.subscribers += 1
+        if device_uids is None:
+            self._all.add(sub)
+        else:
+            for uid in device_uids:
+                self._by_device.setdefault(uid, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        self.subscribers -= 1
+        if sub.device_uids is None:
+            self._all.discard(sub)
+            return
+        for uid in sub.device_uids:
+            subs = self._by_device.get(uid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_device[uid]
+
+    def publish(self, device_uid: str, msg_id: str, payload: dict, ts: datetime):
+        subs = self._by_device.get(device_uid)
+        if not subs and not self._all:
+            return
+        event = {"device_uid": device_uid, "msg_id": msg_id, "payload": payload, "ts": ts.isoformat()}
+        if subs:
+            for sub in subs:
+                sub.offer(device_uid, event)
+        for sub in self._all:
+            sub.offer(device_uid, event)
+
+hub = TelemetryHub()
@@ -0,0 +1,256 @@
+"""Metric dạng Prometheus (text exposition 0.0.4) tự viết – không thêm dependency.
+
+- `Counter`, `Histogram` (bucket cố định), `GaugeFunc` (đọc giá trị lúc scrape).
+- `REGISTRY.render()` → nội dung cho `GET /metrics` (API) hoặc cổng metrics của ingestor.
+- `MetricsMiddleware`: ASGI middleware thuần (không qua BaseHTTPMiddleware) đo latency theo route.
+- `instrument_engine()`: thời gian mỗi câu SQL qua event `before/after_cursor_execute`.
+- `TimedQueuePool`: pool kết nối đo thời gian chờ checkout (`_do_get`).
+
+Mọi thao tác ghi chạy trên event loop (1 thread) nên không dùng lock; chi phí mỗi lần
+ghi là 1 lần tra dict + cộng số (đo bằng `python -m bench.metrics_overhead`).
+"""
+import time, asyncio
+from bisect import bisect_left
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# giây; đủ mịn cho request/SQL nhanh (ms) lẫn flush/commit chậm (s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        out = []
+        for m in self._metrics.values():
+            # format 0.0.4: HELP/TYPE của counter mang tên series (`..._total`)
+            family = m.name + m.suffix if m.kind == "counter" else m.name
+            out.append(f"# HELP {family} {m.help}")
+            out.append(f"# TYPE {family} {m.kind}")
+            out.extend(m.samples())
+        return "\n".join(out) + "\n"
+
+REGISTRY = Registry()
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Counter:
+    kind = "counter"
+    suffix = "_total"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name, self.help, self.label_names = name, help, labels
+        self._children: dict[tuple, _CounterChild] = {}
+        if not labels:
+            self._children[()] = _CounterChild()
+        registry.register(self)
+
+    def labels(self, *values) -> _CounterChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _CounterChild()
+        return child
+
+    def inc(self, amount: float = 1):
+        self._children[()].value += amount
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield f"{self.name}{self.suffix}{_labels(self.label_names, values)} {_num(child.value)}"
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # ô cuối = +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.name, self.help, self.label_names = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self._children: dict[tuple, _HistogramChild] = {}
+        if not labels:
+            self._children[()] = _HistogramChild(self.buckets)
+        registry.register(self)
+
+    def labels(self, *values) -> _HistogramChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="%s"' % _num(bound)
+                yield f"{self.name}_bucket{_labels(self.label_names, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, values)} {_num(child.sum)}"
+            yield f"{self.name}_count{_labels(self.label_names, values)} {cumulative}"
+
+class GaugeFunc:
+    """Gauge đọc lúc scrape: `fn()` trả về số, hoặc dict `{label_values_tuple: số}` nếu có labels."""
+    kind = "gauge"
+    suffix = ""
+
+    def __init__(self, name: str, help: str, fn, labels: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name, self.help, self.label_names, self.fn = name, help, labels, fn
+        registry.register(self)
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        series = self.name + self.suffix
+        if isinstance(value, dict):
+            for values, v in value.items():
+                yield f"{series}{_labels(self.label_names, values)} {_num(v)}"
+        else:
+            yield f"{series} {_num(value)}"
+
+class CounterFunc(GaugeFunc):
+    """Như `GaugeFunc` cho bộ đếm tăng dần đã có sẵn ở nơi khác (ví dụ `publisher.stats()`)."""
+    kind = "counter"
+    suffix = "_total"
+
+# --- HTTP (API) ---
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status"))
+
+class MetricsMiddleware:
+    """Đo thời gian mỗi request HTTP, nhãn là route template (`/telemetry/{device_uid}`) để giới hạn số series."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # không khớp route (404) → gom chung 1 nhãn thay vì path thô
+            path = getattr(route, "path", None) or "<unmatched>"
+            HTTP_LATENCY.labels(scope["method"], path, str(status[0])).observe(time.perf_counter() - start)
+
+# --- SQLAlchemy ---
+
+DB_QUERY = Histogram("db_query_duration_seconds", "SQL statement execution time by verb", ("verb",))
+DB_CHECKOUT = Histogram("db_pool_checkout_seconds", "Time waiting for a pooled DB connection")
+
+def instrument_engine(engine, registry: Registry = REGISTRY):
+    """Gắn event đo thời gian câu SQL (nhãn = động từ đầu câu: SELECT/INSERT/WITH/...).
+
+    Gauge của pool (checked out/size/overflow) được đăng ký vào `registry` – mỗi engine 1 registry.
+    """
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if getattr(sync_engine, "_metrics_instrumented", False):
+        return
+    sync_engine._metrics_instrumented = True
+
+    verbs: dict[str, str] = {}  # câu SQL lặp lại (text()/compiled cache) → khỏi tách chuỗi mỗi lần
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None:
+            return
+        verb = verbs.get(statement)
+        if verb is None:
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+            if len(verbs) < 10000:
+                verbs[statement] = verb
+        DB_QUERY.labels(verb).observe(time.perf_counter() - start)
+
+    pool = sync_engine.pool
+    GaugeFunc("db_pool_checked_out", "DB connections currently checked out", lambda: pool.checkedout(), registry=registry)
+    GaugeFunc("db_pool_size", "Configured DB pool size", lambda: pool.size(), registry=registry)
+    GaugeFunc("db_pool_overflow", "DB connections opened beyond pool_size", lambda: max(0, pool.overflow()), registry=registry)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Pool mặc định của engine async, đo thời gian chờ lấy kết nối (gồm cả lúc phải mở kết nối mới)."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_CHECKOUT.observe(time.perf_counter() - start)
+
+# --- cổng metrics cho process không chạy HTTP server (ingestor) ---
+
+async def serve_metrics(port: int, host: str = "0.0.0.0", registry: Registry = REGISTRY) -> asyncio.AbstractServer:
+    """HTTP tối giản: mọi request GET đều trả `registry.render()`."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
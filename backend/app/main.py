@@ -1,27 +1,68 @@
-from fastapi import FastAPI, Depends, HTTPException, Header
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Response, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from .db import Base, engine, get_db
-from .models import User, Device, Telemetry, CommandQueue
+from sqlalchemy import select, insert, update, delete, tuple_, literal, any_, all_, String
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from .db import Base, engine, get_db, SessionLocal
+from .models import (
+    User, Device, Telemetry, CommandQueue, TelemetryRollup, TelemetryMetric, AlertRule,
+    FirmwareRelease, FirmwareTenantChannel,
+)
 from .schemas import (
     LoginIn, TokenOut, TelemetryOut, CommandIn,
-    DeviceRegisterIn, TelemetryIn, CommandQueueOut, FirmwareCheckOut
+    DeviceRegisterIn, TelemetryIn, CommandQueueOut, FirmwareCheckOut,
+    FanoutIn, FanoutJobOut, CommandAckIn, AlertRuleIn, AlertRuleOut,
+    FirmwareReleaseOut, FirmwarePublishIn, FirmwareChannelIn,
 )
-from .mqtt_pub import publish_command
-from .auth import create_token, require_user
+from .mqtt_pub import publish_command, publisher
+from .auth import create_token, create_device_token, require_user, verify_user_token
+from .device_auth import require_device, authenticate_device, revocations, new_device_secret, HASH_LEGACY_SECRETS_SQL
+from . import fanout, rollups, partitions, export, command_queue, firmware
+from .outbox import dispatcher, DISPATCHER_ENABLED
+from .telemetry_store import insert_telemetry, WRITES
+from .dedup import recent_ids
+from .instrumentation import REGISTRY, MetricsMiddleware, GaugeFunc, CounterFunc, instrument_engine
+from .feed import feed
+from .shadow import shadow
+from .presence import presence, PresenceMonitor
+from .hub import hub, Subscription
+from .notifier import notifier
+import json, asyncio
 from typing import List
+from datetime import datetime, timedelta, timezone
+from .pagination import encode_cursor, decode_cursor
+from .messages import decode_body, parse_telemetry_item, parse_telemetry_batch, BatchTooLarge
+from .codecs import CodecUnavailable
+from pydantic import ValidationError
+import uuid
 
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+import logging
+
+log = logging.getLogger(__name__)
 
 app = FastAPI(title="FastAPI + MQTT + Postgres")
+feed.add_listener(shadow.update)
+feed.add_listener(hub.publish)
+feed.add_listener(presence.on_telemetry)
+feed.add_status_listener(presence.status)
+presence_monitor = PresenceMonitor(presence)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # DEV ONLY: mở CORS để Flutter Web gọi đc
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+# thêm sau cùng → middleware ngoài cùng, đo cả thời gian CORS/exception handler
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+GaugeFunc("live_subscribers", "Open WebSocket/SSE telemetry subscriptions", lambda: hub.subscribers)
+GaugeFunc("device_shadow_devices", "Devices held in the in-memory shadow", lambda: len(shadow))
+CounterFunc("telemetry_feed_received", "Telemetry messages received by the API feed", lambda: feed.received)
 
 @app.on_event("startup")
 async def on_startup():
@@ -32,6 +73,57 @@ async def on_startup():
             await conn.execute(text("ALTER TABLE devices ADD COLUMN IF NOT EXISTS device_secret VARCHAR"))
         except Exception:
             pass
+        await conn.execute(text(HASH_LEGACY_SECRETS_SQL))
+        await conn.execute(text("ALTER TABLE devices ADD COLUMN IF NOT EXISTS firmware_channel VARCHAR"))
+        await conn.execute(text("ALTER TABLE command_queue ADD COLUMN IF NOT EXISTS job_id VARCHAR"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_queue_job_id ON command_queue (job_id)"))
+        await conn.execute(text("ALTER TABLE command_queue ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0"))
+        await conn.execute(text("ALTER TABLE command_queue ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_queue_open ON command_queue (device_uid, id) WHERE status IN ('pending', 'sent')"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_queue_pending ON command_queue (id) WHERE status = 'pending'"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_queue_leased ON command_queue (lease_until) WHERE status = 'leased'"))
+        await conn.execute(text("ALTER TABLE command_queue ADD COLUMN IF NOT EXISTS publish_attempts INTEGER NOT NULL DEFAULT 0"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_command_queue_sending ON command_queue (lease_until) WHERE status = 'sending'"))
+        # không tạo index ở đây: CREATE INDEX thường khoá ghi telemetry suốt lúc build
+        if await partitions.missing_history_index(conn):
+            log.warning("telemetry has no ix_telemetry_device_ts index; run `python -m app.partitions index`")
+        # tạo partition telemetry cho các ngày tới, xoá partition quá retention
+        await partitions.maintain(conn)
+    # kết nối MQTT dùng chung cho mọi lệnh publish
+    await publisher.start()
+    # device shadow: nạp giá trị mới nhất từ DB 1 lần, sau đó cập nhật từ feed MQTT
+    async with SessionLocal() as db:
+        await shadow.warm(db)
+        await presence.warm(db)
+    await feed.start()
+    await presence_monitor.start()
+    # publish firmware / đổi kênh ở worker khác → xoá manifest cache
+    notifier.listen(firmware.CHANNEL, firmware.registry.invalidate)
+    await notifier.start()
+    await revocations.start()
+    await command_queue.sweeper.start()
+    if DISPATCHER_ENABLED:
+        await dispatcher.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await dispatcher.stop()
+    await command_queue.sweeper.stop()
+    await revocations.stop()
+    await notifier.stop()
+    await presence_monitor.stop()
+    await feed.stop()
+    await publisher.stop()
+
+@app.get("/health")
+async def health():
+    """Tình trạng kết nối MQTT publisher (connected, in_flight, queued, ...)."""
+    return {"status": "ok", "mqtt": publisher.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Metric dạng Prometheus (xem `app/instrumentation.py`)."""
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/auth/login", response_model=TokenOut)
 async def login(body: LoginIn, db: AsyncSession = Depends(get_db)):
@@ -45,27 +137,261 @@ async def login(body: LoginIn, db: AsyncSession = Depends(get_db)):
     return TokenOut(access_token=create_token(sub=body.email))
 
 @app.get("/devices", dependencies=[Depends(require_user)])
-async def list_devices(db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(Device))
+async def list_devices(online: bool | None = None, db: AsyncSession = Depends(get_db)):
+    """Danh sách thiết bị kèm `online` / `last_seen` (từ bảng presence trong RAM).
+
+    `online=true|false` lọc theo tập thiết bị online trong RAM, không quét telemetry.
+    """
+    q = select(Device)
+    if online is not None:
+        # mảng 1 tham số thay cho IN (...) → không vượt giới hạn bind params khi nhiều thiết bị online
+        uids = literal(presence.online_uids(), ARRAY(String))
+        q = q.where(Device.device_uid == any_(uids) if online else Device.device_uid != all_(uids))
+    res = await db.execute(q)
     return [
-        {"device_uid": d.device_uid, "name": d.name, "tenant": d.tenant}
+        {"device_uid": d.device_uid, "name": d.name, "tenant": d.tenant,
+         "online": presence.is_online(d.device_uid), "last_seen": presence.last_seen(d.device_uid)}
         for d in res.scalars().all()
     ]
 
+@app.get("/devices/presence", dependencies=[Depends(require_user)])
+async def presence_counts():
+    """Số thiết bị online / offline / đã biết (từ RAM)."""
+    return presence.counts()
+
+@app.get("/devices/latest", dependencies=[Depends(require_user)])
+async def latest_many(uids: str = Query(..., description="Danh sách device_uid, cách nhau bởi dấu phẩy")):
+    """Giá trị mới nhất của nhiều thiết bị, đọc từ device shadow (không truy vấn DB).
+
+    Thiết bị chưa có dữ liệu bị bỏ qua trong kết quả.
+    """
+    return shadow.get_many([u for u in uids.split(",") if u])
+
+@app.get("/devices/{device_uid}/latest", dependencies=[Depends(require_user)])
+async def latest_one(device_uid: str):
+    """Payload/ts/msg_id mới nhất của 1 thiết bị (vd nhiệt độ, trạng thái LED), từ bộ nhớ."""
+    cur = shadow.get(device_uid)
+    if cur is None:
+        raise HTTPException(status_code=404, detail="No telemetry for device")
+    return cur
+
+SSE_HEARTBEAT = 15  # giây; giữ kết nối qua proxy khi không có dữ liệu
+
+def _live_subscribe(uids: str | None) -> Subscription:
+    """Đăng ký vào hub; gửi trước giá trị hiện tại (từ shadow) của các thiết bị được chọn."""
+    device_uids = {u for u in uids.split(",") if u} if uids else None
+    sub = hub.subscribe(device_uids)
+    for cur in shadow.get_many(sorted(device_uids or ())):
+        sub.offer(cur["device_uid"], cur)
+    return sub
+
+async def _until_disconnect(websocket: WebSocket):
+    while True:
+        msg = await websocket.receive()
+        if msg["type"] == "websocket.disconnect":
+            return
+
+@app.websocket("/ws/telemetry")
+async def telemetry_ws(websocket: WebSocket, uids: str | None = None, token: str | None = None):
+    """Đẩy telemetry mới qua WebSocket: `ws://.../ws/telemetry?uids=dev-01,dev-02&token=<JWT>`.
+
+    Bỏ `uids` để nhận mọi thiết bị. Client chậm chỉ nhận giá trị mới nhất mỗi thiết bị.
+    """
+    try:
+        verify_user_token(token or "")
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    await websocket.accept()
+    sub = _live_subscribe(uids)
+    closed = asyncio.create_task(_until_disconnect(websocket))
+    try:
+        while True:
+            getter = asyncio.create_task(sub.next_batch())
+            done, _ = await asyncio.wait({getter, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if closed in done:
+                getter.cancel()
+                break
+            for event in getter.result():
+                await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        closed.cancel()
+        hub.unsubscribe(sub)
+
+@app.get("/stream/telemetry")
+async def telemetry_sse(request: Request, uids: str | None = None, token: str | None = None, authorization: str | None = Header(None)):
+    """Server-Sent Events: mỗi telemetry mới là 1 event `data: {...}`.
+
+    Xác thực bằng header `Authorization: Bearer <JWT>` hoặc `?token=` (EventSource
+    trên trình duyệt không gửi được header).
+    """
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    verify_user_token(token or "")
+    sub = _live_subscribe(uids)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                batch = await sub.next_batch(timeout=SSE_HEARTBEAT)
+                if not batch:
+                    yield ": ping\n\n"
+                for event in batch:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            hub.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/telemetry/{device_uid}", response_model=List[TelemetryOut], dependencies=[Depends(require_user)])
-async def get_telemetry(device_uid: str, db: AsyncSession = Depends(get_db)):
-    res = await db.execute(
-        select(Telemetry)
-        .where(Telemetry.device_uid == device_uid)
-        .order_by(Telemetry.id.desc())
-        .limit(100)
-    )
+async def get_telemetry(
+    device_uid: str,
+    response: Response,
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Lịch sử telemetry mới nhất trước, lọc theo khoảng `from` ≤ ts < `to`.
+
+    Phân trang keyset: nếu còn dữ liệu, header `X-Next-Cursor` chứa cursor để
+    gọi trang tiếp theo (`?cursor=...`). Không dùng OFFSET → mỗi trang là 1 lần
+    quét index `(device_uid, ts, id)`, thời gian không phụ thuộc độ dài lịch sử.
+    """
+    q = select(Telemetry).where(Telemetry.device_uid == device_uid)
+    if from_ is not None:
+        q = q.where(Telemetry.ts >= from_)
+    if to is not None:
+        q = q.where(Telemetry.ts < to)
+    if cursor:
+        try:
+            c_ts, c_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        q = q.where(tuple_(Telemetry.ts, Telemetry.id) < tuple_(c_ts, c_id, types=[Telemetry.ts.type, Telemetry.id.type]))
+    res = await db.execute(q.order_by(Telemetry.ts.desc(), Telemetry.id.desc()).limit(limit))
     rows = res.scalars().all()
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].ts, rows[-1].id)
     return [
         {"device_uid": r.device_uid, "payload": r.payload, "ts": r.ts.isoformat() if r.ts else None}
         for r in rows
     ]
 
+@app.get("/telemetry/{device_uid}/aggregate", dependencies=[Depends(require_user)])
+async def aggregate_telemetry(
+    device_uid: str,
+    metric: str = "data.temp_c",
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
+    resolution: int | None = Query(None, ge=60, description="Độ dài mỗi điểm (giây)"),
+    db: AsyncSession = Depends(get_db),
+):
+    """min/max/avg/count/last của 1 field số theo thời gian, đọc từ `telemetry_rollups`.
+
+    Mặc định: 24h gần nhất, ~300 điểm. Chọn bucket thô nhất (1m/1h/1d) không
+    vượt quá `resolution` rồi gộp tiếp thành điểm dài `resolution` giây.
+    """
+    to = _utc(to) if to else datetime.now(timezone.utc)
+    from_ = _utc(from_) if from_ else to - timedelta(days=1)
+    if from_ >= to:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    if resolution is None:
+        resolution = max(60, int((to - from_).total_seconds() // 300))
+    bucket = rollups.pick_bucket(resolution)
+    res = await db.execute(
+        select(TelemetryRollup)
+        .where(
+            TelemetryRollup.device_uid == device_uid,
+            TelemetryRollup.metric == metric,
+            TelemetryRollup.bucket == bucket,
+            TelemetryRollup.bucket_start >= rollups.bucket_start(from_, rollups.BUCKETS[bucket]),
+            TelemetryRollup.bucket_start < to,
+        )
+        .order_by(TelemetryRollup.bucket_start)
+    )
+    return {
+        "device_uid": device_uid,
+        "metric": metric,
+        "bucket": bucket,
+        "resolution": resolution,
+        "points": rollups.merge_points(res.scalars().all(), resolution),
+    }
+
+@app.get("/series/{metric}", dependencies=[Depends(require_user)])
+async def metric_series(
+    metric: str,
+    uids: str | None = Query(None, description="device_uid cách nhau bởi dấu phẩy (bỏ trống = mọi thiết bị)"),
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
+    limit: int = Query(10000, ge=1, le=100000),
+    db: AsyncSession = Depends(get_db),
+):
+    """Giá trị thô của 1 metric (ví dụ `data.temp_c`) trên nhiều thiết bị, đọc từ `telemetry_metrics`.
+
+    Mặc định 1h gần nhất. Kết quả nhóm theo thiết bị, mỗi điểm `[ts, value]` theo thời gian tăng dần;
+    `truncated` = true nếu chạm `limit` (thu hẹp khoảng thời gian hoặc danh sách thiết bị).
+    """
+    to = _utc(to) if to else datetime.now(timezone.utc)
+    from_ = _utc(from_) if from_ else to - timedelta(hours=1)
+    if from_ >= to:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    q = select(TelemetryMetric.device_uid, TelemetryMetric.ts, TelemetryMetric.value).where(
+        TelemetryMetric.metric == metric,
+        TelemetryMetric.ts >= from_,
+        TelemetryMetric.ts < to,
+    )
+    if uids:
+        q = q.where(TelemetryMetric.device_uid.in_([u.strip() for u in uids.split(",") if u.strip()]))
+    res = await db.execute(q.order_by(TelemetryMetric.device_uid, TelemetryMetric.ts).limit(limit))
+    rows = res.all()
+    series: dict[str, list] = {}
+    for uid, ts, value in rows:
+        series.setdefault(uid, []).append([ts.isoformat(), value])
+    return {
+        "metric": metric,
+        "from": from_.isoformat(),
+        "to": to.isoformat(),
+        "truncated": len(rows) == limit,
+        "series": series,
+    }
+
+@app.get("/export/telemetry", dependencies=[Depends(require_user)])
+async def export_telemetry(
+    uids: str = Query(..., description="device_uid cách nhau bởi dấu phẩy"),
+    from_: datetime = Query(..., alias="from"),
+    to: datetime | None = None,
+    format: str = Query("csv", description="csv | ndjson | parquet (parquet cần pyarrow)"),
+    accept_encoding: str | None = Header(None),
+):
+    """Xuất telemetry của nhiều thiết bị trong khoảng `from` ≤ ts < `to`, stream từ Postgres COPY.
+
+    Bộ nhớ server không phụ thuộc kích thước export (xem `app/export.py`); thứ tự: theo
+    thiết bị như trong `uids`, rồi theo thời gian. `Accept-Encoding: gzip` → nén gzip
+    (CSV/NDJSON). Lỗi giữa chừng chỉ cắt ngắn response (header đã gửi).
+    """
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(export.FORMATS)}")
+    if not export.available(format):
+        raise HTTPException(status_code=400, detail=f"{format} export needs pyarrow installed on the server")
+    device_uids = list(dict.fromkeys(u.strip() for u in uids.split(",") if u.strip()))
+    if not device_uids:
+        raise HTTPException(status_code=400, detail="uids is empty")
+    from_ = _utc(from_)
+    to = _utc(to) if to else datetime.now(timezone.utc)
+    if from_ >= to:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    media_type, ext = export.FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="telemetry-{from_:%Y%m%dT%H%M%S}.{ext}"', "Vary": "Accept-Encoding"}
+    body = export.stream_telemetry(format, device_uids, from_, to)
+    if format != "parquet" and "gzip" in (accept_encoding or "").lower():
+        body = export.gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
 @app.post("/devices/{device_uid}/command", dependencies=[Depends(require_user)])
 async def send_command(device_uid: str, body: CommandIn):
         """Gửi lệnh xuống thiết bị qua MQTT.
@@ -85,108 +411,446 @@ async def send_command(device_uid: str, body: CommandIn):
 # --- ESP32 oriented HTTP endpoints (demo) ---
 
 @app.post("/devices/register", response_model=TokenOut)
-async def register_device(body: DeviceRegisterIn, db: AsyncSession = Depends(get_db)):
-    """Đăng ký thiết bị và trả về một token (dùng tạm làm secret).
+async def register_device(
+    body: DeviceRegisterIn,
+    db: AsyncSession = Depends(get_db),
+    secret: str | None = Header(None, alias="X-Device-Secret"),
+    authorization: str | None = Header(None),
+):
+    """Đăng ký thiết bị và trả về token thiết bị (JWT scope=device, `sub` = device_uid).
 
-    Thiết bị sẽ gửi token này sau đó ở header `X-Device-Secret`.
-    Prod: nên tạo bảng riêng hoặc ký JWT với scope device.
+    Thiết bị gửi token ở `Authorization: Bearer <token>` (hoặc `X-Device-Secret`);
+    server chỉ verify chữ ký, không truy vấn DB. Thiết bị mới nhận thêm `device_secret`
+    ngẫu nhiên (chỉ trả 1 lần, DB lưu hash) để dùng ở `X-Device-Secret`.
+
+    Thiết bị đã tồn tại: cấp lại token cần token user hoặc token thiết bị còn hiệu lực
+    (chưa bị thu hồi); secret không đủ để cấp lại token.
     """
     res = await db.execute(select(Device).where(Device.device_uid == body.device_uid))
     d = res.scalar_one_or_none()
-    if not d:
-        # tạo secret đơn giản: reversed uid; có thể thay bằng uuid4
-        secret = body.device_uid[::-1]
-        d = Device(device_uid=body.device_uid, name=body.name or body.device_uid, device_secret=secret)
-        db.add(d)
+    if d:
+        await _authorize_reissue(db, body.device_uid, secret, authorization)
+        return TokenOut(access_token=create_device_token(d.device_uid))
+    secret, stored = new_device_secret()
+    db.add(Device(device_uid=body.device_uid, name=body.name or body.device_uid, device_secret=stored))
+    try:
         await db.commit()
-    else:
-        secret = d.device_secret or d.device_uid[::-1]
-        if not d.device_secret:
-            d.device_secret = secret
-            await db.commit()
-    # dùng secret làm sub trong token để đơn giản
-    return TokenOut(access_token=create_token(sub=secret))
-
-async def _device_from_secret(db: AsyncSession, secret: str) -> Device | None:
-    if not secret:
-        return None
-    res = await db.execute(select(Device).where(Device.device_secret == secret))
-    return res.scalar_one_or_none()
-
-def _device_secret_header(secret: str | None):
-    if not secret:
-        raise HTTPException(status_code=401, detail="Missing X-Device-Secret")
-    return secret
-
-@app.post("/devices/{device_uid}/telemetry", response_model=dict)
-async def ingest_telemetry_http(device_uid: str, body: TelemetryIn, db: AsyncSession = Depends(get_db), secret: str = Header(None, alias="X-Device-Secret")):
+    except IntegrityError:
+        # đăng ký song song cùng uid: chỉ request tạo được dòng mới nhận secret
+        raise HTTPException(status_code=409, detail="Device already registered")
+    return TokenOut(access_token=create_device_token(body.device_uid), device_secret=secret)
+
+async def _authorize_reissue(db: AsyncSession, device_uid: str, secret: str | None, authorization: str | None):
+    """Cấp lại token cho thiết bị đã có: token user, hoặc token thiết bị còn hiệu lực (chữ ký,
+    đúng thiết bị, chưa bị thu hồi). Secret không được chấp nhận ở đây."""
+    bearer = authorization[7:] if authorization and authorization.lower().startswith("bearer ") else None
+    credential = bearer or secret
+    if not credential:
+        raise HTTPException(status_code=401, detail="Device already registered; credentials required")
+    try:
+        verify_user_token(credential)
+        return
+    except HTTPException:
+        pass  # không phải token user → phải là token của chính thiết bị
+    if credential.count(".") != 2:
+        raise HTTPException(status_code=403, detail="Re-issue requires a user token or a valid device token")
+    await authenticate_device(db, device_uid, credential)
+
+@app.post("/devices/{device_uid}/tokens/revoke", dependencies=[Depends(require_user)])
+async def revoke_device_tokens(device_uid: str, db: AsyncSession = Depends(get_db)):
+    """Thu hồi mọi token đã cấp cho thiết bị và xoá secret; cấp lại token mới qua
+    `/devices/register` với token user."""
+    await db.execute(update(Device).where(Device.device_uid == device_uid).values(device_secret=None))
+    before = await revocations.revoke(db, device_uid)
+    return {"device_uid": device_uid, "revoked_before": before.isoformat()}
+
+@app.post("/devices/{device_uid}/telemetry", response_model=dict, dependencies=[Depends(require_device)])
+async def ingest_telemetry_http(
+    device_uid: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    content_encoding: str | None = Header(None),
+):
     """Thiết bị gửi telemetry qua HTTP (fallback khi không dùng MQTT).
 
-    Header yêu cầu: `X-Device-Secret: <secret>` (hiện tại token đơn giản).
+    Header yêu cầu: `Authorization: Bearer <token thiết bị>` hoặc `X-Device-Secret`.
+    Body: 1 `TelemetryIn` dạng JSON, hoặc CBOR (`application/cbor`) / MessagePack
+    (`application/msgpack`) như endpoint batch; có thể nén `Content-Encoding: gzip`.
+    Codec chưa cài → 415. `ts` ngoài khoảng partition lưu được (quá cũ / quá xa trong tương lai) → 422.
     """
-    secret = _device_secret_header(secret)
-    # resolve secret to device
-    device = await _device_from_secret(db, secret)
-    if not device or device.device_uid != device_uid:
-        raise HTTPException(status_code=403, detail="Invalid device secret")
-    msg_id = body.msg_id or "http-" + device_uid
-    row = Telemetry(device_uid=device_uid, msg_id=msg_id, payload=body.payload)
-    db.add(row)
     try:
-        await db.commit()
-    except Exception:
-        await db.rollback()  # duplicate
+        data = decode_body(await request.body(), content_encoding)
+        body = TelemetryIn.model_validate(parse_telemetry_item(data, request.headers.get("content-type")))
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except CodecUnavailable as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    msg_id = body.msg_id or "http-" + device_uid
+    if recent_ids.seen(device_uid, msg_id):
+        WRITES.labels("duplicate").inc()
         return {"status": "duplicate", "msg_id": msg_id}
+    ts = _utc(body.ts) if body.ts else datetime.now(timezone.utc)
+    if not (await partitions.coverage.check([ts]))[0]:
+        raise HTTPException(status_code=422, detail="ts is outside the stored telemetry range")
+    inserted = await insert_telemetry(db, [{"device_uid": device_uid, "msg_id": msg_id, "payload": body.payload, "ts": ts}])
+    await db.commit()
+    recent_ids.record(device_uid, msg_id)
+    if not inserted:
+        WRITES.labels("duplicate").inc()
+        return {"status": "duplicate", "msg_id": msg_id}
+    WRITES.labels("persisted").inc()
+    feed.publish_local(device_uid, msg_id, body.payload, ts)
     return {"status": "ok", "msg_id": msg_id}
 
-@app.post("/devices/{device_uid}/command/store", response_model=CommandQueueOut, dependencies=[Depends(require_user)])
+def _utc(ts: datetime) -> datetime:
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+@app.post("/devices/{device_uid}/telemetry/batch", response_model=dict, dependencies=[Depends(require_device)])
+async def ingest_telemetry_batch(
+    device_uid: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    content_encoding: str | None = Header(None),
+):
+    """Gửi bù nhiều telemetry trong 1 request (thiết bị buffer khi offline).
+
+    Body: JSON array các `TelemetryIn` (`Content-Type: application/json`) hoặc NDJSON
+    (`application/x-ndjson`, mỗi dòng 1 object), hoặc 1 mảng CBOR (`application/cbor`) /
+    MessagePack (`application/msgpack`); có thể nén `Content-Encoding: gzip`.
+    Xác thực 1 lần, ghi 1 câu lệnh (trùng `(device_uid, msg_id)` bị bỏ qua).
+    Trả về kết quả từng message theo thứ tự gửi: `accepted` | `duplicate` | `invalid`
+    (`invalid` gồm cả message có `ts` ngoài khoảng partition lưu được).
+    """
+    try:
+        data = decode_body(await request.body(), content_encoding)
+        items = parse_telemetry_batch(data, request.headers.get("content-type"))
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except CodecUnavailable as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    now = datetime.now(timezone.utc)
+    results, rows = [], []
+    for item in items:
+        try:
+            msg = TelemetryIn.model_validate(item)
+        except ValidationError as e:
+            results.append({"msg_id": item.get("msg_id") if isinstance(item, dict) else None,
+                            "status": "invalid", "error": e.errors(include_url=False)[0]["msg"]})
+            continue
+        # thiếu msg_id → sinh mới (không dùng "http-<uid>" như endpoint đơn, sẽ trùng nhau cả batch)
+        msg_id = msg.msg_id or uuid.uuid4().hex
+        if recent_ids.seen(device_uid, msg_id):
+            results.append({"msg_id": msg_id, "status": "duplicate"})
+            continue
+        rows.append({"device_uid": device_uid, "msg_id": msg_id, "payload": msg.payload, "ts": _utc(msg.ts) if msg.ts else now})
+        results.append({"msg_id": msg_id, "status": None})
+    # ts gửi bù ngoài mọi partition → invalid (1 dòng như vậy làm lỗi cả câu INSERT)
+    if rows:
+        covered = await partitions.coverage.check([r["ts"] for r in rows])
+        pending = [r for r in results if r["status"] is None]
+        for r, ok in zip(pending, covered):
+            if not ok:
+                r["status"], r["error"] = "invalid", "ts is outside the stored telemetry range"
+        rows = [row for row, ok in zip(rows, covered) if ok]
+    inserted = await insert_telemetry(db, rows) if rows else set()
+    await db.commit()
+    recent_ids.record_many((device_uid, r["msg_id"]) for r in rows)
+
+    accepted = 0
+    it = iter(rows)
+    for r in results:
+        if r["status"] is not None:
+            continue
+        row = next(it)
+        key = (device_uid, row["msg_id"])
+        if key in inserted:
+            inserted.discard(key)  # trùng trong cùng batch: bản đầu accepted, bản sau duplicate
+            r["status"] = "accepted"
+            accepted += 1
+            feed.publish_local(device_uid, row["msg_id"], row["payload"], row["ts"])
+        else:
+            r["status"] = "duplicate"
+    invalid = sum(1 for r in results if r["status"] == "invalid")
+    WRITES.labels("persisted").inc(accepted)
+    WRITES.labels("duplicate").inc(len(results) - accepted - invalid)
+    return {
+        "accepted": accepted,
+        "duplicate": len(results) - accepted - invalid,
+        "invalid": invalid,
+        "results": results,
+    }
+
+@app.post("/devices/{device_uid}/command/store", status_code=202, response_model=CommandQueueOut, dependencies=[Depends(require_user)])
 async def queue_command(device_uid: str, body: CommandIn, db: AsyncSession = Depends(get_db)):
-    """Lưu command vào hàng đợi (ngoài việc publish)."""
-    cq = CommandQueue(device_uid=device_uid, cmd=body.cmd, params=body.params, status="pending")
-    db.add(cq)
+    """Lưu command vào hàng đợi (outbox) và trả về ngay ở trạng thái `pending`.
+
+    Dispatcher nền (`app/outbox.py`) publish MQTT rồi chuyển sang `sent`; broker lỗi
+    không làm request lỗi, command được publish khi kết nối lại.
+    """
+    res = await db.execute(
+        insert(CommandQueue)
+        .values(device_uid=device_uid, cmd=body.cmd, params=body.params, status="pending")
+        .returning(CommandQueue.id, CommandQueue.created_at)
+    )
+    row = res.one()
     await db.commit()
-    await publish_command(device_uid, {"cmd": body.cmd, "params": body.params})
-    cq.status = "sent"
+    dispatcher.wake()
+    return CommandQueueOut(id=row.id, cmd=body.cmd, params=body.params, status="pending", created_at=row.created_at.isoformat() if row.created_at else None)
+
+@app.post("/commands/fanout", status_code=202, response_model=FanoutJobOut, dependencies=[Depends(require_user)])
+async def fanout_command(body: FanoutIn, db: AsyncSession = Depends(get_db)):
+    """Gửi 1 lệnh tới nhiều thiết bị (danh sách uid, tenant hoặc prefix uid).
+
+    Tạo toàn bộ command bằng 1 câu INSERT rồi trả `job_id` ngay; việc publish
+    MQTT chạy nền theo lô. Xem tiến độ ở `GET /commands/jobs/{job_id}`.
+    """
+    if body.device_uids is None and body.tenant is None and not body.uid_prefix:
+        raise HTTPException(status_code=400, detail="Need device_uids, tenant or uid_prefix")
+    targets = fanout.target_devices(body.device_uids, body.tenant, body.uid_prefix)
+    job_id, total = await fanout.create_job(db, body.cmd, body.params, targets)
+    if total:
+        dispatcher.wake()
+    return FanoutJobOut(job_id=job_id, total=total, counts={"pending": total} if total else {})
+
+@app.get("/commands/jobs/{job_id}", response_model=FanoutJobOut, dependencies=[Depends(require_user)])
+async def fanout_job_status(job_id: str, details: bool = False, after_id: int = 0, limit: int = Query(1000, ge=1, le=10000), db: AsyncSession = Depends(get_db)):
+    """Tiến độ job: số command theo status; `details=true` trả thêm trạng thái từng thiết bị (phân trang theo `after_id`)."""
+    counts = await fanout.job_progress(db, job_id)
+    if not counts:
+        raise HTTPException(status_code=404, detail="Job not found")
+    devices = None
+    if details:
+        res = await db.execute(
+            select(CommandQueue.id, CommandQueue.device_uid, CommandQueue.status)
+            .where(CommandQueue.job_id == job_id, CommandQueue.id > after_id)
+            .order_by(CommandQueue.id)
+            .limit(limit)
+        )
+        devices = [{"id": r.id, "device_uid": r.device_uid, "status": r.status} for r in res.all()]
+    return FanoutJobOut(job_id=job_id, total=sum(counts.values()), counts=counts, devices=devices)
+
+def _rule_out(r: AlertRule) -> AlertRuleOut:
+    return AlertRuleOut(**{c: getattr(r, c) for c in AlertRuleOut.model_fields})
+
+@app.get("/rules", response_model=List[AlertRuleOut], dependencies=[Depends(require_user)])
+async def list_rules(device_uid: str | None = None, db: AsyncSession = Depends(get_db)):
+    """Luật cảnh báo (lọc theo thiết bị nếu có `device_uid`). Ingestor đánh giá luật trên telemetry MQTT."""
+    q = select(AlertRule).order_by(AlertRule.id)
+    if device_uid is not None:
+        q = q.where(AlertRule.device_uid == device_uid)
+    res = await db.execute(q)
+    return [_rule_out(r) for r in res.scalars().all()]
+
+@app.post("/rules", status_code=201, response_model=AlertRuleOut, dependencies=[Depends(require_user)])
+async def create_rule(body: AlertRuleIn, db: AsyncSession = Depends(get_db)):
+    """Tạo luật; ingestor nạp lại sau tối đa `RULES__REFRESH_SECONDS`. Hành động được xếp vào
+    `command_queue` với `job_id` = `rule:<id>` (xem tiến độ ở `/commands/jobs/rule:<id>`)."""
+    rule = AlertRule(**body.model_dump())
+    db.add(rule)
+    await db.commit()
+    await db.refresh(rule)
+    return _rule_out(rule)
+
+async def _get_rule(db: AsyncSession, rule_id: int) -> AlertRule:
+    rule = await db.get(AlertRule, rule_id)
+    if rule is None:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    return rule
+
+@app.get("/rules/{rule_id}", response_model=AlertRuleOut, dependencies=[Depends(require_user)])
+async def get_rule(rule_id: int, db: AsyncSession = Depends(get_db)):
+    return _rule_out(await _get_rule(db, rule_id))
+
+@app.put("/rules/{rule_id}", response_model=AlertRuleOut, dependencies=[Depends(require_user)])
+async def update_rule(rule_id: int, body: AlertRuleIn, db: AsyncSession = Depends(get_db)):
+    rule = await _get_rule(db, rule_id)
+    for k, v in body.model_dump().items():
+        setattr(rule, k, v)
+    await db.commit()
+    await db.refresh(rule)
+    return _rule_out(rule)
+
+@app.delete("/rules/{rule_id}", status_code=204, dependencies=[Depends(require_user)])
+async def delete_rule(rule_id: int, db: AsyncSession = Depends(get_db)):
+    await db.delete(await _get_rule(db, rule_id))
     await db.commit()
-    return CommandQueueOut(id=cq.id, cmd=cq.cmd, params=cq.params, status=cq.status, created_at=cq.created_at.isoformat() if cq.created_at else None)
+    return Response(status_code=204)
 
-@app.get("/devices/{device_uid}/commands/poll", response_model=list)
-async def poll_commands(device_uid: str, db: AsyncSession = Depends(get_db), secret: str = Header(None, alias="X-Device-Secret")):
-    """Thiết bị HTTP polling lấy command chưa ack.
+@app.get("/devices/{device_uid}/commands/poll", response_model=list, dependencies=[Depends(require_device)])
+async def poll_commands(
+    device_uid: str,
+    wait: int = Query(0, ge=0, le=60, description="Long-poll: giữ request tối đa N giây đến khi có command"),
+    max_items: int = Query(command_queue.POLL_MAX, ge=1, le=100, alias="max", description="Số command tối đa mỗi lần poll"),
+    lease: int = Query(command_queue.LEASE_SECONDS, ge=1, le=3600, description="Thời gian lease (giây) trước khi command được giao lại"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Thiết bị HTTP polling nhận (lease) command chưa ack, cũ nhất trước.
 
-    Header: X-Device-Secret
+    Header: `Authorization: Bearer <token thiết bị>` hoặc X-Device-Secret
+    Command trả về ở trạng thái `leased` tới `lease_until`; không ack kịp → được giao lại
+    (tối đa `COMMANDS__MAX_ATTEMPTS` lần, sau đó `dead`). Poll song song không nhận trùng.
+    `?wait=30`: nếu chưa có command, giữ request đến khi có command mới cho thiết
+    bị (được đánh thức qua Postgres NOTIFY) hoặc hết thời gian → trả `[]`.
     """
-    secret = _device_secret_header(secret)
-    device = await _device_from_secret(db, secret)
-    if not device or device.device_uid != device_uid:
-        raise HTTPException(status_code=403, detail="Invalid device secret")
-    res = await db.execute(select(CommandQueue).where(CommandQueue.device_uid == device_uid, CommandQueue.status == "sent"))
-    rows = res.scalars().all()
-    return [
-        {"id": r.id, "cmd": r.cmd, "params": r.params, "status": r.status, "created_at": r.created_at.isoformat() if r.created_at else None}
-        for r in rows
-    ]
+    # đăng ký chờ trước khi truy vấn để không lỡ NOTIFY đến giữa 2 bước
+    waiter = notifier.subscribe(device_uid) if wait else None
+    try:
+        rows = await command_queue.claim(db, device_uid, max_items, lease)
+        if not rows and waiter is not None:
+            # trả connection về pool trong lúc chờ
+            await db.close()
+            if await notifier.wait(waiter, wait):
+                rows = await command_queue.claim(db, device_uid, max_items, lease)
+    finally:
+        if waiter is not None:
+            notifier.unsubscribe(device_uid, waiter)
+    return rows
+
+@app.post("/devices/{device_uid}/commands/ack", response_model=dict, dependencies=[Depends(require_device)])
+async def ack_commands(device_uid: str, body: CommandAckIn, db: AsyncSession = Depends(get_db)):
+    """Ack nhiều command trong 1 request/1 commit. `unknown`: id không thuộc thiết bị này."""
+    acked = await command_queue.ack(db, device_uid, body.ids)
+    done = set(acked)
+    return {"acked": acked, "unknown": [i for i in dict.fromkeys(body.ids) if i not in done]}
 
-@app.post("/devices/{device_uid}/commands/{command_id}/ack", response_model=dict)
-async def ack_command(device_uid: str, command_id: int, db: AsyncSession = Depends(get_db), secret: str = Header(None, alias="X-Device-Secret")):
-    secret = _device_secret_header(secret)
-    device = await _device_from_secret(db, secret)
-    if not device or device.device_uid != device_uid:
-        raise HTTPException(status_code=403, detail="Invalid device secret")
-    res = await db.execute(select(CommandQueue).where(CommandQueue.id == command_id, CommandQueue.device_uid == device_uid))
-    cq = res.scalar_one_or_none()
-    if not cq:
+@app.post("/devices/{device_uid}/commands/{command_id}/ack", response_model=dict, dependencies=[Depends(require_device)])
+async def ack_command(device_uid: str, command_id: int, db: AsyncSession = Depends(get_db)):
+    if not await command_queue.ack(db, device_uid, [command_id]):
         raise HTTPException(status_code=404, detail="Command not found")
-    cq.status = "acked"
-    await db.commit()
-    return {"status": "acked", "id": cq.id}
+    return {"status": "acked", "id": command_id}
 
-@app.get("/devices/{device_uid}/firmware/check", response_model=FirmwareCheckOut)
+@app.get("/devices/{device_uid}/firmware/check", response_model=FirmwareCheckOut, dependencies=[Depends(require_device)])
 async def firmware_check(device_uid: str, version: str, db: AsyncSession = Depends(get_db)):
-    """Demo endpoint: luôn trả về latest giả lập nếu version khác.
-    Prod: truy vấn bảng firmware.
+    """Thiết bị hỏi có firmware mới không (theo kênh, tenant, rollout; xem `app/firmware.py`).
+
+    Trả lời từ manifest trong RAM – không truy vấn DB khi cache còn hiệu lực. `url` tải
+    bằng cùng header xác thực, hỗ trợ `Range` để tải tiếp.
+    """
+    target, update = await firmware.registry.check(db, device_uid, version)
+    if target is None:
+        return FirmwareCheckOut(update_available=False, current_version=version, latest_version=version)
+    return FirmwareCheckOut(
+        update_available=update, current_version=version, latest_version=target.version,
+        url=f"/devices/{device_uid}/firmware/download/{target.version}" if update else None,
+        sha256=target.sha256, size=target.size,
+    )
+
+@app.get("/devices/{device_uid}/firmware/download/{version}", dependencies=[Depends(require_device)])
+async def firmware_download(
+    device_uid: str,
+    version: str,
+    db: AsyncSession = Depends(get_db),
+    range_: str | None = Header(None, alias="Range"),
+    if_range: str | None = Header(None),
+    if_none_match: str | None = Header(None),
+):
+    """Tải binary: `ETag` = sha256, `If-None-Match` → 304, `Range: bytes=a-b` → 206 (1 khoảng)."""
+    release = await firmware.registry.downloadable(db, device_uid, version)
+    if release is None:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    await db.close()  # trả connection về pool trước khi gửi file
+    etag = f'"{release.sha256}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=31536000, immutable"}
+    if if_none_match and (if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))):
+        firmware.DOWNLOADS.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    if if_range and if_range.strip() != etag:
+        range_ = None  # file đã đổi so với phần client đang có → gửi lại từ đầu
+    try:
+        span = firmware.parse_range(range_, release.size)
+    except firmware.RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{release.size}"})
+    start, end = span or (0, release.size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if span is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{release.size}"
+    firmware.DOWNLOADS.labels("partial" if span else "full").inc()
+    return StreamingResponse(
+        firmware.iter_bytes(release, start, end), status_code=206 if span else 200,
+        media_type="application/octet-stream", headers=headers,
+    )
+
+def _release_out(r: FirmwareRelease) -> FirmwareReleaseOut:
+    return FirmwareReleaseOut(**{c: getattr(r, c) for c in FirmwareReleaseOut.model_fields})
+
+@app.post("/firmware", status_code=201, response_model=FirmwareReleaseOut, dependencies=[Depends(require_user)])
+async def upload_firmware(
+    request: Request,
+    version: str,
+    channel: str = firmware.DEFAULT_CHANNEL,
+    tenant: str | None = None,
+    notes: str | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Upload binary (body thô `application/octet-stream`, tối đa `FIRMWARE__MAX_MB`).
+
+    Release mới chưa phát hành; gọi `POST /firmware/{version}/publish` để bắt đầu rollout.
     """
-    latest = "1.0.0"
-    if version != latest:
-        return FirmwareCheckOut(update_available=True, current_version=version, latest_version=latest, url=f"https://example.com/fw/{device_uid}/{latest}.bin")
-    return FirmwareCheckOut(update_available=False, current_version=version, latest_version=latest, url=None)
+    if await db.scalar(select(FirmwareRelease.id).where(FirmwareRelease.version == version)) is not None:
+        raise HTTPException(status_code=409, detail="Version already exists")
+    try:
+        sha256, size = await firmware.store_binary(request.stream())
+    except firmware.FirmwareTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not size:
+        raise HTTPException(status_code=400, detail="Empty firmware body")
+    release = FirmwareRelease(version=version, channel=channel, tenant=tenant, sha256=sha256, size=size, rollout_percent=0, notes=notes)
+    db.add(release)
+    await db.commit()
+    return _release_out(release)
+
+@app.get("/firmware", response_model=List[FirmwareReleaseOut], dependencies=[Depends(require_user)])
+async def list_firmware(channel: str | None = None, db: AsyncSession = Depends(get_db)):
+    q = select(FirmwareRelease).order_by(FirmwareRelease.id.desc())
+    if channel is not None:
+        q = q.where(FirmwareRelease.channel == channel)
+    res = await db.execute(q)
+    return [_release_out(r) for r in res.scalars().all()]
+
+@app.post("/firmware/{version}/publish", response_model=FirmwareReleaseOut, dependencies=[Depends(require_user)])
+async def publish_firmware(version: str, body: FirmwarePublishIn, db: AsyncSession = Depends(get_db)):
+    """Phát hành hoặc đổi `rollout_percent` (tăng dần 5 → 25 → 100). Mọi API worker xoá manifest cache."""
+    res = await db.execute(select(FirmwareRelease).where(FirmwareRelease.version == version))
+    release = res.scalar_one_or_none()
+    if release is None:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    release.rollout_percent = body.rollout_percent
+    if release.published_at is None:
+        release.published_at = datetime.now(timezone.utc)
+    await firmware.announce_change(db, "releases")
+    await db.commit()
+    firmware.registry.invalidate("releases")
+    return _release_out(release)
+
+@app.put("/devices/{device_uid}/firmware/channel", dependencies=[Depends(require_user)])
+async def set_device_firmware_channel(device_uid: str, body: FirmwareChannelIn, db: AsyncSession = Depends(get_db)):
+    """Kênh riêng của thiết bị (`null` = theo kênh tenant)."""
+    res = await db.execute(update(Device).where(Device.device_uid == device_uid).values(firmware_channel=body.channel))
+    if not res.rowcount:
+        raise HTTPException(status_code=404, detail="Device not found")
+    await firmware.announce_change(db, f"device:{device_uid}")
+    await db.commit()
+    firmware.registry.invalidate(f"device:{device_uid}")
+    return {"device_uid": device_uid, "channel": body.channel}
+
+@app.put("/tenants/{tenant}/firmware/channel", dependencies=[Depends(require_user)])
+async def set_tenant_firmware_channel(tenant: str, body: FirmwareChannelIn, db: AsyncSession = Depends(get_db)):
+    """Kênh mặc định cho thiết bị của tenant (`null` = `stable`)."""
+    if body.channel is None:
+        await db.execute(delete(FirmwareTenantChannel).where(FirmwareTenantChannel.tenant == tenant))
+    else:
+        await db.execute(
+            pg_insert(FirmwareTenantChannel).values(tenant=tenant, channel=body.channel)
+            .on_conflict_do_update(index_elements=["tenant"], set_={"channel": body.channel})
+        )
+    await firmware.announce_change(db, "releases")
+    await db.commit()
+    firmware.registry.invalidate("releases")
+    return {"tenant": tenant, "channel": body.channel}
@@ -0,0 +1,112 @@
+import os, json, uuid, zlib, logging
+from .codecs import select_codec, codec_name_for, get_codec, CodecUnavailable
+
+log = logging.getLogger(__name__)
+
+# giới hạn cho POST /devices/{uid}/telemetry[/batch] (sau khi giải nén)
+BATCH_MAX_BYTES = int(os.getenv("TELEMETRY__BATCH_MAX_BYTES", str(10 * 1024 * 1024)))
+BATCH_MAX_ITEMS = int(os.getenv("TELEMETRY__BATCH_MAX_ITEMS", "5000"))
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/json-seq")
+
+class BatchTooLarge(ValueError):
+    pass
+
+def decode_telemetry(topic: str, payload: bytes, content_type: str | None = None):
+    """Tách `device_uid` từ topic `t0/devices/{uid}/telemetry[/<codec>]` và decode payload.
+
+    Codec chọn theo `content_type` (MQTT v5), hậu tố topic (`cbor`, `msgpack`), mặc định JSON
+    (xem `app/codecs.py`). Trả về `(device_uid, msg_id, body)` hoặc None nếu topic sai / codec
+    chưa cài / payload nhị phân hỏng. Payload không phải JSON được giữ dạng `{"raw": ...}`;
+    thiếu `msg_id` thì sinh UUID.
+    """
+    parts = topic.split("/")  # t0 devices {uid} telemetry [codec]
+    # defensive check
+    if len(parts) < 4:
+        return None
+    device_uid = parts[2]
+    try:
+        codec = select_codec(content_type, parts[4] if len(parts) > 4 else None)
+    except CodecUnavailable as e:
+        log.warning("dropping telemetry from %s: %s", device_uid, e)
+        return None
+    try:
+        body = codec.decode(payload)
+    except Exception:
+        if codec.name != "json":
+            log.warning("dropping undecodable %s telemetry from %s", codec.name, device_uid)
+            return None
+        body = {"raw": payload.decode(errors="ignore")}
+    if not isinstance(body, dict):
+        body = {"value": body}
+    msg_id = body.get("msg_id") or str(uuid.uuid4())
+    return device_uid, str(msg_id), body
+
+def telemetry_topics(topic: str) -> list[str]:
+    """Topic JSON gốc + biến thể có hậu tố codec (`.../telemetry/cbor`, `.../telemetry/msgpack`)."""
+    return [topic, topic + "/+"]
+
+def content_type_of(message) -> str | None:
+    """`content-type` của message MQTT v5 (None với v3.1.1)."""
+    props = getattr(message, "properties", None)
+    return getattr(props, "ContentType", None) if props is not None else None
+
+def decode_body(body: bytes, content_encoding: str | None, max_bytes: int = BATCH_MAX_BYTES) -> bytes:
+    """Giải nén body theo `Content-Encoding` (gzip/deflate), dừng khi vượt `max_bytes`."""
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding in ("", "identity"):
+        data = body
+    elif encoding in ("gzip", "x-gzip", "deflate"):
+        # wbits 47: tự nhận gzip hoặc zlib; max_length chặn "zip bomb"
+        d = zlib.decompressobj(47)
+        try:
+            data = d.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise ValueError(f"invalid {encoding} body: {e}") from None
+    else:
+        raise ValueError(f"unsupported Content-Encoding: {encoding}")
+    if len(data) > max_bytes:
+        raise BatchTooLarge(f"body larger than {max_bytes} bytes")
+    return data
+
+def parse_telemetry_item(data: bytes, content_type: str | None) -> dict:
+    """1 telemetry object mã hoá theo `content_type` (JSON mặc định, `application/cbor`,
+    `application/msgpack`); `CodecUnavailable` nếu codec chưa cài, ValueError nếu body hỏng."""
+    codec = select_codec(content_type)
+    try:
+        item = codec.decode(data)
+    except ValueError as e:
+        raise ValueError(f"invalid {codec.name} body: {e}") from None
+    except Exception as e:  # lỗi decode của cbor2/msgpack không kế thừa ValueError
+        raise ValueError(f"invalid {codec.name} body: {e}") from None
+    if not isinstance(item, dict):
+        raise ValueError("expected a telemetry object")
+    return item
+
+def parse_telemetry_batch(data: bytes, content_type: str | None, max_items: int = BATCH_MAX_ITEMS) -> list:
+    """Tách batch telemetry: JSON array (hoặc 1 object) hay NDJSON (mỗi dòng 1 object);
+    `application/cbor` / `application/msgpack`: 1 mảng (hoặc 1 map) mã hoá nhị phân.
+
+    Trả về list item thô (chưa validate) để endpoint báo lỗi từng message.
+    """
+    mime = (content_type or "application/json").split(";")[0].strip().lower()
+    name = codec_name_for(mime)
+    try:
+        if mime in NDJSON_TYPES:
+            items = [json.loads(line) for line in data.splitlines() if line.strip()]
+        elif name not in (None, "json"):
+            items = get_codec(name).decode(data)
+        else:
+            items = json.loads(data)
+    except CodecUnavailable:
+        raise
+    except ValueError as e:
+        raise ValueError(f"invalid {name or 'JSON'} body: {e}") from None
+    except Exception as e:  # lỗi decode của cbor2/msgpack không kế thừa ValueError
+        raise ValueError(f"invalid {name} body: {e}") from None
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise ValueError("expected an array of telemetry objects")
+    if len(items) > max_items:
+        raise BatchTooLarge(f"more than {max_items} messages")
+    return items
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, String, Text, JSON, UniqueConstraint, ForeignKey, DateTime
+from sqlalchemy import Column, BigInteger, Integer, Boolean, String, Text, JSON, UniqueConstraint, ForeignKey, DateTime, Index, Float, Sequence, text
 from sqlalchemy.sql import func
 from .db import Base
 
@@ -16,17 +16,55 @@ class Device(Base):
     device_uid = Column(String, unique=True, nullable=False)
     name = Column(String)
     tenant = Column(String, default="t0")
-    device_secret = Column(String, nullable=True)  # đơn giản: lưu dạng plain cho demo, prod cần hash
+    device_secret = Column(String, nullable=True)  # `sha256$<hex>` của secret (app/device_auth.py)
+    firmware_channel = Column(String, nullable=True)  # NULL = kênh của tenant (xem app/firmware.py)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+TELEMETRY_ID_SEQ = Sequence("telemetry_id_seq")
+
 class Telemetry(Base):
+    """Bảng partition theo `ts` (xem `app/partitions.py`); PK phải chứa cột partition."""
     __tablename__ = "telemetry"
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger, TELEMETRY_ID_SEQ, server_default=TELEMETRY_ID_SEQ.next_value(), primary_key=True)
     device_uid = Column(String, ForeignKey("devices.device_uid"), nullable=False)
     msg_id = Column(String, nullable=False)  # string để chấp nhận cả '0001' lẫn uuid
     payload = Column(JSON, nullable=False)
-    ts = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    __table_args__ = (UniqueConstraint("device_uid", "msg_id", name="uq_device_msg"),)
+    ts = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, primary_key=True)
+    __table_args__ = (
+        # truy vấn lịch sử theo khoảng thời gian + phân trang keyset (ts, id)
+        Index("ix_telemetry_device_ts", "device_uid", "ts", "id"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+
+class TelemetryMsgId(Base):
+    """Khoá chống trùng (device_uid, msg_id, ts) cho telemetry.
+
+    Partition theo `ts` cùng lịch/retention với `telemetry` (xoá bằng DROP partition), nên
+    PK phải chứa `ts`: chỉ chặn bản gửi lại có cùng `ts`. Bản gửi lại không kèm `ts` (server
+    gán giờ nhận) do cửa sổ chống trùng trong RAM (`app/dedup.py`) chặn.
+    """
+    __tablename__ = "telemetry_msg_ids"
+    device_uid = Column(String, primary_key=True)
+    msg_id = Column(String, primary_key=True)
+    ts = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, primary_key=True)
+    __table_args__ = ({"postgresql_partition_by": "RANGE (ts)"},)
+
+class TelemetryMetric(Base):
+    """Giá trị số/bool trích từ payload lúc ghi (schema-on-write), 1 dòng / (thiết bị, metric, ts).
+
+    `telemetry.payload` vẫn là nguồn gốc; bảng hẹp này cho truy vấn/analytics không phải
+    parse JSON. Partition theo `ts` giống `telemetry`.
+    """
+    __tablename__ = "telemetry_metrics"
+    device_uid = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)  # path dạng "data.temp_c"
+    ts = Column(DateTime(timezone=True), primary_key=True)
+    value = Column(Float, nullable=False)  # bool → 0/1
+    __table_args__ = (
+        # 1 metric của mọi thiết bị trong khoảng thời gian
+        Index("ix_telemetry_metrics_metric_ts", "metric", "ts"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
 
 class CommandQueue(Base):
     __tablename__ = "command_queue"
@@ -34,6 +72,89 @@ class CommandQueue(Base):
     device_uid = Column(String, ForeignKey("devices.device_uid"), nullable=False)
     cmd = Column(String, nullable=False)
     params = Column(JSON, nullable=True)
-    status = Column(String, default="pending")  # pending|sent|acked
+    status = Column(String, default="pending")  # pending|sending|sent|leased|acked|failed|dead (xem app/outbox.py, app/command_queue.py)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     ack_at = Column(DateTime(timezone=True))
+    job_id = Column(String, nullable=True, index=True)  # lệnh gửi hàng loạt (fan-out)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")  # số lần đã lease
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+    publish_attempts = Column(Integer, nullable=False, default=0, server_default="0")  # số lần outbox publish MQTT
+    __table_args__ = (
+        # chỉ dòng đang mở → poll/sweep không quét lịch sử command đã ack
+        Index("ix_command_queue_open", "device_uid", "id", postgresql_where=text("status IN ('pending', 'sent')")),
+        Index("ix_command_queue_pending", "id", postgresql_where=text("status = 'pending'")),
+        Index("ix_command_queue_leased", "lease_until", postgresql_where=text("status = 'leased'")),
+        Index("ix_command_queue_sending", "lease_until", postgresql_where=text("status = 'sending'")),
+    )
+
+class TelemetryRollup(Base):
+    """Tổng hợp telemetry theo thiết bị / field số / bucket thời gian (1m, 1h, 1d)."""
+    __tablename__ = "telemetry_rollups"
+    device_uid = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)  # path trong payload, vd "data.temp_c"
+    bucket = Column(String, primary_key=True)  # 1m|1h|1d
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    sum = Column(Float, nullable=False)
+    count = Column(BigInteger, nullable=False)
+    last = Column(Float, nullable=False)
+    last_ts = Column(DateTime(timezone=True), nullable=False)
+
+class DeviceTokenRevocation(Base):
+    """Token thiết bị có `iat` trước `revoked_before` bị từ chối (xem `app/device_auth.py`)."""
+    __tablename__ = "device_token_revocations"
+    device_uid = Column(String, primary_key=True)
+    revoked_before = Column(DateTime(timezone=True), nullable=False)
+
+class DevicePresence(Base):
+    """Trạng thái online mới nhất mỗi thiết bị; ingestor ghi khi trạng thái đổi (xem `app/presence.py`)."""
+    __tablename__ = "device_presence"
+    device_uid = Column(String, primary_key=True)
+    online = Column(Boolean, nullable=False)
+    last_seen = Column(DateTime(timezone=True), nullable=False)
+    changed_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+class AlertRule(Base):
+    """Luật cảnh báo trên telemetry, ingestor đánh giá khi message tới (xem `ingestor/rules.py`).
+
+    `kind`: `threshold` so giá trị với `threshold`; `rate` so tốc độ thay đổi (đơn vị/giây giữa
+    2 mẫu liên tiếp). Điều kiện đúng liên tục `for_seconds` giây → xếp `action_cmd` vào
+    `command_queue` (status `pending`, `job_id` = `rule:<id>`), không lặp lại trước `cooldown_seconds`.
+    """
+    __tablename__ = "alert_rules"
+    id = Column(BigInteger, primary_key=True)
+    name = Column(String, nullable=False)
+    device_uid = Column(String, nullable=True, index=True)  # NULL = mọi thiết bị
+    metric = Column(String, nullable=False)  # path trong payload, vd "data.temp_c"
+    kind = Column(String, nullable=False, default="threshold")  # threshold|rate
+    op = Column(String, nullable=False)  # > >= < <= == !=
+    threshold = Column(Float, nullable=False)
+    for_seconds = Column(Float, nullable=False, default=0)
+    cooldown_seconds = Column(Float, nullable=False, default=300)
+    action_cmd = Column(String, nullable=False)
+    action_params = Column(JSON, nullable=True)
+    action_device_uid = Column(String, nullable=True)  # NULL = thiết bị gửi telemetry
+    enabled = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+class FirmwareRelease(Base):
+    """1 phiên bản firmware; binary lưu ở `FIRMWARE__DIR/<sha256>.bin` (xem `app/firmware.py`)."""
+    __tablename__ = "firmware_releases"
+    id = Column(BigInteger, primary_key=True)
+    version = Column(String, unique=True, nullable=False)
+    channel = Column(String, nullable=False, default="stable")
+    tenant = Column(String, nullable=True)  # NULL = mọi tenant
+    sha256 = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    rollout_percent = Column(Integer, nullable=False, default=0)
+    notes = Column(Text, nullable=True)
+    published_at = Column(DateTime(timezone=True), nullable=True)  # NULL = chưa phát hành
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class FirmwareTenantChannel(Base):
+    """Kênh firmware mặc định của tenant (thiết bị không đặt kênh riêng)."""
+    __tablename__ = "firmware_tenant_channels"
+    tenant = Column(String, primary_key=True)
+    channel = Column(String, nullable=False)
@@ -1,10 +1,172 @@
-import os, json
-from asyncio_mqtt import Client
+import os, json, time, uuid, asyncio, logging
+import paho.mqtt.client as mqtt
+from asyncio_mqtt import Client, MqttError, ProtocolVersion
+from .instrumentation import Histogram, GaugeFunc, CounterFunc
 
 MQTT_HOST = os.getenv("MQTT__HOST", "emqx")
 MQTT_PORT = int(os.getenv("MQTT__PORT", "1883"))
+# số publish QoS1 được gửi song song trên 1 kết nối (chờ PUBACK cùng lúc)
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT__MAX_INFLIGHT", "100"))
+MQTT_PUBLISH_TIMEOUT = float(os.getenv("MQTT__PUBLISH_TIMEOUT", "10"))
+# MQTT__PROTOCOL=5: các subscriber telemetry kết nối MQTT v5 để đọc `content-type` của message
+MQTT_PROTOCOL = ProtocolVersion.V5 if os.getenv("MQTT__PROTOCOL", "3.1.1") == "5" else ProtocolVersion.V311
+
+log = logging.getLogger(__name__)
+
+PUBLISH_LATENCY = Histogram("mqtt_publish_command_seconds", "publish_command latency until PUBACK", ("result",))
+
+class MqttPublisher:
+    """Kết nối MQTT dùng lâu dài cho API (thay vì connect/disconnect mỗi lệnh).
+
+    - `start()`/`stop()` gắn với vòng đời app (startup/shutdown).
+    - Dùng paho client do chính lớp này tạo và quản lý (asyncio-mqtt không cho cấu hình số
+      message in-flight qua API công khai): thread mạng của paho giữ kết nối, tự reconnect
+      (backoff 1–30s); callback của paho được chuyển về event loop.
+    - Nhiều `publish()` đồng thời dùng chung kết nối, PUBACK được chờ song song
+      (tối đa `max_inflight`); phần vượt quá xếp hàng → `stats()["queued"]`.
+    - Mất kết nối khi đang chờ PUBACK: paho gửi lại message QoS1 sau khi kết nối lại.
+    """
+
+    def __init__(self, host: str = MQTT_HOST, port: int = MQTT_PORT, max_inflight: int = MQTT_MAX_INFLIGHT):
+        self.host = host
+        self.port = port
+        self.max_inflight = max(1, max_inflight)
+        self._mqtt: mqtt.Client | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._acks: dict[int, asyncio.Future] = {}  # mid → chờ PUBACK
+        self._connected = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._queued = 0
+        self._in_flight = 0
+        self.reconnects = 0
+        self.published = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._mqtt is not None
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def start(self):
+        if self._mqtt is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        client = mqtt.Client(client_id=f"api-pub-{uuid.uuid4().hex[:8]}", protocol=mqtt.MQTTv311)
+        # paho mặc định chỉ cho 20 message QoS1 in-flight
+        client.max_inflight_messages_set(self.max_inflight)
+        client.reconnect_delay_set(1, 30)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.connect_async(self.host, self.port)
+        client.loop_start()
+        self._mqtt = client
+
+    async def stop(self):
+        client, self._mqtt = self._mqtt, None
+        if client is None:
+            return
+        client.disconnect()
+        await asyncio.to_thread(client.loop_stop)
+        self._connected.clear()
+        for fut in self._acks.values():
+            if not fut.done():
+                fut.set_exception(MqttError("MQTT publisher stopped"))
+        self._acks.clear()
+
+    # callback chạy trên thread mạng của paho → chỉ chuyển sang event loop
+    def _on_connect(self, client, userdata, flags, rc):
+        self._loop.call_soon_threadsafe(self._connection_changed, rc == 0, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._loop.call_soon_threadsafe(self._connection_changed, False, rc)
+
+    def _on_publish(self, client, userdata, mid):
+        self._loop.call_soon_threadsafe(self._acked, mid)
+
+    def _connection_changed(self, up: bool, rc: int):
+        if self._mqtt is None:
+            return  # đã stop()
+        if up:
+            self._connected.set()
+            log.info("mqtt publisher connected %s:%s", self.host, self.port)
+            return
+        if self._connected.is_set() or rc != 0:
+            self.reconnects += 1
+            log.warning("mqtt publisher disconnected (rc=%s), paho reconnects in background", rc)
+        self._connected.clear()
+
+    def _acked(self, mid: int):
+        fut = self._acks.get(mid)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    async def publish(self, topic: str, payload: str | bytes, qos: int = 1, retain: bool = False, timeout: float = MQTT_PUBLISH_TIMEOUT):
+        """Publish trên kết nối chung; chờ kết nối lại (tối đa `timeout`) nếu đang mất."""
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+        self._in_flight += 1
+        try:
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise MqttError("MQTT publisher not connected") from None
+            if self._mqtt is None:
+                raise MqttError("MQTT publisher stopped")
+            info = self._mqtt.publish(topic, payload, qos=qos, retain=retain)
+            # QoS1 khi vừa rớt kết nối (NO_CONN): paho vẫn giữ message và gửi khi kết nối lại
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN):
+                raise MqttError(f"publish failed: {mqtt.error_string(info.rc)}")
+            if qos > 0:
+                # đăng ký trước khi nhường event loop → `_acked` không thể chạy trước
+                fut = self._acks[info.mid] = self._loop.create_future()
+                try:
+                    await asyncio.wait_for(fut, timeout)
+                except asyncio.TimeoutError:
+                    raise MqttError("Operation timed out") from None
+                finally:
+                    self._acks.pop(info.mid, None)
+            self.published += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "published": self.published,
+            "failed": self.failed,
+            "reconnects": self.reconnects,
+        }
+
+publisher = MqttPublisher()
+
+GaugeFunc("mqtt_publisher_connected", "1 if the shared MQTT publisher is connected", lambda: int(publisher.connected))
+GaugeFunc("mqtt_publisher_in_flight", "Publishes waiting for PUBACK", lambda: publisher.stats()["in_flight"])
+GaugeFunc("mqtt_publisher_queued", "Publishes waiting for an in-flight slot", lambda: publisher.stats()["queued"])
+CounterFunc("mqtt_publisher_reconnects", "MQTT publisher reconnects", lambda: publisher.reconnects)
 
 async def publish_command(device_uid: str, payload: dict):
     topic = f"t0/devices/{device_uid}/commands"
-    async with Client(MQTT_HOST, MQTT_PORT) as client:
-        await client.publish(topic, json.dumps(payload), qos=1)
+    start, result = time.perf_counter(), "error"
+    try:
+        if publisher.running:
+            await publisher.publish(topic, json.dumps(payload), qos=1)
+        else:
+            # ngoài app (script/CLI): kết nối 1 lần như trước
+            async with Client(MQTT_HOST, MQTT_PORT) as client:
+                await client.publish(topic, json.dumps(payload), qos=1)
+        result = "ok"
+    finally:
+        PUBLISH_LATENCY.labels(result).observe(time.perf_counter() - start)
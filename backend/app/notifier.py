@@ -0,0 +1,122 @@
+import asyncio, logging
+from typing import Callable
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import engine
+
+CHANNEL = "command_queued"
+# payload NOTIFY tối đa ~8000 byte → gom uid thành nhiều NOTIFY nếu cần
+_NOTIFY_BYTES = 7000
+# LISTEN mất kết nối → thử lại sau 1s, 2s, 4s… tối đa 30s
+RECONNECT_MIN_SECONDS = 1.0
+RECONNECT_MAX_SECONDS = 30.0
+
+log = logging.getLogger(__name__)
+
+class CommandNotifier:
+    """Đánh thức các request long-poll `/commands/poll?wait=` khi có command mới.
+
+    Nguồn sự kiện là Postgres `LISTEN command_queued`: mọi API worker (và
+    process khác như ingestor) gọi `announce()` trong transaction tạo command,
+    Postgres chỉ gửi NOTIFY sau khi commit nên người poll luôn thấy dòng mới.
+    """
+
+    def __init__(self):
+        self._waiters: dict[str, set[asyncio.Future]] = {}
+        self._task: asyncio.Task | None = None
+        self._channels: dict[str, Callable[[str], None]] = {}
+        self.listening = False
+
+    def listen(self, channel: str, callback):
+        """LISTEN thêm `channel` trên cùng kết nối; `callback(payload)` chạy trong event loop.
+        Sau mỗi lần (re)connect được gọi 1 lần với payload rỗng (có thể đã lỡ NOTIFY)."""
+        self._channels[channel] = callback
+
+    def subscribe(self, device_uid: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(device_uid, set()).add(fut)
+        return fut
+
+    def unsubscribe(self, device_uid: str, fut: asyncio.Future):
+        waiters = self._waiters.get(device_uid)
+        if waiters is not None:
+            waiters.discard(fut)
+            if not waiters:
+                del self._waiters[device_uid]
+
+    def wake(self, device_uids):
+        for uid in device_uids:
+            for fut in self._waiters.pop(uid, ()):
+                if not fut.done():
+                    fut.set_result(True)
+
+    async def wait(self, fut: asyncio.Future, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _on_notify(self, conn, pid, channel, payload: str):
+        self.wake(payload.split(","))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        delay = RECONNECT_MIN_SECONDS
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda c: lost.set())
+                await conn.add_listener(CHANNEL, self._on_notify)
+                for channel, callback in self._channels.items():
+                    await conn.add_listener(channel, lambda c, pid, ch, payload, cb=callback: cb(payload))
+                    callback("")
+                self.listening = True
+                delay = RECONNECT_MIN_SECONDS
+                await lost.wait()
+                log.warning("command notifier LISTEN connection lost")
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning("command notifier LISTEN failed: %s", e)
+            except Exception:
+                # lỗi bất ngờ (DSN, callback…) không được giết task: long-poll chỉ còn timeout
+                log.exception("command notifier LISTEN failed")
+            finally:
+                self.listening = False
+                if conn is not None and not conn.is_closed():
+                    try:
+                        await conn.close()
+                    except Exception:
+                        conn.terminate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+async def announce(db: AsyncSession, device_uids):
+    """Gửi NOTIFY (trong transaction hiện tại) cho các thiết bị vừa có command."""
+    chunk: list[str] = []
+    size = 0
+    for uid in sorted(set(device_uids)):
+        if chunk and size + len(uid) + 1 > _NOTIFY_BYTES:
+            await db.execute(text("SELECT pg_notify(:ch, :p)"), {"ch": CHANNEL, "p": ",".join(chunk)})
+            chunk, size = [], 0
+        chunk.append(uid)
+        size += len(uid) + 1
+    if chunk:
+        await db.execute(text("SELECT pg_notify(:ch, :p)"), {"ch": CHANNEL, "p": ",".join(chunk)})
+
+notifier = CommandNotifier()
@@ -0,0 +1,205 @@
+"""Outbox cho command: request chỉ ghi `command_queue` (status `pending`) rồi trả về ngay;
+dispatcher nền đọc dòng `pending`, publish MQTT và đánh dấu `sent` theo lô.
+
+    pending ──claim──▶ sending ──publish ok──▶ sent
+       ▲                  │ lỗi kết nối, publish_attempts < OUTBOX__MAX_ATTEMPTS
+       └──────────────────┘ ... ≥ OUTBOX__MAX_ATTEMPTS / lỗi riêng của dòng ──▶ failed
+
+- Claim: 1 câu UPDATE (`FOR UPDATE SKIP LOCKED`) chuyển dòng sang `sending` kèm lease
+  `OUTBOX__LEASE_SECONDS`, tăng `publish_attempts` rồi commit ngay → không giữ transaction/lock
+  trong lúc chờ broker; chạy được nhiều dispatcher (mỗi API worker, hoặc process riêng
+  `python -m app.outbox` với `OUTBOX__DISPATCHER=0` ở API). Dispatcher chết giữa chừng →
+  dòng `sending` hết lease được claim lại (giao ít nhất 1 lần).
+- Mỗi lô tối đa `OUTBOX__BATCH` dòng, publish song song giữa các thiết bị, tuần tự trong
+  cùng thiết bị (giữ thứ tự lệnh); kết quả ghi trong transaction thứ 2: dòng thành công →
+  `sent` bằng 1 câu UPDATE + NOTIFY cho thiết bị HTTP long-poll.
+- Lỗi kết nối (broker mất, timeout) → dòng về `pending`, cả vòng lặp thử lại sau backoff.
+  Lỗi riêng của 1 dòng (vd paho từ chối topic vì device_uid chứa `+`/`#`) → dòng đó `failed`,
+  các dòng khác đi tiếp, không backoff. Không có kết nối MQTT thì không claim dòng.
+- Dispatcher cùng process được đánh thức ngay (`wake()`); dòng do process khác ghi được
+  thấy sau tối đa `OUTBOX__POLL_SECONDS`.
+"""
+import os, asyncio, logging, time
+from asyncio_mqtt import MqttError
+from collections import defaultdict
+from datetime import datetime, timezone
+from sqlalchemy import text, bindparam, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+from .db import SessionLocal
+from .mqtt_pub import publish_command, publisher
+from .notifier import announce
+from .instrumentation import Counter, Histogram
+
+DISPATCHER_ENABLED = os.getenv("OUTBOX__DISPATCHER", "1") not in ("0", "false", "no")
+BATCH = int(os.getenv("OUTBOX__BATCH", "1000"))
+POLL_SECONDS = float(os.getenv("OUTBOX__POLL_SECONDS", "1"))
+LEASE_SECONDS = int(os.getenv("OUTBOX__LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX__MAX_ATTEMPTS", "10"))
+RETRY_MAX_SECONDS = 30
+
+DISPATCHED = Counter("command_outbox_dispatched", "Outbox commands by publish result", ("result",))
+LAG = Histogram("command_outbox_lag_seconds", "Time from command insert to MQTT publish",
+                buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+BATCH_SECONDS = Histogram("command_outbox_batch_seconds", "Time to claim, publish and mark one outbox batch")
+
+log = logging.getLogger(__name__)
+
+# lỗi kết nối/broker: thử lại sau; lỗi khác là của riêng dòng đó
+TRANSIENT_ERRORS = (MqttError, OSError, asyncio.TimeoutError)
+
+_CLAIM_SQL = text("""
+WITH claimed AS (
+    SELECT id FROM command_queue
+    WHERE status = 'pending' OR (status = 'sending' AND lease_until < now())
+    ORDER BY id
+    LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE command_queue q
+SET status = 'sending', publish_attempts = q.publish_attempts + 1,
+    lease_until = now() + make_interval(secs => :lease)
+FROM claimed WHERE q.id = claimed.id
+RETURNING q.id, q.device_uid, q.cmd, q.params, q.created_at, q.publish_attempts
+""")
+
+_MARK_SENT_SQL = text(
+    "UPDATE command_queue SET status = 'sent', lease_until = NULL WHERE id = ANY(:ids)"
+).bindparams(bindparam("ids", type_=ARRAY(BigInteger)))
+
+# chỉ dòng còn `sending` (chưa bị dispatcher khác claim lại sau khi hết lease)
+_RELEASE_SQL = text("""
+UPDATE command_queue
+SET status = CASE WHEN id = ANY(:rejected) OR publish_attempts >= :max_attempts THEN 'failed' ELSE 'pending' END,
+    lease_until = NULL
+WHERE id = ANY(:ids) AND status = 'sending'
+RETURNING status
+""").bindparams(bindparam("ids", type_=ARRAY(BigInteger)), bindparam("rejected", type_=ARRAY(BigInteger)))
+
+class OutboxDispatcher:
+    def __init__(self, batch: int = BATCH, interval: float = POLL_SECONDS,
+                 lease: int = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.batch = max(1, batch)
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.failed = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _publish_device(self, rows) -> list[str]:
+        """Kết quả từng dòng: `sent` | `retry` (lỗi kết nối) | `rejected` (lỗi riêng dòng)."""
+        results = []
+        for r in rows:
+            try:
+                await publish_command(r.device_uid, {"cmd": r.cmd, "params": r.params})
+                results.append("sent")
+            except TRANSIENT_ERRORS:
+                # lệnh sau của cùng thiết bị không được vượt lệnh chưa gửi được
+                results.extend(["retry"] * (len(rows) - len(results)))
+                break
+            except Exception:
+                log.exception("command outbox: dropping command %s for %r", r.id, r.device_uid)
+                results.append("rejected")
+        return results
+
+    async def dispatch_once(self) -> tuple[int, int]:
+        """1 lô: trả về (số đã publish, số lỗi kết nối cần backoff)."""
+        if publisher.running and not publisher.connected:
+            return 0, 0
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            res = await db.execute(_CLAIM_SQL, {"batch": self.batch, "lease": self.lease})
+            rows = sorted(res.all(), key=lambda r: r.id)
+            await db.commit()
+        if not rows:
+            return 0, 0
+        by_device = defaultdict(list)
+        for r in rows:
+            by_device[r.device_uid].append(r)
+        groups = list(by_device.values())
+        results = await asyncio.gather(*(self._publish_device(g) for g in groups))
+        now = datetime.now(timezone.utc)
+        sent, retry, rejected = [], [], []
+        for group, outcomes in zip(groups, results):
+            for r, outcome in zip(group, outcomes):
+                if outcome == "sent":
+                    sent.append(r)
+                    if r.created_at is not None:
+                        LAG.observe((now - r.created_at).total_seconds())
+                else:
+                    (retry if outcome == "retry" else rejected).append(r.id)
+        gave_up = 0
+        async with SessionLocal() as db:
+            if sent:
+                await db.execute(_MARK_SENT_SQL, {"ids": [r.id for r in sent]})
+                await announce(db, [r.device_uid for r in sent])
+            if retry or rejected:
+                res = await db.execute(_RELEASE_SQL, {"ids": retry + rejected, "rejected": rejected,
+                                                      "max_attempts": self.max_attempts})
+                gave_up = sum(1 for (status,) in res.all() if status == "failed")
+            await db.commit()
+        self.sent += len(sent)
+        self.failed += len(retry) + len(rejected)
+        DISPATCHED.labels("sent").inc(len(sent))
+        DISPATCHED.labels("retry").inc(len(retry))
+        DISPATCHED.labels("rejected").inc(len(rejected))
+        if gave_up:
+            DISPATCHED.labels("failed").inc(gave_up)
+            log.warning("command outbox: %d commands failed permanently", gave_up)
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+        return len(sent), len(retry)
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            self._wakeup.clear()
+            try:
+                sent, failed = await self.dispatch_once()
+            except Exception:
+                log.exception("command outbox dispatch failed")
+                sent, failed = 0, 1
+            if failed:
+                log.warning("command outbox: %d publishes failed, retrying in %.1fs", failed, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_SECONDS)
+                continue
+            delay = 0.5
+            if sent >= self.batch:
+                continue  # còn backlog: lấy lô tiếp ngay
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+dispatcher = OutboxDispatcher()
+
+async def _main():
+    """Dispatcher chạy riêng (không cần API): `python -m app.outbox`."""
+    await publisher.start()
+    await dispatcher.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dispatcher.stop()
+        await publisher.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,13 @@
+import base64
+from datetime import datetime
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    """Cursor keyset mờ (opaque): base64url của `ts|id` dòng cuối trang."""
+    raw = f"{ts.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Giải mã cursor; ném ValueError nếu sai định dạng."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    ts, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+    return datetime.fromisoformat(ts), int(row_id)
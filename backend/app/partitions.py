@@ -0,0 +1,296 @@
+"""Quản lý partition theo thời gian của bảng `telemetry` (và `telemetry_metrics`, `telemetry_msg_ids`).
+
+    cd backend
+    DATABASE_URL=... python -m app.partitions maintain   # tạo partition trước + xoá partition hết hạn
+    DATABASE_URL=... python -m app.partitions migrate    # chuyển bảng telemetry / telemetry_msg_ids cũ (heap) sang partitioned
+    DATABASE_URL=... python -m app.partitions index      # bảng telemetry heap cũ: tạo index lịch sử CONCURRENTLY
+
+- Partition theo ngày (`TELEMETRY__PARTITION=day`) hoặc tháng (`month`), tạo trước
+  `TELEMETRY__PARTITIONS_AHEAD` partition.
+- Retention `TELEMETRY__RETENTION_DAYS` (0 = giữ mãi): partition nằm trọn ngoài
+  retention bị DETACH rồi DROP – không DELETE từng dòng, không bloat/vacuum. Áp dụng cho
+  mọi bảng trong `PARTITIONED_TABLES`; bảng chưa migrate (heap) không được dọn.
+- Chống trùng nằm ở bảng `telemetry_msg_ids`, khoá `(device_uid, msg_id, ts)` (unique trên
+  bảng partitioned bắt buộc chứa cột `ts`); bản gửi lại khác `ts` do `app/dedup.py` chặn.
+"""
+import os, sys, time, asyncio, logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+PARTITION_INTERVAL = os.getenv("TELEMETRY__PARTITION", "day")  # day|month
+PARTITIONS_AHEAD = int(os.getenv("TELEMETRY__PARTITIONS_AHEAD", "3"))
+RETENTION_DAYS = int(os.getenv("TELEMETRY__RETENTION_DAYS", "0"))
+# khoá advisory để nhiều process (API, các ingestor) không tạo/xoá partition cùng lúc
+_LOCK_KEY = 727001
+# các bảng partition theo RANGE (ts), dùng chung lịch tạo partition và retention
+PARTITIONED_TABLES = ("telemetry", "telemetry_metrics", "telemetry_msg_ids")
+
+log = logging.getLogger(__name__)
+
+def period_start(ts: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    ts = ts.astimezone(timezone.utc)
+    if interval == "month":
+        return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+    return datetime(ts.year, ts.month, ts.day, tzinfo=timezone.utc)
+
+def next_period(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start + timedelta(days=1)
+
+def partition_name(start: datetime, interval: str = PARTITION_INTERVAL, table: str = "telemetry") -> str:
+    return f"{table}_p" + start.strftime("%Y%m" if interval == "month" else "%Y%m%d")
+
+async def is_partitioned(conn: AsyncConnection, table: str = "telemetry") -> bool:
+    res = await conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"
+    ), {"t": table})
+    return bool(res.scalar())
+
+def _parse_bound(value: str) -> datetime:
+    # Postgres in offset dạng "+07"; fromisoformat của Python 3.10 cần "+07:00"
+    if len(value) > 3 and value[-3] in "+-" and value[-2:].isdigit():
+        value += ":00"
+    return datetime.fromisoformat(value)
+
+async def list_partitions(conn: AsyncConnection, table: str = "telemetry") -> list[tuple[str, datetime, datetime]]:
+    """(tên, from, to) của các partition hiện có, đọc từ pg_inherits + biểu thức bound."""
+    res = await conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:t)
+    """), {"t": table})
+    out = []
+    for name, bound in res.all():
+        # FOR VALUES FROM ('2024-01-01 00:00:00+00') TO ('2024-01-02 00:00:00+00')
+        parts = bound.split("'")
+        if len(parts) < 4:
+            continue  # DEFAULT partition
+        out.append((name, _parse_bound(parts[1]), _parse_bound(parts[3])))
+    return sorted(out, key=lambda p: p[1])
+
+async def create_partition(conn: AsyncConnection, start: datetime, interval: str = PARTITION_INTERVAL, table: str = "telemetry") -> str:
+    name = partition_name(start, interval, table)
+    end = next_period(start, interval)
+    await conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+    return name
+
+async def ensure_partitions(conn: AsyncConnection, now: datetime | None = None, ahead: int = PARTITIONS_AHEAD, table: str = "telemetry"):
+    """Tạo partition cho kỳ hiện tại + `ahead` kỳ tiếp theo (nếu chưa có)."""
+    start = period_start(now or datetime.now(timezone.utc))
+    for _ in range(ahead + 1):
+        await create_partition(conn, start, table=table)
+        start = next_period(start)
+
+async def drop_expired(conn: AsyncConnection, now: datetime | None = None, retention_days: int = RETENTION_DAYS, table: str = "telemetry") -> list[str]:
+    """DETACH + DROP các partition có `to` ≤ mốc retention."""
+    if retention_days <= 0:
+        return []
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    dropped = []
+    for name, _, end in await list_partitions(conn, table):
+        if end <= cutoff:
+            await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            await conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+async def maintain(conn: AsyncConnection) -> list[str]:
+    """Tạo partition trước và xoá partition hết hạn cho các bảng trong `PARTITIONED_TABLES`.
+
+    Bảng chưa partition (ví dụ `telemetry` cũ chưa migrate) được bỏ qua.
+    """
+    tables = [t for t in PARTITIONED_TABLES if await is_partitioned(conn, t)]
+    if not tables:
+        return []
+    if len(tables) < len(PARTITIONED_TABLES):
+        log.warning("tables not partitioned (no retention): %s – run `python -m app.partitions migrate`",
+                    ", ".join(t for t in PARTITIONED_TABLES if t not in tables))
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+    dropped = []
+    for table in tables:
+        await ensure_partitions(conn, table=table)
+        dropped += await drop_expired(conn, table=table)
+    if dropped:
+        log.info("dropped expired telemetry partitions: %s", ", ".join(dropped))
+    return dropped
+
+class PartitionCoverage:
+    """Khoảng `ts` mà các bảng partitioned nhận được (cache các partition hiện có trong RAM).
+
+    Dùng trước khi ghi telemetry có `ts` do thiết bị gửi (gửi bù khi offline): Postgres báo lỗi
+    "no partition of relation found for row" cho cả câu lệnh nếu 1 dòng rơi ngoài mọi partition.
+    `ts` thuộc kỳ hiện tại → `PARTITIONS_AHEAD` kỳ tới mà partition chưa có (process chạy lâu,
+    `maintain` chưa chạy lại) → tạo ngay; ngoài cửa sổ đó và ngoài partition có sẵn → từ chối.
+    """
+
+    def __init__(self, refresh_seconds: float = 300):
+        self.refresh_seconds = refresh_seconds
+        self._ranges: dict[str, list[tuple[datetime, datetime]]] | None = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, conn: AsyncConnection):
+        ranges = {}
+        for table in PARTITIONED_TABLES:
+            if await is_partitioned(conn, table):
+                ranges[table] = [(start, end) for _, start, end in await list_partitions(conn, table)]
+        self._ranges, self._loaded_at = ranges, time.monotonic()
+
+    def _covers(self, ts: datetime) -> bool:
+        return all(any(start <= ts < end for start, end in parts) for parts in self._ranges.values())
+
+    async def check(self, tss: list[datetime]) -> list[bool]:
+        """Mỗi `ts` (có timezone) có partition để ghi không."""
+        from .db import engine
+
+        async with self._lock:
+            if self._ranges is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+                async with engine.connect() as conn:
+                    await self.refresh(conn)
+            missing = [ts for ts in tss if not self._covers(ts)]
+            if missing and self._ranges:
+                start = end = period_start(datetime.now(timezone.utc))
+                for _ in range(PARTITIONS_AHEAD + 1):
+                    end = next_period(end)
+                create = any(start <= ts < end for ts in missing)
+                # ts quá cũ/quá xa: chỉ nạp lại thỉnh thoảng (partition có thể vừa được backfill tạo)
+                if create or time.monotonic() - self._loaded_at > 30:
+                    async with engine.begin() as conn:
+                        if create:
+                            await maintain(conn)
+                        await self.refresh(conn)
+        return [self._covers(ts) for ts in tss]
+
+coverage = PartitionCoverage()
+
+async def migrate_legacy(conn: AsyncConnection, drop_legacy: bool = False) -> int:
+    """Chuyển bảng `telemetry` thường sang partitioned, giữ nguyên id.
+
+    Chạy trong 1 transaction; nên dừng ingestor trong lúc migrate. Bảng cũ được
+    giữ lại tên `telemetry_legacy` (trừ khi `drop_legacy`) để đối chiếu.
+    """
+    from .db import Base
+    from .models import Telemetry, TelemetryMsgId
+
+    if await is_partitioned(conn):
+        return 0
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+    await conn.execute(text("ALTER TABLE telemetry RENAME TO telemetry_legacy"))
+    # tên index/constraint là duy nhất trong schema → đổi tên để tạo bảng mới
+    await conn.execute(text("ALTER TABLE telemetry_legacy RENAME CONSTRAINT telemetry_pkey TO telemetry_legacy_pkey"))
+    await conn.execute(text("ALTER INDEX IF EXISTS ix_telemetry_device_ts RENAME TO ix_telemetry_legacy_device_ts"))
+    # sequence của id được bảng mới dùng tiếp; không để DROP bảng cũ kéo theo
+    await conn.execute(text("ALTER SEQUENCE telemetry_id_seq OWNED BY NONE"))
+    await conn.run_sync(Base.metadata.create_all, tables=[Telemetry.__table__, TelemetryMsgId.__table__])
+
+    res = await conn.execute(text("SELECT min(ts) FROM telemetry_legacy"))
+    await _create_range(conn, res.scalar(), ("telemetry", "telemetry_msg_ids"))
+
+    res = await conn.execute(text(
+        "INSERT INTO telemetry (id, device_uid, msg_id, payload, ts) "
+        "SELECT id, device_uid, msg_id, payload, ts FROM telemetry_legacy"
+    ))
+    moved = res.rowcount
+    await conn.execute(text(
+        "INSERT INTO telemetry_msg_ids (device_uid, msg_id, ts) "
+        "SELECT device_uid, msg_id, ts FROM telemetry_legacy ON CONFLICT DO NOTHING"
+    ))
+    await conn.execute(text(
+        "SELECT setval('telemetry_id_seq', GREATEST((SELECT max(id) FROM telemetry), 1))"
+    ))
+    if drop_legacy:
+        await conn.execute(text("DROP TABLE telemetry_legacy"))
+    return moved
+
+async def _create_range(conn: AsyncConnection, oldest: datetime | None, tables: tuple[str, ...]):
+    """Partition từ kỳ chứa `oldest` tới `PARTITIONS_AHEAD` kỳ tới cho các bảng đã partition."""
+    now = datetime.now(timezone.utc)
+    for table in tables:
+        if not await is_partitioned(conn, table):
+            continue
+        start = period_start(oldest or now)
+        while start <= now:
+            await create_partition(conn, start, table=table)
+            start = next_period(start)
+        await ensure_partitions(conn, now, table=table)
+
+async def migrate_msg_ids(conn: AsyncConnection) -> int:
+    """Chuyển `telemetry_msg_ids` thường (khoá `(device_uid, msg_id)`) sang partitioned theo `ts`.
+
+    Chạy trong 1 transaction, nên dừng ingestor trong lúc migrate. Sau đó khoá cũ được dọn
+    bằng DROP partition như `telemetry`. Bảng cũ bị xoá.
+    """
+    from .db import Base
+    from .models import TelemetryMsgId
+
+    if await is_partitioned(conn, "telemetry_msg_ids"):
+        return 0
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+    await conn.execute(text("ALTER TABLE telemetry_msg_ids RENAME TO telemetry_msg_ids_legacy"))
+    await conn.execute(text("ALTER TABLE telemetry_msg_ids_legacy RENAME CONSTRAINT telemetry_msg_ids_pkey TO telemetry_msg_ids_legacy_pkey"))
+    await conn.run_sync(Base.metadata.create_all, tables=[TelemetryMsgId.__table__])
+    res = await conn.execute(text("SELECT min(ts) FROM telemetry_msg_ids_legacy"))
+    await _create_range(conn, res.scalar(), ("telemetry_msg_ids",))
+    res = await conn.execute(text(
+        "INSERT INTO telemetry_msg_ids (device_uid, msg_id, ts) "
+        "SELECT device_uid, msg_id, ts FROM telemetry_msg_ids_legacy"
+    ))
+    await conn.execute(text("DROP TABLE telemetry_msg_ids_legacy"))
+    return res.rowcount
+
+_HISTORY_INDEX_SQL = text(
+    "SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass('ix_telemetry_device_ts')"
+)
+
+async def missing_history_index(conn: AsyncConnection) -> bool:
+    """`telemetry` thiếu (hoặc có bản lỗi của) index `(device_uid, ts, id)` cho `/telemetry/history`."""
+    return not (await conn.execute(_HISTORY_INDEX_SQL)).scalar()
+
+async def create_history_index(engine) -> bool:
+    """Tạo index lịch sử cho bảng `telemetry` heap cũ bằng `CREATE INDEX CONCURRENTLY`
+    (ngoài transaction, không chặn ghi). Bảng partitioned đã có index từ model.
+
+    Lần build CONCURRENTLY bị ngắt để lại index `INVALID` → xoá rồi build lại.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if await is_partitioned(conn):
+            return False
+        valid = (await conn.execute(_HISTORY_INDEX_SQL)).scalar()
+        if valid:
+            return False
+        if valid is not None:
+            await conn.execute(text("DROP INDEX CONCURRENTLY ix_telemetry_device_ts"))
+        await conn.execute(text("CREATE INDEX CONCURRENTLY ix_telemetry_device_ts ON telemetry (device_uid, ts, id)"))
+        return True
+
+async def _main(cmd: str):
+    from .db import engine
+    if cmd == "index":
+        created = await create_history_index(engine)
+        print("created ix_telemetry_device_ts" if created else "ix_telemetry_device_ts already present")
+        await engine.dispose()
+        return
+    async with engine.begin() as conn:
+        if cmd == "migrate":
+            moved = await migrate_legacy(conn, drop_legacy="--drop-legacy" in sys.argv)
+            print(f"migrated {moved} rows into partitioned telemetry")
+            moved = await migrate_msg_ids(conn)
+            print(f"migrated {moved} rows into partitioned telemetry_msg_ids")
+        else:
+            dropped = await maintain(conn)
+            for table in PARTITIONED_TABLES:
+                print(f"{table} partitions:", [p[0] for p in await list_partitions(conn, table)])
+            print("dropped:", dropped)
+    await engine.dispose()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("maintain", "migrate", "index"):
+        raise SystemExit(__doc__)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1]))
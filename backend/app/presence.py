@@ -0,0 +1,217 @@
+"""Trạng thái online/offline của thiết bị, giữ trong RAM.
+
+Nguồn:
+- message retained `t0/devices/{uid}/status` (`{"online": true|false, "ts": ...}` hoặc chuỗi
+  `online`/`offline`): thiết bị publish khi kết nối, broker publish last-will `online: false`
+  khi thiết bị rớt mạng (hết keepalive);
+- telemetry (MQTT và HTTP) được tính là heartbeat.
+
+Thiết bị online mà không có message nào trong `PRESENCE__TIMEOUT_SECONDS` → offline (thiết bị
+không đăng ký last-will, thiết bị chỉ dùng HTTP). Thiết bị online nằm trong 1 `OrderedDict`
+theo thứ tự heartbeat → kiểm tra hết hạn chỉ chạm các dòng đã quá hạn.
+
+Ingestor (`ingestor/run.py`) ghi các lần đổi trạng thái theo lô vào `device_presence`; mỗi API
+worker giữ bảng riêng (feed MQTT + ingest HTTP, nạp từ `device_presence` lúc khởi động) để
+trả `GET /devices?online=` và `GET /devices/presence` mà không quét telemetry.
+"""
+import os, json, time, asyncio, logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from sqlalchemy import text, bindparam, String, Boolean, DateTime
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import SessionLocal
+from .fields import finite_float
+from .instrumentation import Counter, GaugeFunc
+
+STATUS_TOPIC = os.getenv("MQTT__STATUS_TOPIC", "t0/devices/+/status")
+TIMEOUT_SECONDS = float(os.getenv("PRESENCE__TIMEOUT_SECONDS", "120"))
+FLUSH_SECONDS = float(os.getenv("PRESENCE__FLUSH_SECONDS", "2"))
+
+CHANGES = Counter("device_presence_changes", "Device presence transitions by cause", ("cause",))
+
+log = logging.getLogger(__name__)
+
+_UPSERT_SQL = text("""
+INSERT INTO device_presence (device_uid, online, last_seen, changed_at)
+SELECT u, o, s, now() FROM unnest(:uids, :online, :seen) AS i(u, o, s)
+ON CONFLICT (device_uid) DO UPDATE
+SET online = excluded.online, last_seen = excluded.last_seen, changed_at = now()
+WHERE device_presence.last_seen <= excluded.last_seen
+""").bindparams(
+    bindparam("uids", type_=ARRAY(String)),
+    bindparam("online", type_=ARRAY(Boolean)),
+    bindparam("seen", type_=ARRAY(DateTime(timezone=True))),
+)
+
+def decode_status(topic: str, payload: bytes):
+    """`t0/devices/{uid}/status` → `(device_uid, online, ts | None)`; None nếu không hiểu
+    (payload rỗng = xoá message retained)."""
+    parts = topic.split("/")
+    if len(parts) < 4 or not payload:
+        return None
+    raw = payload.decode(errors="ignore").strip()
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        body = raw.lower()
+    ts = None
+    if isinstance(body, dict):
+        online, ts = body.get("online"), body.get("ts")
+        ts = finite_float(ts)
+    elif isinstance(body, str):
+        online = {"online": True, "offline": False}.get(body)
+    else:
+        online = body
+    if not isinstance(online, (bool, int)):
+        return None
+    return parts[2], bool(online), ts
+
+class PresenceTable:
+    def __init__(self, timeout: float = TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._last_seen: dict[str, float] = {}  # epoch giây, mọi thiết bị đã biết
+        self._online: OrderedDict[str, None] = OrderedDict()  # heartbeat cũ → mới
+        self._changes: dict[str, tuple[bool, float]] = {}  # chưa ghi DB, gộp theo thiết bị
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    @property
+    def online_count(self) -> int:
+        return len(self._online)
+
+    def _change(self, device_uid: str, online: bool, ts: float, cause: str):
+        self._changes[device_uid] = (online, ts)
+        CHANGES.labels(cause).inc()
+
+    def heartbeat(self, device_uid: str):
+        now = time.time()
+        self._last_seen[device_uid] = now
+        if device_uid in self._online:
+            self._online.move_to_end(device_uid)
+        else:
+            self._online[device_uid] = None
+            self._change(device_uid, True, now, "online")
+
+    def status(self, device_uid: str, online: bool, ts: float | None = None, retained: bool = False):
+        """Message status/last-will. Với message retained (nhận lúc subscribe), `ts` của thiết bị
+        dùng để bỏ qua status online đã cũ (lần kết nối trước, không có last-will)."""
+        now = time.time()
+        if online and not (retained and ts is not None and now - ts >= self.timeout):
+            self.heartbeat(device_uid)
+            return
+        known = device_uid in self._last_seen
+        was_online = device_uid in self._online
+        self._online.pop(device_uid, None)
+        seen = min(ts, now) if retained and ts is not None else now
+        self._last_seen[device_uid] = max(self._last_seen.get(device_uid, 0.0), seen)
+        if was_online or not known:
+            self._change(device_uid, False, self._last_seen[device_uid], "offline")
+
+    def on_telemetry(self, device_uid: str, msg_id: str, payload: dict, ts: datetime):
+        """Listener cho `TelemetryFeed` (thời điểm nhận, không dùng `ts` trong payload)."""
+        self.heartbeat(device_uid)
+
+    def expire(self, now: float | None = None) -> int:
+        """Chuyển offline các thiết bị không có message trong `timeout` giây."""
+        cutoff = (time.time() if now is None else now) - self.timeout
+        expired = 0
+        while self._online:
+            uid = next(iter(self._online))
+            if self._last_seen[uid] >= cutoff:
+                break
+            del self._online[uid]
+            self._change(uid, False, self._last_seen[uid], "timeout")
+            expired += 1
+        return expired
+
+    def is_online(self, device_uid: str) -> bool:
+        return device_uid in self._online
+
+    def last_seen(self, device_uid: str) -> datetime | None:
+        ts = self._last_seen.get(device_uid)
+        return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else None
+
+    def online_uids(self) -> list[str]:
+        return list(self._online)
+
+    def counts(self) -> dict[str, int]:
+        return {"online": len(self._online), "offline": len(self._last_seen) - len(self._online), "known": len(self._last_seen)}
+
+    def drain(self) -> dict[str, tuple[bool, float]]:
+        changes, self._changes = self._changes, {}
+        return changes
+
+    def restore(self, changes: dict[str, tuple[bool, float]]):
+        """Trả lại các thay đổi ghi DB lỗi (không đè thay đổi mới hơn)."""
+        for uid, change in changes.items():
+            self._changes.setdefault(uid, change)
+
+    async def warm(self, db: AsyncSession):
+        """Nạp trạng thái đã lưu. `last_seen` trong DB là lúc đổi trạng thái, không phải heartbeat
+        cuối → thiết bị đang online được tính heartbeat lúc nạp (thêm `timeout` giây để lên tiếng)."""
+        now = time.time()
+        res = await db.execute(text("SELECT device_uid, online, last_seen FROM device_presence ORDER BY last_seen"))
+        for uid, online, seen in res.all():
+            if uid in self._last_seen:
+                continue  # đã nhận message mới hơn từ MQTT
+            if online:
+                self._last_seen[uid] = now
+                self._online[uid] = None
+            else:
+                self._last_seen[uid] = seen.timestamp()
+
+async def save_changes(db: AsyncSession, changes: dict[str, tuple[bool, float]]):
+    """Upsert các lần đổi trạng thái bằng 1 câu lệnh (giá trị mảng). Không commit."""
+    uids = list(changes)
+    await db.execute(_UPSERT_SQL, {
+        "uids": uids,
+        "online": [changes[u][0] for u in uids],
+        "seen": [datetime.fromtimestamp(changes[u][1], timezone.utc) for u in uids],
+    })
+
+class PresenceMonitor:
+    """Task nền: mỗi `interval` giây cho hết hạn heartbeat và (nếu `persist`) ghi thay đổi vào DB."""
+
+    def __init__(self, table: PresenceTable, persist: bool = False, interval: float = FLUSH_SECONDS):
+        self.table = table
+        self.persist = persist
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if self.persist:
+                await self.flush()
+
+    async def flush(self):
+        changes = self.table.drain()
+        if not changes or not self.persist:
+            return
+        try:
+            async with SessionLocal() as db:
+                await save_changes(db, changes)
+                await db.commit()
+        except Exception:
+            log.exception("saving %d presence changes failed, will retry", len(changes))
+            self.table.restore(changes)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.table.expire()
+            await self.flush()
+
+presence = PresenceTable()
+GaugeFunc("devices_online", "Devices currently online (status/last-will + heartbeat)", lambda: presence.online_count)
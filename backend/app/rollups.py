@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import func, case
+from .models import TelemetryRollup
+from .fields import numeric_fields
+
+# tên bucket → độ dài (giây), từ mịn đến thô
+BUCKETS = {"1m": 60, "1h": 3600, "1d": 86400}
+# mỗi dòng rollup dùng 10 bind params
+UPSERT_CHUNK = 3000
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def bucket_start(ts: datetime, seconds: int) -> datetime:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    epoch = int(ts.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+def pick_bucket(resolution: float) -> str:
+    """Bucket thô nhất không vượt quá độ phân giải yêu cầu (giây)."""
+    chosen = "1m"
+    for name, seconds in BUCKETS.items():
+        if seconds <= resolution:
+            chosen = name
+    return chosen
+
+class RollupAccumulator:
+    """Gộp các giá trị trong bộ nhớ theo khoá (device, metric, bucket, bucket_start)
+    để mỗi lần flush chỉ upsert mỗi khoá đúng 1 lần."""
+
+    def __init__(self):
+        self.aggs: dict[tuple, list] = {}
+
+    def __len__(self):
+        return len(self.aggs)
+
+    def add_value(self, device_uid: str, metric: str, ts: datetime, value: float):
+        for name, seconds in BUCKETS.items():
+            key = (device_uid, metric, name, bucket_start(ts, seconds))
+            a = self.aggs.get(key)
+            if a is None:
+                self.aggs[key] = [value, value, value, 1, value, ts]
+                continue
+            a[0] = min(a[0], value)
+            a[1] = max(a[1], value)
+            a[2] += value
+            a[3] += 1
+            if ts >= a[5]:
+                a[4], a[5] = value, ts
+
+    def add_payload(self, device_uid: str, ts: datetime, payload: dict):
+        for metric, value in numeric_fields(payload).items():
+            self.add_value(device_uid, metric, ts, value)
+
+    def rows(self) -> list[dict]:
+        # sắp xếp khoá → các transaction khoá dòng theo cùng thứ tự, tránh deadlock
+        return [
+            {
+                "device_uid": k[0], "metric": k[1], "bucket": k[2], "bucket_start": k[3],
+                "min": a[0], "max": a[1], "sum": a[2], "count": a[3], "last": a[4], "last_ts": a[5],
+            }
+            for k, a in sorted(self.aggs.items())
+        ]
+
+async def upsert_rollups(db: AsyncSession, acc: RollupAccumulator):
+    """Cộng dồn vào `telemetry_rollups` bằng `INSERT ... ON CONFLICT DO UPDATE`. Không commit."""
+    rows = acc.rows()
+    t = TelemetryRollup.__table__
+    for i in range(0, len(rows), UPSERT_CHUNK):
+        stmt = pg_insert(TelemetryRollup).values(rows[i:i + UPSERT_CHUNK])
+        ex = stmt.excluded
+        newer = ex.last_ts >= t.c.last_ts
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["device_uid", "metric", "bucket", "bucket_start"],
+            set_={
+                "min": func.least(t.c.min, ex.min),
+                "max": func.greatest(t.c.max, ex.max),
+                "sum": t.c.sum + ex.sum,
+                "count": t.c.count + ex.count,
+                "last": case((newer, ex.last), else_=t.c.last),
+                "last_ts": func.greatest(t.c.last_ts, ex.last_ts),
+            },
+        )
+        await db.execute(stmt)
+
+def merge_points(rows, resolution: int) -> list[dict]:
+    """Gộp các dòng rollup (đã sắp theo bucket_start) thành điểm có độ dài `resolution` giây."""
+    points: list[dict] = []
+    for r in rows:
+        start = bucket_start(r.bucket_start, resolution)
+        p = points[-1] if points and points[-1]["ts"] == start else None
+        if p is None:
+            points.append({"ts": start, "min": r.min, "max": r.max, "sum": r.sum, "count": r.count, "last": r.last})
+            continue
+        p["min"] = min(p["min"], r.min)
+        p["max"] = max(p["max"], r.max)
+        p["sum"] += r.sum
+        p["count"] += r.count
+        p["last"] = r.last
+    for p in points:
+        p["avg"] = p.pop("sum") / p["count"] if p["count"] else None
+        p["ts"] = p["ts"].isoformat()
+    return points
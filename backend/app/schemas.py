@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import Any, Dict
+from pydantic import BaseModel, EmailStr, Field
+from typing import Any, Dict, List, Literal
+from datetime import datetime
 
 class LoginIn(BaseModel):
     email: EmailStr
@@ -8,6 +9,7 @@ class LoginIn(BaseModel):
 class TokenOut(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    device_secret: str | None = None  # chỉ khi đăng ký thiết bị mới (trả đúng 1 lần)
 
 class TelemetryOut(BaseModel):
     device_uid: str
@@ -33,6 +35,7 @@ class DeviceRegisterIn(BaseModel):
 class TelemetryIn(BaseModel):
     msg_id: str | None = None
     payload: Dict[str, Any]
+    ts: datetime | None = None  # thời điểm đo (thiết bị gửi bù); mặc định lúc server nhận
 
 class CommandQueueOut(BaseModel):
     id: int
@@ -41,8 +44,74 @@ class CommandQueueOut(BaseModel):
     status: str
     created_at: str | None = None
 
+class CommandAckIn(BaseModel):
+    ids: List[int]
+
 class FirmwareCheckOut(BaseModel):
     update_available: bool
     current_version: str
     latest_version: str
     url: str | None = None
+    sha256: str | None = None
+    size: int | None = None
+
+class FirmwareReleaseOut(BaseModel):
+    version: str
+    channel: str
+    tenant: str | None = None
+    sha256: str
+    size: int
+    rollout_percent: int
+    notes: str | None = None
+    published_at: datetime | None = None
+
+class FirmwarePublishIn(BaseModel):
+    """Phát hành / đổi tỉ lệ rollout (0–100 % thiết bị của kênh)."""
+    rollout_percent: int = Field(100, ge=0, le=100)
+
+class FirmwareChannelIn(BaseModel):
+    channel: str | None = None  # thiết bị: None = theo kênh của tenant
+
+class FanoutIn(BaseModel):
+    """Gửi 1 lệnh tới nhiều thiết bị.
+
+    Chọn thiết bị theo `device_uids`, `tenant`, `uid_prefix` (kết hợp AND, cần ít nhất 1 điều kiện).
+    """
+    cmd: str
+    params: Dict[str, Any] | None = None
+    device_uids: List[str] | None = None
+    tenant: str | None = None
+    uid_prefix: str | None = None
+
+class FanoutJobOut(BaseModel):
+    job_id: str
+    total: int
+    counts: Dict[str, int] = {}
+    devices: List[Dict[str, Any]] | None = None
+
+class AlertRuleIn(BaseModel):
+    """Luật cảnh báo, ví dụ "temp_c > 30 trong 60 s → led_on":
+
+    {
+        "name": "hot", "device_uid": "dev-01", "metric": "data.temp_c",
+        "op": ">", "threshold": 30, "for_seconds": 60, "action_cmd": "led_on"
+    }
+
+    `device_uid` bỏ trống = mọi thiết bị; `kind: "rate"` so tốc độ thay đổi (đơn vị/giây).
+    """
+    name: str
+    device_uid: str | None = None
+    metric: str
+    kind: Literal["threshold", "rate"] = "threshold"
+    op: Literal[">", ">=", "<", "<=", "==", "!="]
+    threshold: float
+    for_seconds: float = Field(0, ge=0)
+    cooldown_seconds: float = Field(300, ge=0)
+    action_cmd: str
+    action_params: Dict[str, Any] | None = None
+    action_device_uid: str | None = None
+    enabled: bool = True
+
+class AlertRuleOut(AlertRuleIn):
+    id: int
+    updated_at: datetime | None = None
@@ -0,0 +1,51 @@
+import os
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+# chỉ nạp giá trị mới nhất trong cửa sổ này khi khởi động (0 = toàn bộ lịch sử)
+WARM_HOURS = int(os.getenv("SHADOW__WARM_HOURS", "168"))
+
+class DeviceShadow:
+    """Giá trị mới nhất của từng thiết bị (payload, ts, msg_id) giữ trong bộ nhớ.
+
+    Cập nhật từ feed MQTT + ingest HTTP; chỉ ghi đè khi `ts` mới hơn để dữ liệu
+    nạp từ DB lúc khởi động không đè lên message vừa nhận.
+    """
+
+    def __init__(self):
+        self._latest: dict[str, dict] = {}
+        self.warmed = False
+
+    def __len__(self):
+        return len(self._latest)
+
+    def update(self, device_uid: str, msg_id: str, payload: dict, ts: datetime):
+        cur = self._latest.get(device_uid)
+        if cur is not None and cur["_ts"] > ts:
+            return
+        self._latest[device_uid] = {"device_uid": device_uid, "msg_id": msg_id, "payload": payload, "ts": ts.isoformat(), "_ts": ts}
+
+    def get(self, device_uid: str) -> dict | None:
+        cur = self._latest.get(device_uid)
+        return _public(cur) if cur else None
+
+    def get_many(self, device_uids: list[str]) -> list[dict]:
+        return [_public(self._latest[uid]) for uid in device_uids if uid in self._latest]
+
+    async def warm(self, db: AsyncSession, hours: int = WARM_HOURS):
+        """Nạp bản ghi mới nhất mỗi thiết bị bằng 1 câu `DISTINCT ON`."""
+        where = "WHERE ts >= now() - make_interval(hours => :hours)" if hours > 0 else ""
+        res = await db.execute(text(f"""
+            SELECT DISTINCT ON (device_uid) device_uid, msg_id, payload, ts
+            FROM telemetry {where}
+            ORDER BY device_uid, ts DESC, id DESC
+        """), {"hours": hours} if hours > 0 else {})
+        for uid, msg_id, payload, ts in res.all():
+            self.update(uid, msg_id, payload, ts)
+        self.warmed = True
+
+def _public(entry: dict) -> dict:
+    return {k: v for k, v in entry.items() if k != "_ts"}
+
+shadow = DeviceShadow()
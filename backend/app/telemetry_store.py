@@ -0,0 +1,115 @@
+import os, json
+from datetime import datetime, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, bindparam, String, DateTime, Float
+from sqlalchemy.dialects.postgresql import ARRAY
+from .fields import numeric_fields, METRIC_FIELDS
+from .instrumentation import Counter
+from .rollups import RollupAccumulator, upsert_rollups
+
+# ghi các lá số/bool của payload vào `telemetry_metrics` cùng transaction với telemetry
+METRICS_ENABLED = os.getenv("METRICS__ENABLED", "1") not in ("0", "false", "no")
+# cập nhật bảng telemetry_rollups (1m/1h/1d) cùng transaction với telemetry
+ROLLUPS_ENABLED = os.getenv("ROLLUP__ENABLED", "1") not in ("0", "false", "no")
+
+# caller tăng sau khi commit: persisted | duplicate | failed (dòng lỗi dữ liệu, vào dead-letter)
+WRITES = Counter("telemetry_messages", "Telemetry messages by write result", ("result",))
+# giá trị không vào `telemetry_metrics` vì đã có giá trị cùng (device_uid, metric, ts) – 2 message
+# khác msg_id trùng ts; telemetry vẫn giữ cả 2 payload. Đếm lúc ghi (batch rollback rồi ghi lại
+# có thể đếm 2 lần).
+METRIC_CONFLICTS = Counter("telemetry_metric_conflicts", "Metric values dropped: same device, metric and ts already stored")
+
+# 1 câu lệnh: ghi khoá (device_uid, msg_id, ts) vào telemetry_msg_ids (chống trùng), chỉ dòng có khoá mới
+# được ghi vào telemetry. Input truyền bằng mảng → số bind params cố định dù batch lớn.
+_INSERT_SQL = text("""
+WITH input AS (
+    SELECT * FROM unnest(:uids, :msg_ids, :payloads, :tss) AS i(device_uid, msg_id, payload, ts)
+), fresh AS (
+    INSERT INTO telemetry_msg_ids (device_uid, msg_id, ts)
+    SELECT device_uid, msg_id, ts FROM input
+    ON CONFLICT DO NOTHING
+    RETURNING device_uid, msg_id
+)
+INSERT INTO telemetry (device_uid, msg_id, payload, ts)
+SELECT i.device_uid, i.msg_id, i.payload::json, i.ts
+FROM input i JOIN fresh f ON f.device_uid = i.device_uid AND f.msg_id = i.msg_id
+ON CONFLICT DO NOTHING
+RETURNING device_uid, msg_id
+""").bindparams(
+    bindparam("uids", type_=ARRAY(String)),
+    bindparam("msg_ids", type_=ARRAY(String)),
+    bindparam("payloads", type_=ARRAY(String)),
+    bindparam("tss", type_=ARRAY(DateTime(timezone=True))),
+)
+
+_METRICS_SQL = text("""
+WITH ins AS (
+    INSERT INTO telemetry_metrics (device_uid, metric, ts, value)
+    SELECT * FROM unnest(:uids, :metrics, :tss, :vals)
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+)
+SELECT count(*) FROM ins
+""").bindparams(
+    bindparam("uids", type_=ARRAY(String)),
+    bindparam("metrics", type_=ARRAY(String)),
+    bindparam("tss", type_=ARRAY(DateTime(timezone=True))),
+    bindparam("vals", type_=ARRAY(Float)),
+)
+
+async def insert_metrics(db: AsyncSession, rows: list[dict], patterns: list[str] = METRIC_FIELDS) -> tuple[int, int]:
+    """Trích lá số/bool (khớp `patterns`) của từng payload vào `telemetry_metrics`. Không commit.
+
+    Trả về (số giá trị trích được, số dòng thực sự ghi); chênh lệch là giá trị trùng
+    `(device_uid, metric, ts)` đã có (PK), bị bỏ qua.
+    """
+    uids, metrics, tss, vals = [], [], [], []
+    for r in rows:
+        if not isinstance(r["payload"], dict):
+            continue
+        for metric, value in numeric_fields(r["payload"], patterns, include_bool=True).items():
+            uids.append(r["device_uid"])
+            metrics.append(metric)
+            tss.append(r["ts"])
+            vals.append(value)
+    if not uids:
+        return 0, 0
+    res = await db.execute(_METRICS_SQL, {"uids": uids, "metrics": metrics, "tss": tss, "vals": vals})
+    return len(uids), res.scalar_one()
+
+async def insert_telemetry(db: AsyncSession, rows: list[dict], metrics: bool = METRICS_ENABLED, rollups: bool = ROLLUPS_ENABLED) -> set[tuple[str, str]]:
+    """Ghi nhiều dòng telemetry, bỏ qua dòng trùng `(device_uid, msg_id)`.
+
+    `rows`: list dict có `device_uid`, `msg_id`, `payload` và `ts` (tuỳ chọn, mặc định now).
+    Trả về tập `(device_uid, msg_id)` thực sự được ghi (phần còn lại là duplicate).
+    `metrics`: ghi luôn giá trị đã trích vào `telemetry_metrics` (chỉ cho dòng mới).
+    `rollups`: cộng dòng mới vào `telemetry_rollups` – mọi đường ghi (MQTT, HTTP) đi qua đây.
+    Không commit – caller tự quản lý transaction.
+    """
+    # bỏ trùng ngay trong batch (giữ bản đầu tiên) để kết quả trả về khớp input
+    unique: dict[tuple[str, str], dict] = {}
+    for r in rows:
+        unique.setdefault((r["device_uid"], r["msg_id"]), r)
+    if not unique:
+        return set()
+    now = datetime.now(timezone.utc)
+    values = [{**r, "ts": r.get("ts") or now} for r in unique.values()]
+    res = await db.execute(_INSERT_SQL, {
+        "uids": [r["device_uid"] for r in values],
+        "msg_ids": [r["msg_id"] for r in values],
+        "payloads": [json.dumps(r["payload"]) for r in values],
+        "tss": [r["ts"] for r in values],
+    })
+    inserted = {(uid, mid) for uid, mid in res.all()}
+    fresh = [r for r in values if (r["device_uid"], r["msg_id"]) in inserted]
+    if metrics and fresh:
+        extracted, written = await insert_metrics(db, fresh)
+        if written < extracted:
+            METRIC_CONFLICTS.inc(extracted - written)
+    if rollups and fresh:
+        acc = RollupAccumulator()
+        for r in fresh:
+            if isinstance(r["payload"], dict):
+                acc.add_payload(r["device_uid"], r["ts"], r["payload"])
+        await upsert_rollups(db, acc)
+    return inserted
@@ -0,0 +1,33 @@
+"""Benchmark: chi phí xác thực JWT mỗi request, có và không có cache token đã verify.
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://a:b@localhost/x python -m bench.auth_cache --tokens 1000
+
+`--tokens` token khác nhau được dùng xoay vòng (như nhiều user/thiết bị cùng gọi API);
+cache nhỏ hơn số token → đo cả trường hợp LRU bị đẩy ra liên tục.
+"""
+import argparse, time
+from app import auth
+
+def run(tokens: list[str], n: int, verify) -> float:
+    start = time.perf_counter()
+    for i in range(n):
+        verify(tokens[i % len(tokens)])
+    return (time.perf_counter() - start) / n * 1e6
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tokens", type=int, default=1000)
+    ap.add_argument("-n", type=int, default=50_000)
+    args = ap.parse_args()
+
+    users = [auth.create_token(f"user{i}@example.com") for i in range(args.tokens)]
+    devices = [auth.create_device_token(f"dev-{i}") for i in range(args.tokens)]
+    for label, tokens, verify in (("user", users, auth.verify_user_token), ("device", devices, auth.verify_device_token)):
+        for size in (0, args.tokens // 2, auth.TOKEN_CACHE_SIZE):
+            auth.token_cache = auth.TokenCache(size)
+            us = run(tokens, args.n, verify)
+            print(f"{label:<7} cache={size:<6} {us:8.1f} us/verify")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Benchmark: chi phí decode và số byte trên đường truyền của JSON / CBOR / MessagePack.
+
+Không cần DB hay broker:
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://x:x@localhost/x \\
+        python -m bench.codec_bench --messages 100000
+
+Payload giống `sim_device.py`. Đo `decode_telemetry` (đường ingestor thật, gồm tách topic
+và chuẩn hoá kiểu) và decode thuần của codec. Codec chưa cài thư viện được bỏ qua.
+"""
+import argparse, random, time
+from app.codecs import CODECS, KNOWN
+from app.messages import decode_telemetry
+
+def make_payloads(n: int) -> list[dict]:
+    return [
+        {
+            "msg_id": f"{i:08d}",
+            "ts": 1700000000 + i,
+            "data": {"temp_c": round(24 + random.random() * 3, 2), "humidity": random.randint(30, 90), "led": bool(i % 2)},
+        }
+        for i in range(n)
+    ]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=100000)
+    args = ap.parse_args()
+
+    payloads = make_payloads(args.messages)
+    missing = [name for name in KNOWN if name not in CODECS]
+    print(f"messages={args.messages}" + (f"  (skipped, not installed: {', '.join(missing)})" if missing else ""))
+    print(f"{'codec':<8} {'bytes/msg':>10} {'decode µs':>10} {'ingest µs':>10}")
+    base = None
+    for name, codec in CODECS.items():
+        encoded = [codec.encode(p) for p in payloads]
+        size = sum(len(e) for e in encoded) / len(encoded)
+        topic = "t0/devices/bench-0001/telemetry" + ("" if name == "json" else f"/{name}")
+
+        start = time.perf_counter()
+        for e in encoded:
+            codec.decode(e)
+        raw = (time.perf_counter() - start) / len(encoded) * 1e6
+
+        start = time.perf_counter()
+        for e in encoded:
+            decode_telemetry(topic, e)
+        full = (time.perf_counter() - start) / len(encoded) * 1e6
+
+        base = base or size
+        print(f"{name:<8} {size:>10.1f} {raw:>10.2f} {full:>10.2f}   ({size / base:.0%} of JSON bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark: chi phí của instrumentation (app/instrumentation.py) – không cần hạ tầng.
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://a:b@localhost/x python -m bench.metrics_overhead
+
+- ns/lần cho `Counter.inc`, `Counter.labels(..).inc`, `Histogram.observe`.
+- Request HTTP qua ASGI (không socket) tới 1 app FastAPI nhỏ, có và không có `MetricsMiddleware`.
+- Câu SQL trên engine sqlite (sync, in-memory), có và không có event của `instrument_engine`.
+"""
+import argparse, asyncio, time
+from fastapi import FastAPI
+from sqlalchemy import create_engine, text
+from app.instrumentation import Registry, Counter, Histogram, MetricsMiddleware, instrument_engine
+
+def ns_per_op(fn, n: int) -> float:
+    start = time.perf_counter_ns()
+    fn(n)
+    return (time.perf_counter_ns() - start) / n
+
+def bench_primitives(n: int):
+    reg = Registry()
+    c = Counter("c", "", registry=reg)
+    cl = Counter("cl", "", ("result",), registry=reg)
+    h = Histogram("h", "", ("verb",), registry=reg)
+
+    def baseline(n):
+        for _ in range(n):
+            pass
+
+    def counter(n):
+        for _ in range(n):
+            c.inc()
+
+    def counter_labels(n):
+        for _ in range(n):
+            cl.labels("ok").inc()
+
+    def histogram(n):
+        for i in range(n):
+            h.labels("SELECT").observe(i * 1e-6)
+
+    base = ns_per_op(baseline, n)
+    for name, fn in (("counter.inc", counter), ("counter.labels().inc", counter_labels), ("histogram.labels().observe", histogram)):
+        print(f"{name:<28} {ns_per_op(fn, n) - base:8.0f} ns/op")
+
+def make_app(instrumented: bool):
+    app = FastAPI()
+
+    @app.get("/telemetry/{device_uid}")
+    async def get_telemetry(device_uid: str):
+        return {"device_uid": device_uid}
+
+    if instrumented:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+async def call(app, path: str):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"", "headers": [], "client": ("127.0.0.1", 1), "server": ("test", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+async def bench_http(n: int):
+    res = {}
+    for instrumented in (False, True, False, True):  # xen kẽ để giảm nhiễu warm-up
+        app = make_app(instrumented)
+        await call(app, "/telemetry/warm")
+        start = time.perf_counter_ns()
+        for i in range(n):
+            await call(app, f"/telemetry/dev-{i % 100}")
+        res[instrumented] = (time.perf_counter_ns() - start) / n
+    print(f"{'http request (no metrics)':<28} {res[False] / 1000:8.1f} us")
+    print(f"{'http request (middleware)':<28} {res[True] / 1000:8.1f} us  (+{(res[True] - res[False]) / 1000:.1f} us)")
+
+def bench_sql(n: int):
+    res = {}
+    for instrumented in (False, True, False, True):
+        engine = create_engine("sqlite://")
+        if instrumented:
+            instrument_engine(engine, registry=Registry())
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER)"))
+            conn.execute(text("INSERT INTO t (v) VALUES (1)"))
+            stmt = text("SELECT v FROM t WHERE id = 1")
+            start = time.perf_counter_ns()
+            for _ in range(n):
+                conn.execute(stmt).all()
+            res[instrumented] = (time.perf_counter_ns() - start) / n
+        engine.dispose()
+    print(f"{'sql query (no events)':<28} {res[False] / 1000:8.1f} us")
+    print(f"{'sql query (instrumented)':<28} {res[True] / 1000:8.1f} us  (+{(res[True] - res[False]) / 1000:.1f} us)")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=200_000, help="số lần cho phép đo primitive")
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--queries", type=int, default=20000)
+    args = ap.parse_args()
+    bench_primitives(args.n)
+    asyncio.run(bench_http(args.requests))
+    bench_sql(args.queries)
+
+if __name__ == "__main__":
+    main()
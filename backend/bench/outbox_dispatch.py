@@ -0,0 +1,149 @@
+"""Benchmark: `POST /devices/{uid}/command/store` kiểu cũ (commit → publish → commit trong request)
+so với outbox (1 commit trong request, dispatcher publish theo lô) – DB và broker giả lập.
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://a:b@localhost/x python -m bench.outbox_dispatch --commands 5000
+
+`--commit-ms`: thời gian 1 commit; `--puback-ms`: thời gian chờ PUBACK; `--outage`: broker mất
+kết nối `--outage` giây ở giữa bài đo (request kiểu cũ chờ/timeout, outbox vẫn nhận lệnh).
+"""
+import argparse, asyncio, time
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from app import outbox
+
+class Broker:
+    def __init__(self, puback_ms: float):
+        self.puback = puback_ms / 1000
+        self.down_until = 0.0
+        self.published = 0
+
+    async def publish(self, device_uid: str, payload: dict):
+        if time.monotonic() < self.down_until:
+            await asyncio.sleep(0.05)
+            raise ConnectionError("broker down")
+        await asyncio.sleep(self.puback)
+        self.published += 1
+
+class FakeResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+class FakeDb:
+    """Bảng command_queue trong RAM; commit tốn `commit_ms`."""
+
+    def __init__(self, commit_ms: float):
+        self.commit = commit_ms / 1000
+        self.rows: dict[int, SimpleNamespace] = {}
+        self.next_id = 1
+
+    def insert(self, device_uid: str) -> int:
+        i, self.next_id = self.next_id, self.next_id + 1
+        self.rows[i] = SimpleNamespace(id=i, device_uid=device_uid, cmd="ping", params=None,
+                                       status="pending", publish_attempts=0, created_at=datetime.now(timezone.utc))
+        return i
+
+    def session(self):
+        db = self
+
+        class Session:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                pass
+
+            async def execute(self, stmt, params=None):
+                sql = str(stmt)
+                if "claimed" in sql:
+                    rows = [r for r in db.rows.values() if r.status == "pending"][: params["batch"]]
+                    for r in rows:
+                        r.status, r.publish_attempts = "sending", r.publish_attempts + 1
+                    return FakeResult(rows)
+                if "'sent'" in sql:
+                    for i in params["ids"]:
+                        db.rows[i].status = "sent"
+                elif "'failed'" in sql:
+                    for i in params["ids"]:
+                        db.rows[i].status = "failed" if i in params["rejected"] else "pending"
+                    return FakeResult([(db.rows[i].status,) for i in params["ids"]])
+                return FakeResult([])
+
+            async def commit(self):
+                await asyncio.sleep(db.commit)
+
+            async def rollback(self):
+                pass
+
+        return Session()
+
+def pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+async def run(mode: str, args) -> None:
+    broker, db = Broker(args.puback_ms), FakeDb(args.commit_ms)
+    latencies, errors = [], 0
+    dispatcher = None
+    if mode == "outbox":
+        outbox.SessionLocal = db.session
+        outbox.publish_command = broker.publish
+        dispatcher = outbox.OutboxDispatcher(batch=args.batch, interval=0.05)
+        await dispatcher.start()
+
+    async def request(n: int):
+        nonlocal errors
+        uid = f"dev-{n % args.devices}"
+        start = time.perf_counter()
+        try:
+            if mode == "inline":
+                i = db.insert(uid)
+                await asyncio.sleep(db.commit)
+                await asyncio.wait_for(broker.publish(uid, {}), 5)
+                db.rows[i].status = "sent"
+                await asyncio.sleep(db.commit)
+            else:
+                db.insert(uid)
+                await asyncio.sleep(db.commit)
+                dispatcher.wake()
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+
+    period = 1 / args.rate
+    start = time.monotonic()
+    tasks = []
+    for n in range(args.commands):
+        if args.outage and n == args.commands // 2:
+            broker.down_until = time.monotonic() + args.outage
+        tasks.append(asyncio.create_task(request(n)))
+        await asyncio.sleep(max(0.0, start + (n + 1) * period - time.monotonic()))
+    await asyncio.gather(*tasks)
+    deadline = time.monotonic() + 60
+    while any(r.status == "pending" for r in db.rows.values()) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - start
+    if dispatcher is not None:
+        await dispatcher.stop()
+    sent = sum(1 for r in db.rows.values() if r.status == "sent")
+    print(f"{mode:<7} request p50 {pct(latencies, 0.5):7.1f} ms  p99 {pct(latencies, 0.99):7.1f} ms  "
+          f"errors {errors:5d}  sent {sent}/{args.commands} in {elapsed:.1f}s")
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--commands", type=int, default=5000)
+    ap.add_argument("--rate", type=float, default=1000, help="request/s")
+    ap.add_argument("--devices", type=int, default=500)
+    ap.add_argument("--commit-ms", type=float, default=2)
+    ap.add_argument("--puback-ms", type=float, default=5)
+    ap.add_argument("--batch", type=int, default=outbox.BATCH)
+    ap.add_argument("--outage", type=float, default=0, help="giây broker mất kết nối giữa bài đo")
+    args = ap.parse_args()
+    for mode in ("inline", "outbox"):
+        await run(mode, args)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Benchmark: chi phí đánh giá luật mỗi message của `ingestor/rules.py` (trong RAM, không cần DB).
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://a:b@localhost/x python -m bench.rules_engine --rules 10000 --devices 10000
+
+`--rules` luật chia đều cho `--devices` thiết bị (metric `data.temp_c`, ngưỡng khác nhau,
+nửa là `threshold`, nửa là `rate`) + `--shared` luật cho mọi thiết bị. Mỗi vòng mỗi thiết
+bị gửi 1 payload `{"data": {"temp_c", "hum", "led"}}`. So với quét tuyến tính toàn bộ luật
+và với cùng số thiết bị nhưng chỉ 100 luật (chi phí mỗi message không được tăng theo số luật).
+"""
+import argparse, random, time, tracemalloc
+from ingestor.rules import RuleEngine, Rule
+
+def make_rules(n: int, devices: int, shared: int) -> list[Rule]:
+    rnd = random.Random(1)
+    rules = []
+    for i in range(n):
+        kind = "threshold" if i % 2 == 0 else "rate"
+        threshold = rnd.uniform(25, 30) if kind == "threshold" else rnd.uniform(0.5, 2)
+        rules.append(Rule(i + 1, f"dev-{i % devices}", "data.temp_c", kind, ">", threshold, 5, 60, "led_on"))
+    for j in range(shared):
+        rules.append(Rule(n + j + 1, None, "data.hum", "threshold", ">", 90, 0, 300, "fan_on"))
+    return rules
+
+def payloads(devices: int, rounds: int):
+    rnd = random.Random(2)
+    for r in range(rounds):
+        for d in range(devices):
+            yield f"dev-{d}", {"msg_id": f"{r}", "data": {"temp_c": 24 + rnd.random() * 7, "hum": 40 + rnd.random() * 55, "led": r % 2 == 0}}, r * 2.0
+
+def run_engine(rules: list[Rule], messages: list, trace: bool = False) -> tuple[float, int, int]:
+    engine = RuleEngine()
+    engine.load(rules)
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    fired = 0
+    for uid, payload, now in messages:
+        fired += engine.evaluate(uid, payload, now)
+    elapsed = time.perf_counter() - start
+    state_bytes = 0
+    if trace:
+        engine._actions.clear()  # chỉ đo trạng thái cửa sổ, không tính hành động chờ ghi
+        state_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return elapsed, fired, state_bytes
+
+def run_linear(rules: list[Rule], messages: list, limit: int) -> float:
+    """Cách ngây thơ: mỗi message duyệt mọi luật, lọc theo thiết bị + metric."""
+    start = time.perf_counter()
+    for uid, payload, _ in messages[:limit]:
+        data = payload["data"]
+        for r in rules:
+            if r.device_uid in (None, uid):
+                value = data.get(r.metric.split(".", 1)[1])
+                if value is not None:
+                    r.test(value, r.threshold)
+    return (time.perf_counter() - start) / limit
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rules", type=int, default=10_000)
+    ap.add_argument("--devices", type=int, default=10_000)
+    ap.add_argument("--shared", type=int, default=5, help="luật áp dụng cho mọi thiết bị")
+    ap.add_argument("--rounds", type=int, default=10, help="số payload mỗi thiết bị")
+    args = ap.parse_args()
+
+    messages = list(payloads(args.devices, args.rounds))
+    for n in (100, args.rules):
+        rules = make_rules(n, args.devices, args.shared)
+        elapsed, fired, _ = run_engine(rules, messages)
+        state = run_engine(rules, messages, trace=True)[2]
+        print(f"indexed  {n:6d}+{args.shared} rules: {elapsed / len(messages) * 1e6:6.2f} us/msg "
+              f"({len(messages) / elapsed:9.0f} msg/s), fired {fired}, state {state / 2**20:.1f} MiB")
+    per_msg = run_linear(make_rules(args.rules, args.devices, args.shared), messages, 2000)
+    print(f"linear   {args.rules:6d}+{args.shared} rules: {per_msg * 1e6:8.1f} us/msg ({1 / per_msg:9.0f} msg/s)")
+
+if __name__ == "__main__":
+    main()
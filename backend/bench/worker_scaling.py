@@ -0,0 +1,101 @@
+"""Benchmark: thông lượng ingest theo số worker (`ingestor.workers.WorkerPool`).
+
+Không cần broker hay Postgres:
+
+    cd backend
+    DATABASE_URL=postgresql+asyncpg://x:x@localhost/x \\
+        python -m bench.worker_scaling --messages 50000 --devices 500 --commit-ms 20
+
+- "Broker" là 1 task bơm message đã decode vào `pool.dispatch()` – giống vòng lặp
+  MQTT trong `ingestor/run.py` sau khi subscribe `$share/<group>/...`.
+- Session DB giả: mỗi câu lệnh tốn `--stmt-ms`, commit tốn `--commit-ms`
+  (mô phỏng round-trip + fsync), nên thông lượng bị chặn bởi I/O chứ không phải CPU.
+- Sau khi chạy, kiểm tra thứ tự ghi của từng thiết bị khớp thứ tự gửi.
+"""
+import argparse, asyncio, time
+from ingestor.workers import WorkerPool
+
+class FakeResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+    def scalar_one(self):
+        return len(self._rows)
+
+class FakeSession:
+    def __init__(self, log: list, stmt_ms: float, commit_ms: float):
+        self.log, self.stmt_ms, self.commit_ms = log, stmt_ms, commit_ms
+        self._pending = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params=None):
+        await asyncio.sleep(self.stmt_ms / 1000)
+        if isinstance(params, dict) and "msg_ids" in params:
+            rows = list(zip(params["uids"], params["msg_ids"]))
+            self._pending.extend(rows)
+            return FakeResult(rows)
+        if isinstance(params, dict) and "metrics" in params:
+            return FakeResult(params["uids"])  # số dòng telemetry_metrics đã ghi
+        return FakeResult([])
+
+    async def commit(self):
+        await asyncio.sleep(self.commit_ms / 1000)
+        self.log.extend(self._pending)
+        self._pending = []
+
+    async def rollback(self):
+        self._pending = []
+
+def check_order(log: list, devices: int) -> bool:
+    last: dict[str, int] = {}
+    for uid, msg_id in log:
+        seq = int(msg_id)
+        if seq <= last.get(uid, -1):
+            return False
+        last[uid] = seq
+    return len(last) == devices
+
+async def run(workers: int, args) -> tuple[float, bool]:
+    log: list = []
+    pool = WorkerPool(
+        workers=workers,
+        session_factory=lambda: FakeSession(log, args.stmt_ms, args.commit_ms),
+        max_batch=args.batch_size,
+        max_delay=args.flush_ms / 1000,
+    )
+    await pool.start(warm=False)
+    start = time.perf_counter()
+    for i in range(args.messages):
+        await pool.dispatch(f"bench-{i % args.devices:05d}", str(i), {"data": {"temp_c": 25.0}})
+    await pool.close()
+    elapsed = time.perf_counter() - start
+    return args.messages / elapsed, len(log) == args.messages and check_order(log, args.devices)
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=50000)
+    ap.add_argument("--devices", type=int, default=500)
+    ap.add_argument("--workers", default="1,2,4,8")
+    ap.add_argument("--batch-size", type=int, default=500)
+    ap.add_argument("--flush-ms", type=int, default=200)
+    ap.add_argument("--stmt-ms", type=float, default=2)
+    ap.add_argument("--commit-ms", type=float, default=20)
+    args = ap.parse_args()
+
+    base = None
+    print(f"messages={args.messages} devices={args.devices} stmt_ms={args.stmt_ms} commit_ms={args.commit_ms}")
+    for n in (int(x) for x in args.workers.split(",")):
+        rate, ordered = await run(n, args)
+        base = base or rate
+        print(f"workers={n:<3} {rate:10.1f} msg/s  (x{rate / base:.1f})  per-device order: {'ok' if ordered else 'BROKEN'}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""Dựng lại `telemetry_metrics` từ payload của các dòng `telemetry` đã có.
+
+    cd backend
+    DATABASE_URL=... python -m ingestor.backfill_metrics --since 2024-01-01 [--until 2024-06-01] [--device dev-01]
+
+Giá trị của khoảng [since, until) bị xoá rồi trích lại theo `METRICS__FIELDS`, nên chạy
+lại nhiều lần không sinh dòng trùng; dùng khi đổi danh sách field hoặc sau khi migrate
+dữ liệu cũ. Mặc định `until` = thời điểm chạy.
+"""
+import argparse, asyncio, time
+from datetime import datetime, timezone
+from sqlalchemy import select, delete
+from app.db import Base, engine, SessionLocal
+from app.models import Telemetry, TelemetryMetric
+from app.telemetry_store import insert_metrics
+from app import partitions
+
+CHUNK = 5000
+
+def _ts(value: str | None) -> datetime:
+    ts = datetime.fromisoformat(value) if value else datetime.now(timezone.utc)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+async def backfill(since: datetime, until: datetime, device_uid: str | None = None) -> int:
+    async with SessionLocal() as db:
+        q = delete(TelemetryMetric).where(TelemetryMetric.ts >= since, TelemetryMetric.ts < until)
+        if device_uid:
+            q = q.where(TelemetryMetric.device_uid == device_uid)
+        await db.execute(q)
+        last_id, total = 0, 0
+        while True:
+            # duyệt theo id (keyset), mỗi chunk 1 câu INSERT
+            q = (
+                select(Telemetry.id, Telemetry.device_uid, Telemetry.ts, Telemetry.payload)
+                .where(Telemetry.ts >= since, Telemetry.ts < until, Telemetry.id > last_id)
+                .order_by(Telemetry.id)
+                .limit(CHUNK)
+            )
+            if device_uid:
+                q = q.where(Telemetry.device_uid == device_uid)
+            rows = (await db.execute(q)).all()
+            if not rows:
+                break
+            await insert_metrics(db, [{"device_uid": r.device_uid, "ts": r.ts, "payload": r.payload} for r in rows])
+            last_id, total = rows[-1].id, total + len(rows)
+        await db.commit()
+        return total
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--since", required=True, help="ISO date/time (không có múi giờ = UTC)")
+    ap.add_argument("--until", help="ISO date/time (mặc định: bây giờ)")
+    ap.add_argument("--device", help="chỉ backfill 1 device_uid")
+    args = ap.parse_args()
+
+    since, until = _ts(args.since), _ts(args.until)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # dữ liệu cũ hơn partition sớm nhất cần có partition tương ứng trước khi ghi
+        if await partitions.is_partitioned(conn, "telemetry_metrics"):
+            period = partitions.period_start(since)
+            while period < until:
+                await partitions.create_partition(conn, period, table="telemetry_metrics")
+                period = partitions.next_period(period)
+    start = time.perf_counter()
+    total = await backfill(since, until, args.device)
+    print(f"extracted metrics from {total} telemetry rows [{since.isoformat()} → {until.isoformat()}) in {time.perf_counter() - start:.1f}s")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
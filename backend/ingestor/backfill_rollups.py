@@ -0,0 +1,72 @@
+"""Dựng lại `telemetry_rollups` từ các dòng `telemetry` đã có.
+
+    cd backend
+    DATABASE_URL=... python -m ingestor.backfill_rollups --since 2024-01-01 [--until 2024-06-01] [--device dev-01]
+
+`since`/`until` được làm tròn xuống đầu ngày (UTC) để mọi bucket 1m/1h/1d trong
+khoảng được phủ trọn; rollup cũ của các bucket đó bị xoá rồi tính lại, nên chạy
+lại nhiều lần không bị cộng trùng. Mặc định `until` = 00:00 UTC hôm nay: phần
+từ hôm nay trở đi do ingestor cập nhật trực tiếp.
+"""
+import argparse, asyncio, time
+from datetime import datetime, timezone
+from sqlalchemy import select, delete
+from app.db import Base, engine, SessionLocal
+from app.models import Telemetry, TelemetryRollup
+from app.rollups import RollupAccumulator, upsert_rollups, bucket_start, BUCKETS
+
+CHUNK = 5000
+
+def _day(value: str | None) -> datetime:
+    ts = datetime.fromisoformat(value) if value else datetime.now(timezone.utc)
+    return bucket_start(ts, BUCKETS["1d"])
+
+async def backfill(since: datetime, until: datetime, device_uid: str | None = None) -> int:
+    async with SessionLocal() as db:
+        q = delete(TelemetryRollup).where(TelemetryRollup.bucket_start >= since, TelemetryRollup.bucket_start < until)
+        if device_uid:
+            q = q.where(TelemetryRollup.device_uid == device_uid)
+        await db.execute(q)
+        acc = RollupAccumulator()
+        last_id, total = 0, 0
+        while True:
+            # duyệt theo id (keyset) để bộ nhớ không phụ thuộc số dòng
+            q = (
+                select(Telemetry.id, Telemetry.device_uid, Telemetry.ts, Telemetry.payload)
+                .where(Telemetry.ts >= since, Telemetry.ts < until, Telemetry.id > last_id)
+                .order_by(Telemetry.id)
+                .limit(CHUNK)
+            )
+            if device_uid:
+                q = q.where(Telemetry.device_uid == device_uid)
+            rows = (await db.execute(q)).all()
+            if not rows:
+                break
+            for r in rows:
+                if isinstance(r.payload, dict):
+                    acc.add_payload(r.device_uid, r.ts, r.payload)
+            last_id, total = rows[-1].id, total + len(rows)
+            if len(acc) > 50000:
+                await upsert_rollups(db, acc)
+                acc = RollupAccumulator()
+        await upsert_rollups(db, acc)
+        await db.commit()
+        return total
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--since", required=True, help="ISO date/time, làm tròn xuống đầu ngày UTC")
+    ap.add_argument("--until", help="ISO date/time (mặc định: hôm nay 00:00 UTC)")
+    ap.add_argument("--device", help="chỉ backfill 1 device_uid")
+    args = ap.parse_args()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    since, until = _day(args.since), _day(args.until)
+    start = time.perf_counter()
+    total = await backfill(since, until, args.device)
+    print(f"backfilled {total} telemetry rows [{since.isoformat()} → {until.isoformat()}) in {time.perf_counter() - start:.1f}s")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
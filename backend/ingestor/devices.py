@@ -0,0 +1,70 @@
+import os
+from collections import OrderedDict
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import select
+from app.models import Device
+
+DEVICE_CACHE_SIZE = int(os.getenv("INGEST__DEVICE_CACHE_SIZE", "100000"))
+
+class KnownDevices:
+    """Tập device_uid đã chắc chắn tồn tại trong bảng `devices` (LRU, giới hạn kích thước).
+
+    Device đã biết → bỏ qua SELECT/INSERT devices khi ghi telemetry.
+    Bị evict chỉ tốn thêm 1 lần `INSERT ... ON CONFLICT DO NOTHING`, không sai dữ liệu.
+    """
+
+    def __init__(self, max_size: int = DEVICE_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._uids: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __contains__(self, device_uid: str):
+        return device_uid in self._uids
+
+    def unknown(self, device_uids) -> set[str]:
+        """Lọc ra uid chưa biết; uid đã biết được đẩy lên đầu LRU."""
+        missing = set()
+        for uid in device_uids:
+            if uid in self._uids:
+                self._uids.move_to_end(uid)
+            else:
+                missing.add(uid)
+        return missing
+
+    def add_many(self, device_uids):
+        for uid in device_uids:
+            self._uids[uid] = None
+            self._uids.move_to_end(uid)
+        while len(self._uids) > self.max_size:
+            self._uids.popitem(last=False)
+
+    def discard_many(self, device_uids):
+        for uid in device_uids:
+            self._uids.pop(uid, None)
+
+    async def warm(self, db: AsyncSession):
+        """Nạp sẵn device mới nhất (tối đa `max_size`) khi khởi động."""
+        res = await db.execute(
+            select(Device.device_uid).order_by(Device.id.desc()).limit(self.max_size)
+        )
+        # thêm từ cũ → mới để device mới nhất nằm cuối LRU
+        self.add_many(reversed(res.scalars().all()))
+
+async def provision_devices(db: AsyncSession, device_uids: set[str]):
+    """Tạo device còn thiếu bằng 1 câu `INSERT ... ON CONFLICT (device_uid) DO NOTHING`.
+
+    An toàn khi nhiều ingestor cùng thấy 1 device mới: instance đến sau chờ
+    transaction kia commit rồi bỏ qua dòng trùng thay vì lỗi unique.
+    """
+    if not device_uids:
+        return
+    stmt = (
+        pg_insert(Device)
+        # sắp xếp để các instance khoá dòng theo cùng thứ tự → tránh deadlock
+        .values([{"device_uid": uid, "name": uid} for uid in sorted(device_uids)])
+        .on_conflict_do_nothing(index_elements=["device_uid"])
+    )
+    await db.execute(stmt)
@@ -0,0 +1,259 @@
+"""Rules engine trong đường ingest: đánh giá `alert_rules` trên từng dòng telemetry vừa được
+`BatchWriter` commit (chỉ dòng thực sự insert – bỏ duplicate và dòng vào dead-letter).
+
+- Luật được index theo (device_uid, metric) và metric (luật cho mọi thiết bị) → chi phí mỗi
+  message tỉ lệ với số field của payload và số luật khớp, không với tổng số luật. Thiết bị
+  không có luật riêng và không có luật chung → bỏ qua luôn, không duyệt payload.
+- Trạng thái cửa sổ (điều kiện đúng từ lúc nào, đã bắn chưa, mẫu trước cho luật `rate`) giữ
+  trong RAM theo (luật, thiết bị); thời gian là `ts` của dòng (lúc ingestor nhận message). Restart → đếm lại.
+  Trạng thái không có mẫu mới quá `max(for_seconds, cooldown)` + `RULES__STATE_IDLE_SECONDS`
+  bị bỏ (thiết bị im lặng lâu như vậy bắt đầu lần đếm mới) → luật chung cho mọi thiết bị
+  không làm bộ nhớ tăng theo mọi thiết bị từng thấy.
+- Hành động đi đúng đường command có sẵn: ghi `command_queue` (status `pending`,
+  `job_id` = `rule:<id>`) theo lô, dispatcher outbox (`app/outbox.py`) publish MQTT. DB lỗi →
+  giữ lại để ghi lần sau, tối đa `RULES__MAX_PENDING` hành động; vượt thì bỏ hành động cũ nhất
+  (`rules_fired_total{result="dropped"}`).
+- Luật nạp lại từ DB mỗi `RULES__REFRESH_SECONDS` khi bảng thay đổi (CRUD qua API `/rules`).
+
+Chỉ telemetry MQTT đi qua ingestor; telemetry gửi bằng HTTP không được đánh giá. Nhiều ingestor
+với shared subscription: mọi message của 1 thiết bị phải về cùng instance (`hash_clientid`).
+"""
+import os, json, math, time, asyncio, logging, operator
+from collections import OrderedDict, deque
+from sqlalchemy import text, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.db import SessionLocal
+from app.fields import flatten, finite_float
+from app.instrumentation import Counter, GaugeFunc
+
+RULES_ENABLED = os.getenv("RULES__ENABLED", "1") not in ("0", "false", "no")
+REFRESH_SECONDS = float(os.getenv("RULES__REFRESH_SECONDS", "10"))
+FLUSH_SECONDS = float(os.getenv("RULES__FLUSH_SECONDS", "0.5"))
+STATE_IDLE_SECONDS = float(os.getenv("RULES__STATE_IDLE_SECONDS", "600"))
+MAX_PENDING = int(os.getenv("RULES__MAX_PENDING", "10000"))
+
+OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq, "!=": operator.ne}
+KINDS = ("threshold", "rate")
+
+FIRED = Counter("rules_fired", "Alert rule actions by result", ("result",))
+
+log = logging.getLogger(__name__)
+
+_INSERT_SQL = text("""
+INSERT INTO command_queue (device_uid, cmd, params, status, job_id)
+SELECT a.device_uid, a.cmd, a.params::json, 'pending', a.job_id
+FROM unnest(:uids, :cmds, :params, :jobs) AS a(device_uid, cmd, params, job_id)
+JOIN devices d ON d.device_uid = a.device_uid
+""").bindparams(
+    bindparam("uids", type_=ARRAY(String)),
+    bindparam("cmds", type_=ARRAY(String)),
+    bindparam("params", type_=ARRAY(String)),
+    bindparam("jobs", type_=ARRAY(String)),
+)
+
+class Rule:
+    __slots__ = ("id", "device_uid", "metric", "kind", "test", "threshold", "for_seconds", "cooldown",
+                 "cmd", "params", "target")
+
+    def __init__(self, id, device_uid, metric, kind, op, threshold, for_seconds, cooldown_seconds,
+                 action_cmd, action_params=None, action_device_uid=None):
+        if kind not in KINDS:
+            raise ValueError(f"unknown rule kind {kind!r}")
+        self.id = id
+        self.device_uid = device_uid
+        self.metric = metric
+        self.kind = kind
+        self.test = OPS[op]
+        self.threshold = threshold
+        self.for_seconds = for_seconds or 0.0
+        self.cooldown = cooldown_seconds or 0.0
+        self.cmd = action_cmd
+        self.params = action_params
+        self.target = action_device_uid
+
+class _State:
+    __slots__ = ("since", "fired", "fired_at", "prev_value", "prev_ts", "seen")
+
+    def __init__(self):
+        self.seen = 0.0  # lần đánh giá gần nhất
+        self.since = None  # điều kiện đúng liên tục từ lúc này
+        self.fired = False  # đã bắn trong lần điều kiện đúng hiện tại
+        self.fired_at = -math.inf
+        self.prev_value = None  # mẫu trước (luật rate)
+        self.prev_ts = 0.0
+
+class RuleEngine:
+    def __init__(self, state_idle: float = STATE_IDLE_SECONDS, max_pending: int = MAX_PENDING):
+        self.state_idle = state_idle
+        self.max_pending = max(1, max_pending)
+        self._by_device: dict[str, dict[str, list[Rule]]] = {}  # uid → metric → luật riêng
+        self._any_device: dict[str, list[Rule]] = {}  # metric → luật cho mọi thiết bị
+        self._rules: dict[int, Rule] = {}
+        self._state: OrderedDict[tuple[int, str], _State] = OrderedDict()  # đánh giá cũ → mới
+        self._actions: deque[tuple[str, str, str | None, str]] = deque(maxlen=self.max_pending)  # (uid, cmd, params JSON, job_id)
+        self._version = None
+        self._task: asyncio.Task | None = None
+        self.rules = 0
+
+    def load(self, rules: list[Rule]):
+        by_device, any_device = {}, {}
+        for r in rules:
+            index = by_device.setdefault(r.device_uid, {}) if r.device_uid else any_device
+            index.setdefault(r.metric, []).append(r)
+        self._by_device, self._any_device = by_device, any_device
+        self._rules = {r.id: r for r in rules}
+        # bỏ trạng thái của luật đã xoá/tắt
+        self._state = OrderedDict((k, s) for k, s in self._state.items() if k[0] in self._rules)
+        self.rules = len(rules)
+
+    def evaluate_rows(self, rows: list[dict]) -> int:
+        """Hook `on_commit` của `BatchWriter`: đánh giá các dòng vừa insert, thời gian = `ts` của dòng."""
+        return sum(self.evaluate(r["device_uid"], r["payload"], r["ts"].timestamp()) for r in rows
+                   if isinstance(r["payload"], dict))
+
+    def evaluate(self, device_uid: str, payload: dict, now: float | None = None) -> int:
+        """Đánh giá payload của 1 thiết bị; hành động được gom để `flush()`. Trả về số luật bắn."""
+        own = self._by_device.get(device_uid)
+        if own is None and not self._any_device:
+            return 0
+        now = time.time() if now is None else now
+        fired = 0
+        for metric, value in flatten(payload):
+            value = float(value) if isinstance(value, bool) else finite_float(value)
+            if value is None:
+                continue
+            rules = own.get(metric) if own is not None else None
+            shared = self._any_device.get(metric)
+            for group in (rules, shared):
+                if group:
+                    for r in group:
+                        fired += self._check(r, device_uid, value, now)
+        return fired
+
+    def _check(self, r: Rule, device_uid: str, value: float, now: float) -> int:
+        key = (r.id, device_uid)
+        st = self._state.get(key)
+        if st is None:
+            st = self._state[key] = _State()
+        else:
+            self._state.move_to_end(key)
+        st.seen = now
+        if r.kind == "rate":
+            prev, prev_ts = st.prev_value, st.prev_ts
+            st.prev_value, st.prev_ts = value, now
+            if prev is None or now <= prev_ts:
+                return 0
+            value = (value - prev) / (now - prev_ts)
+        if not r.test(value, r.threshold):
+            st.since, st.fired = None, False
+            return 0
+        if st.since is None:
+            st.since = now
+        if st.fired or now - st.since < r.for_seconds or now - st.fired_at < r.cooldown:
+            return 0
+        st.fired, st.fired_at = True, now
+        params = json.dumps(r.params) if r.params is not None else None
+        if len(self._actions) == self.max_pending:
+            FIRED.labels("dropped").inc()  # deque đầy: append bỏ hành động cũ nhất
+        self._actions.append((r.target or device_uid, r.cmd, params, f"rule:{r.id}"))
+        return 1
+
+    def expire(self, now: float | None = None) -> int:
+        """Bỏ trạng thái không có mẫu quá `max(for_seconds, cooldown) + state_idle` giây: cooldown
+        đã hết, mẫu trước của luật `rate` đã quá cũ. Quét từ mục cũ nhất, dừng ở mục đầu tiên
+        chưa hết hạn (mục phía sau có thể chờ thêm tối đa horizon dài nhất giữa các luật)."""
+        now = time.time() if now is None else now
+        expired = 0
+        while self._state:
+            key, st = next(iter(self._state.items()))
+            r = self._rules.get(key[0])
+            horizon = max(r.for_seconds, r.cooldown) if r is not None else 0.0
+            if now - st.seen <= horizon + self.state_idle:
+                break
+            del self._state[key]
+            expired += 1
+        return expired
+
+    def stats(self) -> dict:
+        return {"rules": self.rules, "rule_states": len(self._state), "rule_actions_pending": len(self._actions)}
+
+    async def refresh(self, db) -> bool:
+        """Nạp lại luật nếu bảng đã đổi (số dòng / `updated_at` mới nhất)."""
+        version = (await db.execute(text("SELECT count(*), max(updated_at) FROM alert_rules"))).one()
+        if tuple(version) == self._version:
+            return False
+        res = await db.execute(text("""
+            SELECT id, device_uid, metric, kind, op, threshold, for_seconds, cooldown_seconds,
+                   action_cmd, action_params, action_device_uid
+            FROM alert_rules WHERE enabled
+        """))
+        rules = []
+        for row in res.all():
+            try:
+                rules.append(Rule(*row))
+            except (KeyError, ValueError):
+                log.warning("skipping invalid alert rule %s", row.id)
+        self.load(rules)
+        self._version = tuple(version)
+        log.info("loaded %d alert rules", len(rules))
+        return True
+
+    async def flush(self):
+        """Ghi hành động đã gom vào `command_queue` bằng 1 câu lệnh (thiết bị chưa có trong
+        `devices` bị bỏ qua)."""
+        actions, self._actions = list(self._actions), deque(maxlen=self.max_pending)
+        if not actions:
+            return
+        uids, cmds, params, jobs = (list(col) for col in zip(*actions))
+        try:
+            async with SessionLocal() as db:
+                res = await db.execute(_INSERT_SQL, {"uids": uids, "cmds": cmds, "params": params, "jobs": jobs})
+                await db.commit()
+        except Exception:
+            log.exception("queueing %d rule actions failed, will retry", len(actions))
+            # hành động cũ đứng trước; quá `max_pending` thì bỏ phần cũ nhất
+            merged = actions + list(self._actions)
+            dropped = max(0, len(merged) - self.max_pending)
+            if dropped:
+                FIRED.labels("dropped").inc(dropped)
+                log.warning("dropping %d oldest rule actions (RULES__MAX_PENDING=%d)", dropped, self.max_pending)
+            self._actions = deque(merged[dropped:], maxlen=self.max_pending)
+            return
+        FIRED.labels("queued").inc(res.rowcount)
+        FIRED.labels("unknown_device").inc(len(actions) - res.rowcount)
+
+    async def start(self):
+        try:
+            async with SessionLocal() as db:
+                await self.refresh(db)
+        except Exception:
+            log.warning("alert_rules not loaded (table created by the API on first start)")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        next_refresh = time.monotonic() + REFRESH_SECONDS
+        while True:
+            await asyncio.sleep(FLUSH_SECONDS)
+            await self.flush()
+            self.expire()
+            if time.monotonic() >= next_refresh:
+                next_refresh = time.monotonic() + REFRESH_SECONDS
+                try:
+                    async with SessionLocal() as db:
+                        await self.refresh(db)
+                except Exception:
+                    log.exception("alert rule refresh failed")
+
+rules = RuleEngine()
+GaugeFunc("rules_loaded", "Enabled alert rules loaded in the ingestor", lambda: rules.rules)
@@ -1,13 +1,39 @@
-import os, json, uuid, asyncio
+import os, asyncio, logging
 from asyncio_mqtt import Client, MqttError
+from paho.mqtt.client import topic_matches_sub
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from app.db import SessionLocal
-from app.models import Telemetry, Device
+from app.db import SessionLocal, engine
+from app.models import Device
+from app.telemetry_store import insert_telemetry
+from app.messages import decode_telemetry, telemetry_topics, content_type_of
+from app.mqtt_pub import MQTT_PROTOCOL
+from app import partitions
+from app.dedup import recent_ids
+from app.presence import presence, PresenceMonitor, decode_status, STATUS_TOPIC
+from app.instrumentation import Counter, GaugeFunc, CounterFunc, instrument_engine, serve_metrics
+from ingestor.workers import WorkerPool
+from ingestor.spool import Spool
+from ingestor.rules import rules, RULES_ENABLED
 
 MQTT_HOST = os.getenv("MQTT__HOST", "emqx")
 MQTT_PORT = int(os.getenv("MQTT__PORT", "1883"))
 TOPIC = os.getenv("MQTT__TOPIC", "t0/devices/+/telemetry")
+# EMQX shared subscription: các ingestor cùng group chia nhau message (mỗi message 1 instance).
+# Presence cần status + telemetry của 1 thiết bị về cùng instance → dùng
+# `shared_subscription_strategy = hash_clientid` trên EMQX khi chạy nhiều ingestor.
+SHARE_GROUP = os.getenv("MQTT__SHARE_GROUP", "")
+PARTITION_CHECK_INTERVAL = int(os.getenv("TELEMETRY__PARTITION_CHECK_SECONDS", "3600"))
+# INGEST__SPOOL=0 → không spill ra đĩa, hàng đợi đầy thì chặn vòng MQTT như trước
+SPOOL_ENABLED = os.getenv("INGEST__SPOOL", "1") not in ("0", "false", "no")
+STATS_INTERVAL = int(os.getenv("INGEST__STATS_SECONDS", "30"))
+# cổng HTTP cho Prometheus scrape (0 = tắt)
+METRICS_PORT = int(os.getenv("INGEST__METRICS_PORT", "9100"))
+
+RECEIVED = Counter("ingest_mqtt_messages", "MQTT telemetry messages by decode result", ("result",))
+RECONNECTS = Counter("ingest_mqtt_reconnects", "MQTT connection losses")
+
+log = logging.getLogger(__name__)
 
 async def ensure_device(db: AsyncSession, device_uid: str):
     res = await db.execute(select(Device).where(Device.device_uid == device_uid))
@@ -17,36 +43,107 @@ async def ensure_device(db: AsyncSession, device_uid: str):
         await db.commit()
 
 async def handle_message(topic: str, payload: bytes):
-    parts = topic.split("/")  # t0 devices {uid} telemetry
-    # defensive check
-    if len(parts) < 4:
+    """Đường ghi từng message (1 session + 1 commit / message), giữ lại để so sánh benchmark."""
+    decoded = decode_telemetry(topic, payload)
+    if decoded is None:
         return
-    device_uid = parts[2]
-    try:
-        body = json.loads(payload.decode())
-    except Exception:
-        body = {"raw": payload.decode(errors="ignore")}
-    msg_id = body.get("msg_id") or str(uuid.uuid4())
+    device_uid, msg_id, body = decoded
 
     async with SessionLocal() as db:
         await ensure_device(db, device_uid)
-        db.add(Telemetry(device_uid=device_uid, msg_id=msg_id, payload=body))
+        # duplicate đã được ON CONFLICT bỏ qua; lỗi khác để nổi lên, không nuốt
+        await insert_telemetry(db, [{"device_uid": device_uid, "msg_id": msg_id, "payload": body}])
+        await db.commit()
+
+async def partition_loop():
+    """Định kỳ tạo partition telemetry cho các kỳ tới và xoá partition hết hạn."""
+    while True:
         try:
-            await db.commit()
+            async with engine.begin() as conn:
+                await partitions.maintain(conn)
         except Exception:
-            await db.rollback()  # duplicate? bỏ qua trong demo
+            log.exception("telemetry partition maintenance failed")
+        await asyncio.sleep(PARTITION_CHECK_INTERVAL)
+
+async def stats_loop(pool: WorkerPool):
+    """Log độ sâu hàng đợi, dung lượng spool và tốc độ replay (INFO khi đang spill)."""
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        st = {**pool.stats(), **recent_ids.stats(), **rules.stats(), **{f"presence_{k}": v for k, v in presence.counts().items()}}
+        level = logging.INFO if st["spilling"] or st["spool_bytes"] else logging.DEBUG
+        log.log(level, "ingest stats %s", " ".join(f"{k}={v}" for k, v in st.items()))
+
+def register_pool_metrics(pool: WorkerPool):
+    GaugeFunc("ingest_queue_depth", "Messages waiting in worker queues", lambda: pool.stats()["queue_depth"])
+    GaugeFunc("ingest_queue_capacity", "Total worker queue capacity", lambda: pool.stats()["queue_capacity"])
+    GaugeFunc("ingest_spilling", "1 while new messages go to the disk spool", lambda: int(pool.stats()["spilling"]))
+    GaugeFunc("ingest_spool_bytes", "Bytes held in the disk spool", lambda: pool.stats()["spool_bytes"])
+    GaugeFunc("ingest_spool_replay_rate", "Messages/s replayed from the spool (10s window)", lambda: pool.stats()["replay_rate"])
+    CounterFunc("ingest_spilled", "Messages written to the disk spool", lambda: pool.stats()["spilled"])
+    CounterFunc("ingest_replayed", "Messages replayed from the disk spool", lambda: pool.stats()["replayed"])
+
+def subscription_topic(topic: str = TOPIC, group: str = SHARE_GROUP) -> str:
+    return f"$share/{group}/{topic}" if group else topic
 
 async def main():
     reconnect_delay = 3
-    while True:
-        try:
-            async with Client(MQTT_HOST, MQTT_PORT) as client:
-                await client.subscribe(TOPIC, qos=1)
-                async with client.unfiltered_messages() as messages:
-                    async for m in messages:
-                        await handle_message(m.topic, m.payload)
-        except MqttError:
-            await asyncio.sleep(reconnect_delay)
+    # luật được đánh giá sau commit, chỉ trên dòng thực sự insert
+    pool = WorkerPool(spool=Spool() if SPOOL_ENABLED else None, on_commit=rules.evaluate_rows if RULES_ENABLED else None)
+    await pool.start()
+    instrument_engine(engine)
+    register_pool_metrics(pool)
+    metrics_server = await serve_metrics(METRICS_PORT) if METRICS_PORT else None
+    maintenance = asyncio.create_task(partition_loop())
+    reporter = asyncio.create_task(stats_loop(pool))
+    # shared subscription không nhận message retained → nạp trạng thái đã lưu trước
+    try:
+        async with SessionLocal() as db:
+            await presence.warm(db)
+    except Exception:
+        log.warning("device_presence not loaded (table created by the API on first start)")
+    # ghi thay đổi online/offline theo lô vào device_presence
+    presence_monitor = PresenceMonitor(presence, persist=True)
+    await presence_monitor.start()
+    if RULES_ENABLED:
+        await rules.start()
+    try:
+        while True:
+            try:
+                async with Client(MQTT_HOST, MQTT_PORT, protocol=MQTT_PROTOCOL) as client:
+                    for topic in telemetry_topics(TOPIC):
+                        await client.subscribe(subscription_topic(topic), qos=1)
+                    await client.subscribe(subscription_topic(STATUS_TOPIC), qos=1)
+                    async with client.unfiltered_messages() as messages:
+                        async for m in messages:
+                            if topic_matches_sub(STATUS_TOPIC, m.topic):
+                                status = decode_status(m.topic, m.payload)
+                                if status is not None:
+                                    presence.status(*status, retained=bool(m.retain))
+                                continue
+                            decoded = decode_telemetry(m.topic, m.payload, content_type_of(m))
+                            if decoded is None:
+                                RECEIVED.labels("dropped").inc()
+                                continue
+                            presence.heartbeat(decoded[0])
+                            if recent_ids.seen(decoded[0], decoded[1]):
+                                # QoS1 gửi lại message đã ghi: bỏ, không tốn INSERT
+                                RECEIVED.labels("duplicate").inc()
+                                continue
+                            RECEIVED.labels("accepted").inc()
+                            await pool.submit(*decoded)
+            except MqttError:
+                RECONNECTS.inc()
+                # buffer vẫn được flush theo thời gian; không chờ DB ở đây để reconnect ngay
+                await asyncio.sleep(reconnect_delay)
+    finally:
+        maintenance.cancel()
+        reporter.cancel()
+        await presence_monitor.stop()
+        await rules.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+        await pool.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
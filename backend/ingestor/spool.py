@@ -0,0 +1,124 @@
+import os, json, logging
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("INGEST__SPOOL_DIR", "spool")
+SEGMENT_BYTES = int(os.getenv("INGEST__SPOOL_SEGMENT_MB", "64")) * 1024 * 1024
+# tổng dung lượng tối đa trên đĩa (0 = không giới hạn); đầy → vòng MQTT bị chặn thay vì bỏ message
+MAX_BYTES = int(os.getenv("INGEST__SPOOL_MAX_MB", "1024")) * 1024 * 1024
+
+class Spool:
+    """Log append-only trên đĩa, chia thành các segment `seg-<n>.log` (mỗi dòng 1 message JSON).
+
+    Ghi luôn vào segment mới nhất, đọc lại từ segment cũ nhất. Segment đọc hết chỉ bị xoá khi
+    caller gọi `commit()` (sau khi mọi message đã đọc được ghi xong vào DB); process chết trước
+    đó → segment còn trên đĩa và được đọc lại lúc khởi động (message trùng bị bỏ nhờ `msg_id`).
+    """
+
+    def __init__(self, directory: str = SPOOL_DIR, segment_bytes: int = SEGMENT_BYTES, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = max(1, segment_bytes)
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            int(name[4:-4]) for name in os.listdir(directory)
+            if name.startswith("seg-") and name.endswith(".log")
+        )
+        self.bytes = sum(os.path.getsize(self._path(n)) for n in self._segments)
+        # số segment chỉ tăng: segment đã đọc hết nhưng chưa `commit()` vẫn còn trên đĩa,
+        # mở lại đúng số đó để ghi thì commit() sẽ xoá mất message mới
+        self._next = self._segments[-1] + 1 if self._segments else 1
+        self._out = None        # file đang ghi (segment cuối)
+        self._out_size = 0
+        self._in = None         # file đang đọc (segment đầu)
+        self._consumed: list[int] = []  # đã đọc hết, chờ `commit()` mới xoá
+
+    def _path(self, n: int) -> str:
+        return os.path.join(self.directory, f"seg-{n:012d}.log")
+
+    @property
+    def segments(self) -> int:
+        return len(self._segments) + len(self._consumed)
+
+    @property
+    def consumed(self) -> int:
+        return len(self._consumed)
+
+    def empty(self) -> bool:
+        return not self._segments
+
+    def full(self) -> bool:
+        return self.max_bytes > 0 and self.bytes >= self.max_bytes
+
+    def append(self, device_uid: str, msg_id: str, payload: dict, ts: datetime):
+        line = (json.dumps([device_uid, msg_id, ts.isoformat(), payload], separators=(",", ":")) + "\n").encode()
+        if self._out is None or self._out_size >= self.segment_bytes:
+            if self._out is not None:
+                self._out.close()
+            n, self._next = self._next, self._next + 1
+            self._segments.append(n)
+            self._out, self._out_size = open(self._path(n), "ab"), 0
+        self._out.write(line)
+        # đẩy xuống OS ngay: process chết vẫn còn dữ liệu (không fsync từng dòng)
+        self._out.flush()
+        self._out_size += len(line)
+        self.bytes += len(line)
+
+    def read(self, limit: int) -> list[tuple[str, str, dict, datetime]]:
+        """Đọc tối đa `limit` message theo đúng thứ tự ghi. Rỗng = đã đọc hết."""
+        out = []
+        while len(out) < limit and self._segments:
+            n = self._segments[0]
+            if self._in is None:
+                self._in = open(self._path(n), "rb")
+            line = self._in.readline()
+            if line.endswith(b"\n"):
+                try:
+                    uid, msg_id, ts, payload = json.loads(line)
+                    out.append((uid, msg_id, payload, datetime.fromisoformat(ts)))
+                except ValueError:
+                    log.warning("skipping corrupt spool record in %s", self._path(n))
+                continue
+            if self._out is not None and len(self._segments) == 1:
+                # đang đọc đúng segment đang ghi và đã đuổi kịp → dừng, không xoá
+                self._in.seek(self._in.tell() - len(line))
+                break
+            # hết segment (dòng cuối dở dang do crash thì bỏ) → chờ commit() mới xoá
+            self._in.close()
+            self._in = None
+            self._consumed.append(self._segments.pop(0))
+        return out
+
+    def commit(self):
+        """Xoá các segment đã đọc hết. Chỉ gọi khi mọi message `read()` trả về đã nằm trong DB."""
+        for n in self._consumed:
+            self.bytes -= os.path.getsize(self._path(n))
+            os.remove(self._path(n))
+        self._consumed.clear()
+
+    def drained(self) -> bool:
+        """Đã đọc hết mọi dòng đã ghi (không còn segment nào chưa đọc xong)."""
+        if not self._segments:
+            return True
+        if len(self._segments) > 1 or self._in is None or self._out is None:
+            return False
+        return self._in.tell() >= self._out_size
+
+    def reset(self):
+        """Gọi khi `drained()` và mọi message đã đọc đã nằm trong DB: xoá hết segment
+        (kể cả segment đang ghi) để lần spill sau bắt đầu segment mới."""
+        for f in (self._in, self._out):
+            if f is not None:
+                f.close()
+        self._in = self._out = None
+        self.commit()
+        for n in self._segments:
+            os.remove(self._path(n))
+        self._segments, self.bytes, self._out_size = [], 0, 0
+
+    def close(self):
+        for f in (self._in, self._out):
+            if f is not None:
+                f.close()
+        self._in = self._out = None
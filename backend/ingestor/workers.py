@@ -0,0 +1,181 @@
+import os, time, zlib, asyncio, logging
+from datetime import datetime, timezone
+from app.db import SessionLocal
+from ingestor.devices import KnownDevices
+from ingestor.writer import BatchWriter
+from ingestor.spool import Spool
+
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("INGEST__WORKERS", "4"))
+WORKER_QUEUE = int(os.getenv("INGEST__WORKER_QUEUE", "10000"))
+REPLAY_BATCH = 1000
+
+def shard_of(device_uid: str, n: int) -> int:
+    # crc32 ổn định giữa các lần chạy (khác hash() của Python bị random hoá)
+    return zlib.crc32(device_uid.encode()) % n
+
+class WorkerPool:
+    """N worker, mỗi worker 1 hàng đợi + 1 `BatchWriter` (transaction riêng).
+
+    Message được chia theo hash `device_uid` → mọi message của 1 thiết bị luôn do
+    cùng 1 worker ghi theo đúng thứ tự nhận, trong khi các thiết bị khác ghi song
+    song. 1 commit chậm chỉ chặn shard của nó.
+
+    Có `spool`: `submit()` không chờ hàng đợi. Hàng đợi nào đầy → chuyển sang chế độ
+    spill, mọi message sau đó (kể cả của shard còn trống, để giữ thứ tự) được ghi
+    vào spool trên đĩa; task replay đọc lại spool theo thứ tự và đưa vào hàng đợi
+    khi DB ghi kịp, đọc hết thì quay về ghi thẳng vào hàng đợi. Segment chỉ bị xoá
+    sau khi mọi message đã đọc ra được writer commit (`_confirm`).
+    """
+
+    def __init__(self, workers: int = WORKERS, queue_size: int = WORKER_QUEUE, session_factory=SessionLocal, spool: Spool | None = None, **writer_kwargs):
+        self.size = max(1, workers)
+        self.queue_size = queue_size
+        self.spool = spool
+        self._session_factory = session_factory
+        self.known = KnownDevices()
+        self.writers = [
+            BatchWriter(session_factory=session_factory, known=self.known, **writer_kwargs)
+            for _ in range(self.size)
+        ]
+        self.queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(self.size)]
+        self._tasks: list[asyncio.Task] = []
+        # còn segment từ lần chạy trước → bắt đầu ở chế độ spill để replay trước
+        self.spilling = spool is not None and not spool.empty()
+        self._spill_started = asyncio.Event()
+        self._closing = False
+        self.spilled = 0
+        self.replayed = 0
+        self._rate_mark = (time.monotonic(), 0)
+
+    async def start(self, warm: bool = True):
+        if warm:
+            try:
+                async with self._session_factory() as db:
+                    await self.known.warm(db)
+            except Exception:
+                # DB chưa sẵn sàng: vẫn nhận message (cache trống chỉ tốn thêm INSERT devices)
+                log.warning("device cache warm-up failed, starting cold", exc_info=True)
+        for writer, queue in zip(self.writers, self.queues):
+            await writer.start(warm=False)
+            self._tasks.append(asyncio.create_task(self._work(writer, queue)))
+        if self.spool is not None:
+            self._tasks.append(asyncio.create_task(self._replay()))
+
+    async def dispatch(self, device_uid: str, msg_id: str, payload: dict, ts: datetime | None = None):
+        """Đưa message vào hàng đợi của shard, chờ nếu hàng đợi đầy."""
+        ts = ts or datetime.now(timezone.utc)
+        await self.queues[shard_of(device_uid, self.size)].put((device_uid, msg_id, payload, ts))
+
+    async def submit(self, device_uid: str, msg_id: str, payload: dict):
+        """Dùng cho vòng MQTT: hàng đợi đầy thì spill ra đĩa thay vì chặn.
+
+        Chỉ chặn khi spool cũng đầy (`INGEST__SPOOL_MAX_MB`) → backpressure về broker.
+        """
+        if self.spool is None:
+            return await self.dispatch(device_uid, msg_id, payload)
+        ts = datetime.now(timezone.utc)
+        while True:
+            if not self.spilling:
+                try:
+                    self.queues[shard_of(device_uid, self.size)].put_nowait((device_uid, msg_id, payload, ts))
+                    return
+                except asyncio.QueueFull:
+                    self.spilling = True
+                    self._spill_started.set()
+                    log.warning("ingest queue full (%d queued), spilling to %s", self.depth(), self.spool.directory)
+            if not self.spool.full():
+                self.spool.append(device_uid, msg_id, payload, ts)
+                self.spilled += 1
+                return
+            await asyncio.sleep(0.05)
+
+    async def _replay(self):
+        while not self._closing:
+            if not self.spilling:
+                await self._spill_started.wait()
+                self._spill_started.clear()
+                continue
+            records = self.spool.read(REPLAY_BATCH)
+            for record in records:
+                await self.dispatch(*record)
+                self.replayed += 1
+            if self.spool.consumed:
+                await self._confirm()
+            if records:
+                continue
+            if self.depth() <= self.queue_size * self.size // 2:
+                await self._confirm()
+                # trong lúc chờ commit, message mới vẫn được spill → chỉ reset khi thật sự đọc hết
+                # (từ lúc kiểm tra tới reset không có await)
+                if self.spool.drained():
+                    self.spool.reset()
+                    self.spilling = False
+                    log.info("spool drained, %d messages replayed so far", self.replayed)
+            else:
+                await asyncio.sleep(0.1)  # chờ hàng đợi vơi bớt để không spill lại ngay
+
+    async def _confirm(self):
+        """Chờ mọi message đã đưa vào hàng đợi được ghi vào DB rồi xoá segment đã đọc hết.
+
+        Đang spill nên hàng đợi chỉ chứa message replay; `flush()` chỉ trả về khi batch đã
+        commit (lỗi tạm thời được thử lại bên trong) hoặc dòng lỗi đã vào dead-letter.
+        """
+        await self.drain()
+        self.spool.commit()
+
+    async def _work(self, writer: BatchWriter, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await writer.add(*item)
+            finally:
+                queue.task_done()
+
+    async def drain(self):
+        """Chờ các hàng đợi rỗng rồi flush mọi writer."""
+        for queue in self.queues:
+            await queue.join()
+        await asyncio.gather(*(w.flush() for w in self.writers))
+
+    async def close(self):
+        # dừng replay sau lô đang dở (đã đọc khỏi spool thì phải vào hàng đợi);
+        # phần còn trong spool nằm lại trên đĩa cho lần chạy sau
+        self._closing = True
+        self._spill_started.set()
+        await asyncio.gather(*self._tasks[self.size:], return_exceptions=True)
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        await asyncio.gather(*(w.close() for w in self.writers))
+        if self.spool is not None:
+            # mọi message đã đọc ra đã được flush ở trên → segment đọc hết có thể xoá
+            self.spool.commit()
+            self.spool.close()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def replay_rate(self) -> float:
+        """Số message/giây được replay từ spool, tính trên cửa sổ ~10s gần nhất."""
+        now = time.monotonic()
+        since, count = self._rate_mark
+        rate = (self.replayed - count) / (now - since) if now > since else 0.0
+        if now - since >= 10:
+            self._rate_mark = (now, self.replayed)
+        return rate
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "queue_capacity": self.queue_size * self.size,
+            "spilling": self.spilling,
+            "spool_bytes": self.spool.bytes if self.spool is not None else 0,
+            "spool_segments": self.spool.segments if self.spool is not None else 0,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "replay_rate": round(self.replay_rate(), 1),
+        }
@@ -0,0 +1,175 @@
+import os, json, time, asyncio, logging
+from datetime import datetime, timezone
+from sqlalchemy.exc import DBAPIError, DataError, IntegrityError, ProgrammingError, TimeoutError as PoolTimeout
+from app.db import SessionLocal
+from app.telemetry_store import insert_telemetry, WRITES
+from app.instrumentation import Counter, Histogram
+from app.dedup import recent_ids
+from ingestor.devices import KnownDevices, provision_devices
+from ingestor.spool import SPOOL_DIR
+
+log = logging.getLogger(__name__)
+
+# Flush khi đủ BATCH_SIZE message hoặc message cũ nhất đã chờ FLUSH_MS
+BATCH_SIZE = int(os.getenv("INGEST__BATCH_SIZE", "500"))
+FLUSH_MS = int(os.getenv("INGEST__FLUSH_MS", "200"))
+# DB lỗi tạm thời (mất kết nối, restart, pool cạn) → thử lại batch, chờ tối đa RETRY_MAX_SECONDS giữa 2 lần
+RETRY_MAX_SECONDS = float(os.getenv("INGEST__RETRY_MAX_SECONDS", "30"))
+# dòng DB từ chối vì lỗi dữ liệu (ví dụ `ts` không có partition): 1 dòng JSON/message để xem/ghi lại tay
+DEAD_LETTER_FILE = os.getenv("INGEST__DEAD_LETTER_FILE", os.path.join(SPOOL_DIR, "dead-letter.log"))
+
+FLUSH_SECONDS = Histogram("ingest_flush_duration_seconds", "Time to write one telemetry batch (successful attempts)")
+FLUSH_RETRIES = Counter("ingest_flush_retries", "Batch writes retried after a transient DB error")
+
+def is_transient(exc: Exception) -> bool:
+    """Lỗi kết nối/tạm thời: nên thử lại. Lỗi dữ liệu/SQL thì thử lại cũng vô ích."""
+    if isinstance(exc, (DataError, IntegrityError, ProgrammingError)):
+        return False
+    return isinstance(exc, (DBAPIError, PoolTimeout, OSError, asyncio.TimeoutError))
+
+class BatchWriter:
+    """Gom telemetry đã decode và ghi theo lô.
+
+    - `add()` đưa message vào buffer; buffer đầy `max_batch` → flush ngay.
+    - Task nền flush buffer khi message đầu tiên đã chờ quá `max_delay` giây.
+    - Mỗi lần flush: 1 transaction, 1 câu INSERT nhiều dòng ON CONFLICT DO NOTHING.
+    - Device chưa có trong `known` được tạo chung 1 câu INSERT trong cùng transaction.
+    - `ts` lấy lúc nhận message (không phải lúc flush); rollup chỉ tính dòng mới (không tính duplicate).
+    - Lỗi tạm thời (`is_transient`) → giữ batch, thử lại với backoff; trong lúc đó `add()` bị chặn
+      khi buffer đầy → hàng đợi phía trước đầy → spill ra đĩa (`ingestor/workers.py`).
+    - Lỗi dữ liệu → chia đôi batch và ghi lại từng nửa cho tới khi tách được dòng lỗi; dòng lỗi
+      vào `DEAD_LETTER_FILE`, các dòng còn lại vẫn được ghi.
+    - `on_commit(rows)`: gọi sau mỗi commit với các dòng thực sự được insert (rules engine).
+    """
+
+    def __init__(self, session_factory=SessionLocal, max_batch: int = BATCH_SIZE, max_delay: float = FLUSH_MS / 1000, known: KnownDevices | None = None, on_commit=None):
+        self._session_factory = session_factory
+        self.known = known if known is not None else KnownDevices()
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self._buf: list[dict] = []
+        self._first_at: float | None = None
+        self._lock = asyncio.Lock()  # flush tuần tự → giữ thứ tự ghi
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self, warm: bool = True):
+        if warm:
+            async with self._session_factory() as db:
+                await self.known.warm(db)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def add(self, device_uid: str, msg_id: str, payload: dict, ts: datetime | None = None):
+        if not self._buf:
+            self._first_at = time.monotonic()
+            self._wakeup.set()
+        self._buf.append({"device_uid": device_uid, "msg_id": msg_id, "payload": payload, "ts": ts or datetime.now(timezone.utc)})
+        if len(self._buf) >= self.max_batch:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Ghi toàn bộ buffer hiện tại. Trả về số dòng mới được insert."""
+        async with self._lock:
+            batch, self._buf, self._first_at = self._buf, [], None
+            if not batch:
+                return 0
+            inserted, dead = await self._commit(batch)
+            WRITES.labels("persisted").inc(inserted)
+            WRITES.labels("duplicate").inc(len(batch) - inserted - dead)
+            WRITES.labels("failed").inc(dead)
+            return inserted
+
+    async def _commit(self, batch: list[dict]) -> tuple[int, int]:
+        """Ghi 1 batch, trả về (số dòng mới, số dòng vào dead-letter)."""
+        delay = 0.5
+        while True:
+            start = time.perf_counter()
+            try:
+                inserted = await self._write(batch)
+            except Exception as exc:
+                if not is_transient(exc):
+                    if len(batch) == 1:
+                        log.error("telemetry %s/%s rejected (%s), moved to %s", batch[0]["device_uid"], batch[0]["msg_id"], exc.__class__.__name__, DEAD_LETTER_FILE)
+                        self._dead_letter(batch[0], exc)
+                        return 0, 1
+                    # 1 dòng lỗi làm hỏng cả câu lệnh → chia đôi để giữ lại các dòng hợp lệ
+                    log.warning("flush %d telemetry rows failed (%s), splitting batch", len(batch), exc.__class__.__name__)
+                    mid = len(batch) // 2
+                    first, second = await self._commit(batch[:mid]), await self._commit(batch[mid:])
+                    return first[0] + second[0], first[1] + second[1]
+                FLUSH_RETRIES.inc()
+                log.warning("flush %d telemetry rows failed (%s), retrying in %.1fs", len(batch), exc.__class__.__name__, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_SECONDS)
+                continue
+            FLUSH_SECONDS.observe(time.perf_counter() - start)
+            return inserted, 0
+
+    @staticmethod
+    def _dead_letter(row: dict, exc: Exception):
+        record = [row["device_uid"], row["msg_id"], row["ts"].isoformat(), row["payload"], str(getattr(exc, "orig", None) or exc)[:500]]
+        try:
+            os.makedirs(os.path.dirname(DEAD_LETTER_FILE) or ".", exist_ok=True)
+            with open(DEAD_LETTER_FILE, "a") as f:
+                f.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+        except OSError:
+            log.exception("writing dead-letter record failed, dropping %s/%s", row["device_uid"], row["msg_id"])
+
+    async def _write(self, batch: list[dict]) -> int:
+        uids = {r["device_uid"] for r in batch}
+        new_uids = self.known.unknown(uids)
+        async with self._session_factory() as db:
+            try:
+                await provision_devices(db, new_uids)
+                # telemetry + telemetry_metrics + telemetry_rollups trong cùng transaction
+                inserted = await insert_telemetry(db, batch)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                # device có thể đã bị xoá khỏi DB → bỏ khỏi cache để lần sau tạo lại
+                self.known.discard_many(uids)
+                raise
+        # chỉ đánh dấu "đã biết" sau khi commit thành công
+        self.known.add_many(new_uids)
+        # cả dòng mới lẫn dòng DB báo trùng đều đã nằm trong DB → redelivery sau đó bỏ trước khi INSERT
+        recent_ids.record_many((r["device_uid"], r["msg_id"]) for r in batch)
+        if self.on_commit is not None and inserted:
+            keys, fresh = set(inserted), []
+            for r in batch:
+                key = (r["device_uid"], r["msg_id"])
+                if key in keys:  # trùng trong cùng batch: chỉ bản đầu được ghi
+                    keys.discard(key)
+                    fresh.append(r)
+            try:
+                self.on_commit(fresh)
+            except Exception:
+                # đã commit: lỗi của hook không được làm batch bị ghi lại
+                log.exception("on_commit hook failed for %d rows", len(inserted))
+        return len(inserted)
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._first_at is None:
+                continue
+            delay = self._first_at + self.max_delay - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._first_at is not None and time.monotonic() - self._first_at >= self.max_delay:
+                await self.flush()
+            elif self._buf:
+                # buffer đã được flush theo size rồi có message mới → chờ tiếp
+                self._wakeup.set()
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.device_auth import authenticate_device, hash_secret, new_device_secret
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar_one_or_none(self):
+        return self.value
+
+
+class _Session:
+    def __init__(self, stored):
+        self.stored = stored
+
+    async def execute(self, stmt, params=None):
+        return _Result(self.stored)
+
+
+def _auth(stored, credential):
+    asyncio.run(authenticate_device(_Session(stored), "dev-01", credential))
+
+
+def test_new_secret_is_random_and_only_hash_is_stored():
+    (s1, h1), (s2, _) = new_device_secret(), new_device_secret()
+    assert s1 != s2 and s1 not in h1
+    assert h1 == hash_secret(s1)
+    _auth(h1, s1)
+
+
+def test_secret_must_match_hash():
+    _, stored = new_device_secret()
+    for credential in ("10-ved", stored):  # uid đảo ngược (secret cũ), chính giá trị hash
+        with pytest.raises(HTTPException) as e:
+            _auth(stored, credential)
+        assert e.value.status_code == 403
+    with pytest.raises(HTTPException) as e:
+        _auth(None, "10-ved")  # secret cũ đã bị xoá lúc migrate
+    assert e.value.status_code == 403
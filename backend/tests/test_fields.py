@@ -0,0 +1,15 @@
+from app.fields import finite_float, numeric_fields
+
+
+def test_huge_int_and_non_finite_are_skipped():
+    payload = {"data": {"temp": 21, "big": 10 ** 400, "nan": float("nan"), "inf": float("inf"),
+                        "on": True, "name": "x", "nested": {"v": 1.5}}}
+    assert numeric_fields(payload) == {"data.temp": 21.0, "data.nested.v": 1.5}
+    assert numeric_fields(payload, include_bool=True)["data.on"] == 1.0
+
+
+def test_finite_float():
+    assert finite_float(3) == 3.0
+    assert finite_float(-(10 ** 400)) is None
+    assert finite_float(True) is None
+    assert finite_float("1") is None
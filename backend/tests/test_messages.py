@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from app import codecs
+from app.codecs import CodecUnavailable
+from app.messages import parse_telemetry_item
+
+
+def test_item_decoded_by_content_type():
+    item = {"msg_id": "1", "payload": {"t": 21.5}}
+    assert parse_telemetry_item(json.dumps(item).encode(), "application/json; charset=utf-8") == item
+    assert parse_telemetry_item(json.dumps(item).encode(), None) == item
+    for name in ("cbor", "msgpack"):
+        if name in codecs.CODECS:
+            codec = codecs.CODECS[name]
+            assert parse_telemetry_item(codec.encode(item), codec.content_types[0]) == item
+
+
+def test_item_errors(monkeypatch):
+    with pytest.raises(ValueError):
+        parse_telemetry_item(b"[1, 2]", "application/json")
+    with pytest.raises(ValueError):
+        parse_telemetry_item(b"{", "application/json")
+    monkeypatch.delitem(codecs.CODECS, "cbor", raising=False)
+    with pytest.raises(CodecUnavailable):
+        parse_telemetry_item(b"\xa0", "application/cbor")
@@ -0,0 +1,56 @@
+import asyncio
+
+from app import notifier as notifier_mod
+from app.notifier import CommandNotifier
+
+
+class _Conn:
+    def __init__(self):
+        self.listeners = {}
+
+    def add_termination_listener(self, cb):
+        pass
+
+    async def add_listener(self, channel, cb):
+        self.listeners[channel] = cb
+
+    def is_closed(self):
+        return False
+
+    async def close(self):
+        pass
+
+
+def test_unexpected_errors_reconnect_with_backoff(monkeypatch):
+    attempts, sleeps = [], []
+    conn = _Conn()
+
+    async def connect(dsn):
+        attempts.append(dsn)
+        if len(attempts) < 3:
+            raise ValueError("unexpected")  # không phải OSError/PostgresError
+        return conn
+
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(notifier_mod.asyncpg, "connect", connect)
+    monkeypatch.setattr(notifier_mod.asyncio, "sleep", sleep)
+
+    async def run():
+        n = CommandNotifier()
+        await n.start()
+        for _ in range(100):
+            if n.listening:
+                break
+            await real_sleep(0)
+        await n.stop()
+        return n
+
+    asyncio.run(run())
+    assert len(attempts) == 3
+    assert sleeps == [1.0, 2.0]
+    assert notifier_mod.CHANNEL in conn.listeners
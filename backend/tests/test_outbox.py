@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+from asyncio_mqtt import MqttError
+
+from app import outbox
+
+
+class _Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+class _Table:
+    """`command_queue` trong RAM; ghi lại transaction đang mở lúc publish."""
+
+    def __init__(self, uids):
+        self.rows = {i: SimpleNamespace(id=i, device_uid=uid, cmd="ping", params=None, created_at=None,
+                                        status="pending", publish_attempts=0)
+                     for i, uid in enumerate(uids, 1)}
+        self.open_sessions = 0
+
+    def session(self):
+        table = self
+
+        class Session:
+            async def __aenter__(self):
+                table.open_sessions += 1
+                return self
+
+            async def __aexit__(self, *exc):
+                table.open_sessions -= 1
+
+            async def execute(self, stmt, params=None):
+                sql = str(stmt)
+                if "claimed" in sql:
+                    rows = [r for r in table.rows.values() if r.status == "pending"][: params["batch"]]
+                    for r in rows:
+                        r.status, r.publish_attempts = "sending", r.publish_attempts + 1
+                    return _Result(rows)
+                if "'sent'" in sql:
+                    for i in params["ids"]:
+                        table.rows[i].status = "sent"
+                elif "'failed'" in sql:
+                    for i in params["ids"]:
+                        r = table.rows[i]
+                        give_up = i in params["rejected"] or r.publish_attempts >= params["max_attempts"]
+                        r.status = "failed" if give_up else "pending"
+                    return _Result([(table.rows[i].status,) for i in params["ids"]])
+                return _Result([])
+
+            async def commit(self):
+                pass
+
+        return Session()
+
+
+def _dispatch(monkeypatch, table, publish, **kw):
+    monkeypatch.setattr(outbox, "SessionLocal", table.session)
+    monkeypatch.setattr(outbox, "publish_command", publish)
+    return asyncio.run(outbox.OutboxDispatcher(**kw).dispatch_once())
+
+
+def test_publishes_outside_the_claim_transaction(monkeypatch):
+    table = _Table(["a", "a", "b"])
+    seen = []
+
+    async def publish(uid, payload):
+        seen.append((uid, table.open_sessions))
+
+    assert _dispatch(monkeypatch, table, publish) == (3, 0)
+    assert sorted(seen) == [("a", 0), ("a", 0), ("b", 0)]
+    assert {r.status for r in table.rows.values()} == {"sent"}
+
+
+def test_rejected_row_is_failed_without_backoff(monkeypatch):
+    table = _Table(["bad+uid", "bad+uid", "ok"])
+
+    async def publish(uid, payload):
+        if "+" in uid:
+            raise ValueError("Publish topic cannot contain wildcards.")
+
+    assert _dispatch(monkeypatch, table, publish) == (1, 0)
+    assert [r.status for r in table.rows.values()] == ["failed", "failed", "sent"]
+
+
+def test_connection_errors_retry_then_fail(monkeypatch):
+    table = _Table(["a", "a"])
+
+    async def publish(uid, payload):
+        raise MqttError("Operation timed out")
+
+    assert _dispatch(monkeypatch, table, publish, max_attempts=2) == (0, 2)
+    assert [r.status for r in table.rows.values()] == ["pending", "pending"]
+    assert _dispatch(monkeypatch, table, publish, max_attempts=2) == (0, 2)
+    assert [r.status for r in table.rows.values()] == ["failed", "failed"]
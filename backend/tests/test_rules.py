@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timezone
+
+from bench.worker_scaling import FakeSession
+from ingestor import rules as rules_mod
+from ingestor.rules import Rule, RuleEngine
+from ingestor.workers import WorkerPool
+
+
+def _engine(**kw) -> RuleEngine:
+    engine = RuleEngine(**kw)
+    engine.load([Rule(1, None, "data.temp", "threshold", ">", 30, 0, 0, "fan_on")])
+    return engine
+
+
+def test_pending_actions_are_capped_when_db_is_down(monkeypatch):
+    class Down:
+        async def __aenter__(self):
+            raise OSError("db down")
+
+        async def __aexit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(rules_mod, "SessionLocal", Down)
+    engine = _engine(max_pending=3)
+    dropped = rules_mod.FIRED.labels("dropped")
+    before = dropped.value
+    for i in range(5):  # mỗi thiết bị bắn 1 lần
+        assert engine.evaluate(f"dev-{i}", {"data": {"temp": 35}}, now=100.0) == 1
+    asyncio.run(engine.flush())
+    engine.evaluate("dev-9", {"data": {"temp": 35}}, now=100.0)
+    asyncio.run(engine.flush())
+    assert [a[0] for a in engine._actions] == ["dev-3", "dev-4", "dev-9"]
+    assert dropped.value - before == 3
+
+
+def test_rules_see_only_committed_new_rows():
+    engine = _engine()
+    log: list = []
+
+    class Session(FakeSession):
+        async def execute(self, stmt, params=None):
+            res = await super().execute(stmt, params)
+            if isinstance(params, dict) and "msg_ids" in params:
+                # "dup" đã có trong DB: không được insert
+                res._rows = [r for r in res._rows if r[1] != "dup"]
+            return res
+
+    async def ingest():
+        pool = WorkerPool(workers=2, session_factory=lambda: Session(log, 0, 0),
+                          max_batch=10, max_delay=0.01, on_commit=engine.evaluate_rows)
+        await pool.start(warm=False)
+        ts = datetime.now(timezone.utc)
+        await pool.dispatch("hot", "dup", {"data": {"temp": 40}}, ts)
+        await pool.dispatch("cold", "1", {"data": {"temp": 20}}, ts)
+        await pool.dispatch("warm", "2", {"data": {"temp": 31}}, ts)
+        assert not engine._actions  # chưa commit → chưa đánh giá
+        await pool.close()
+
+    asyncio.run(ingest())
+    assert [a[0] for a in engine._actions] == ["warm"]
@@ -0,0 +1,39 @@
+import asyncio
+import random
+import time
+
+from bench.worker_scaling import FakeSession, check_order
+from ingestor.workers import WorkerPool
+
+MESSAGES, DEVICES = 3000, 60
+
+
+class _JitterSession(FakeSession):
+    """Commit 5–15 ms ngẫu nhiên → các shard commit lệch nhau."""
+
+    async def commit(self):
+        self.commit_ms = random.uniform(5, 15)
+        await super().commit()
+
+
+async def _ingest(workers: int) -> tuple[float, list]:
+    log: list = []
+    pool = WorkerPool(workers=workers, session_factory=lambda: _JitterSession(log, 1, 10),
+                      max_batch=100, max_delay=0.02)
+    await pool.start(warm=False)
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        await pool.dispatch(f"dev-{i % DEVICES:03d}", str(i), {"data": {"temp_c": 25.0}})
+    await pool.close()
+    return MESSAGES / (time.perf_counter() - start), log
+
+
+def test_workers_keep_per_device_order_and_scale():
+    random.seed(7)
+    one, log_one = asyncio.run(_ingest(1))
+    four, log_four = asyncio.run(_ingest(4))
+    for log in (log_one, log_four):
+        assert len(log) == MESSAGES
+        assert check_order(log, DEVICES)
+    # commit chậm là nút cổ chai: 4 shard commit song song phải nhanh hơn rõ rệt
+    assert four > 2 * one, (one, four)
@@ -1,33 +1,55 @@
 """ESP32-like simulator.
 
 Nâng cấp từ script ban đầu để mô phỏng thiết bị thật:
-1. Đăng ký device qua HTTP để lấy secret (demo: secret = reversed uid).
+1. Đăng ký device qua HTTP để lấy token thiết bị (JWT scope=device).
 2. Gửi telemetry đều đặn qua MQTT (có msg_id)
-3. Publish retained status.
+3. Publish retained status `online: true`; đăng ký last-will `online: false` (broker tự publish
+   khi mất kết nối quá 1.5 × `MQTT_KEEPALIVE` giây) → backend thấy offline sau vài giây.
 4. Subscribe commands topic và thực thi lệnh (led_on/led_off/reboot giả lập).
-5. Poll hàng đợi command (HTTP) và ack sau khi xử lý.
-6. (Tuỳ chọn) Fallback gửi telemetry qua HTTP nếu MQTT mất kết nối.
+5. Poll hàng đợi command (HTTP) và ack sau khi xử lý (`COMMAND_LONG_POLL_WAIT` > 0 để dùng long-poll).
+6. (Tuỳ chọn) Fallback gửi telemetry qua HTTP nếu MQTT mất kết nối: buffer lại rồi gửi
+   cả lô qua `POST /devices/{uid}/telemetry/batch` (NDJSON nén gzip).
 
 Yêu cầu thư viện: paho-mqtt, requests
 pip install paho-mqtt requests
+(`PAYLOAD_FORMAT = 'cbor'` cần thêm `pip install cbor2`, `'msgpack'` cần `pip install msgpack`)
 """
 
-import json, time, random, threading, requests, sys
+import json, gzip, time, random, threading, requests, sys
+from collections import deque
 from paho.mqtt import client as mqtt
 
 # --- CONFIG ---
 BROKER_HOST = 'localhost'        # Đổi sang IP host nếu chạy từ thiết bị ngoài
 BROKER_PORT = 1883
+MQTT_KEEPALIVE = 10              # giây; ngắn → last-will được gửi sớm khi thiết bị rớt mạng
 API_BASE = 'http://localhost:8000'
 DEVICE_UID = 'dev-01'
+USER_EMAIL = 'admin@example.com'  # login demo; cần để đăng ký lại uid đã có khi chưa có token thiết bị
 TENANT = 't0'
 MQTT_TELEMETRY_INTERVAL = 2      # giây
 COMMAND_POLL_INTERVAL = 5        # giây
+COMMAND_LONG_POLL_WAIT = 0       # >0: long-poll, server giữ request tối đa N giây đến khi có command
+PAYLOAD_FORMAT = 'json'          # 'json' | 'cbor' | 'msgpack' (nhị phân: publish lên .../telemetry/<format>)
 USE_HTTP_FALLBACK = False        # True: gửi cả HTTP telemetry khi MQTT lỗi
+HTTP_BATCH_SIZE = 50             # gửi lô khi buffer đủ N bản ghi hoặc khi MQTT kết nối lại
+HTTP_BUFFER_MAX = 1000           # buffer đầy → bỏ bản ghi cũ nhất (như RAM giới hạn trên ESP32)
 
 LED_STATE = False
-DEVICE_SECRET = None
+DEVICE_TOKEN = None
 STOP = False
+HTTP_BUFFER = deque(maxlen=HTTP_BUFFER_MAX)
+
+def encode_payload(payload):
+    """Mã hoá telemetry theo PAYLOAD_FORMAT, trả về (topic, bytes)."""
+    topic = f'{TENANT}/devices/{DEVICE_UID}/telemetry'
+    if PAYLOAD_FORMAT == 'cbor':
+        import cbor2
+        return topic + '/cbor', cbor2.dumps(payload)
+    if PAYLOAD_FORMAT == 'msgpack':
+        import msgpack
+        return topic + '/msgpack', msgpack.packb(payload)
+    return topic, json.dumps(payload)
 
 # --- HTTP helper ---
 def http_post(path, json_body, headers=None):
@@ -40,46 +62,63 @@ def http_post(path, json_body, headers=None):
         print('[HTTP] POST error', path, e)
         return None
 
-def http_get(path, headers=None, params=None):
+def http_get(path, headers=None, params=None, timeout=5):
     url = API_BASE + path
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=5)
+        r = requests.get(url, headers=headers, params=params, timeout=timeout)
         r.raise_for_status()
         return r.json()
     except Exception as e:
         print('[HTTP] GET error', path, e)
         return None
 
+def device_headers():
+    return {'Authorization': f'Bearer {DEVICE_TOKEN}'}
+
+def user_headers():
+    resp = http_post('/auth/login', {'email': USER_EMAIL, 'password': 'x'})
+    return {'Authorization': f'Bearer {resp["access_token"]}'} if resp else {}
+
 def register_device():
-    global DEVICE_SECRET
+    global DEVICE_TOKEN
     print('[REG] registering device', DEVICE_UID)
     data = {'device_uid': DEVICE_UID, 'name': DEVICE_UID}
-    resp = http_post('/devices/register', data)
+    # uid đã đăng ký → server đòi credential: token thiết bị đang có, không thì token user
+    headers = device_headers() if DEVICE_TOKEN else user_headers()
+    resp = http_post('/devices/register', data, headers)
     if not resp:
         print('[REG] failed')
         return False
-    # secret demo = reversed uid (server dùng vậy) -> hoặc decode JWT.
-    DEVICE_SECRET = DEVICE_UID[::-1]
-    print('[REG] got secret (demo):', DEVICE_SECRET)
+    # token ký bởi server, verify không cần DB; bị thu hồi → 403, cần user cấp lại token mới
+    DEVICE_TOKEN = resp['access_token']
+    print('[REG] got device token')
     return True
 
-def ack_command(command_id):
-    headers = {'X-Device-Secret': DEVICE_SECRET}
-    resp = http_post(f'/devices/{DEVICE_UID}/commands/{command_id}/ack', {}, headers)
+def ack_commands(command_ids):
+    # 1 request cho cả lô; command không ack trước `lease_until` sẽ được server giao lại
+    resp = http_post(f'/devices/{DEVICE_UID}/commands/ack', {'ids': command_ids}, device_headers())
     if resp:
-        print(f'[CMD] acked id={command_id}')
+        print(f'[CMD] acked ids={resp.get("acked")}')
 
 def poll_commands():
-    if not DEVICE_SECRET:
+    if not DEVICE_TOKEN:
         return
-    headers = {'X-Device-Secret': DEVICE_SECRET}
-    rows = http_get(f'/devices/{DEVICE_UID}/commands/poll', headers) or []
+    headers = device_headers()
+    if COMMAND_LONG_POLL_WAIT > 0:
+        rows = http_get(f'/devices/{DEVICE_UID}/commands/poll', headers,
+                        params={'wait': COMMAND_LONG_POLL_WAIT}, timeout=COMMAND_LONG_POLL_WAIT + 5)
+    else:
+        rows = http_get(f'/devices/{DEVICE_UID}/commands/poll', headers)
+    if rows is None:
+        return None
     for row in rows:
         cid = row.get('id')
         cmd = row.get('cmd')
         params = row.get('params') or {}
         handle_local_command(cmd, params, source=f'queue:{cid}')
-        ack_command(cid)
+    if rows:
+        ack_commands([row['id'] for row in rows])
+    return rows
 
 def handle_local_command(cmd, params, source='mqtt'):  # giả lập thực thi lệnh
     global LED_STATE
@@ -94,6 +133,8 @@ def handle_local_command(cmd, params, source='mqtt'):  # giả lập thực thi
 
 # --- MQTT ---
 client = mqtt.Client()
+STATUS_TOPIC = f'{TENANT}/devices/{DEVICE_UID}/status'
+client.will_set(STATUS_TOPIC, json.dumps({'online': False}), qos=1, retain=True)
 
 def on_connect(c, userdata, flags, rc):
     if rc == 0:
@@ -102,7 +143,7 @@ def on_connect(c, userdata, flags, rc):
         c.subscribe(commands_topic, qos=1)
         print('[MQTT] subscribed', commands_topic)
         # publish retained status
-        c.publish(f'{TENANT}/devices/{DEVICE_UID}/status', json.dumps({'online': True, 'ts': int(time.time())}), qos=1, retain=True)
+        c.publish(STATUS_TOPIC, json.dumps({'online': True, 'ts': int(time.time())}), qos=1, retain=True)
     else:
         print('[MQTT] connect failed rc', rc)
 
@@ -122,7 +163,7 @@ client.on_message = on_message
 def mqtt_connect_loop():
     while not STOP:
         try:
-            client.connect(BROKER_HOST, BROKER_PORT, 60)
+            client.connect(BROKER_HOST, BROKER_PORT, MQTT_KEEPALIVE)
             client.loop_start()
             break
         except Exception as e:
@@ -138,15 +179,40 @@ def publish_telemetry(counter):
             'led': LED_STATE,
         }
     }
-    topic = f'{TENANT}/devices/{DEVICE_UID}/telemetry'
+    topic, body = encode_payload(payload)
     try:
-        client.publish(topic, json.dumps(payload), qos=1)
+        # mất kết nối thì paho không raise mà trả rc != 0
+        info = client.publish(topic, body, qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(mqtt.error_string(info.rc))
         print('[TEL] sent', payload)
+        if HTTP_BUFFER:
+            flush_http_buffer()  # MQTT đã kết nối lại → gửi nốt phần còn buffer
     except Exception as e:
         print('[TEL] mqtt publish failed', e)
-        if USE_HTTP_FALLBACK and DEVICE_SECRET:
-            headers = {'X-Device-Secret': DEVICE_SECRET}
-            http_post(f'/devices/{DEVICE_UID}/telemetry', {'msg_id': payload['msg_id'], 'payload': payload['data']}, headers)
+        if USE_HTTP_FALLBACK and DEVICE_TOKEN:
+            HTTP_BUFFER.append({'msg_id': payload['msg_id'], 'payload': payload['data'],
+                                'ts': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(payload['ts']))})
+            if len(HTTP_BUFFER) >= HTTP_BATCH_SIZE:
+                flush_http_buffer()
+
+def flush_http_buffer():
+    """Gửi buffer qua endpoint batch (NDJSON + gzip); chỉ xoá khỏi buffer khi server đã nhận."""
+    batch = list(HTTP_BUFFER)
+    if not batch:
+        return
+    body = gzip.compress(''.join(json.dumps(m) + '\n' for m in batch).encode())
+    headers = {**device_headers(), 'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+    try:
+        r = requests.post(f'{API_BASE}/devices/{DEVICE_UID}/telemetry/batch', data=body, headers=headers, timeout=10)
+        r.raise_for_status()
+        res = r.json()
+    except Exception as e:
+        print('[HTTP] batch error', e)
+        return
+    for _ in batch:
+        HTTP_BUFFER.popleft()
+    print(f"[TEL] http batch: {res['accepted']} accepted, {res['duplicate']} duplicate, {res['invalid']} invalid")
 
 def telemetry_loop():
     i = 0
@@ -157,7 +223,10 @@ def telemetry_loop():
 
 def command_poll_loop():
     while not STOP:
-        poll_commands()
+        rows = poll_commands()
+        # long-poll: server đã chờ sẵn, poll lại ngay (chỉ nghỉ khi lỗi)
+        if COMMAND_LONG_POLL_WAIT > 0 and rows is not None:
+            continue
         time.sleep(COMMAND_POLL_INTERVAL)
 
 def main():
@@ -175,6 +244,9 @@ def main():
     finally:
         global STOP
         STOP = True
+        # ngắt kết nối chủ động thì broker không gửi last-will → tự báo offline
+        if client.is_connected():
+            client.publish(STATUS_TOPIC, json.dumps({'online': False, 'ts': int(time.time())}), qos=1, retain=True).wait_for_publish(2)
         client.loop_stop()
         client.disconnect()
 